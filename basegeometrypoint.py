@@ -1,7 +1,10 @@
+import numpy as np
 from shapely.geometry import Point
 
 
 class BaseGeometryPoint(object):
+    __slots__ = ()
+
     @property
     def bbox(self):
         raise NotImplementedError("bounding box of base geometry is not implemented")
@@ -11,4 +14,7 @@ class BaseGeometryPoint(object):
         raise NotImplementedError("centroid of base geometry is not implemented")
 
     def contains(self, point: Point):
-        raise NotImplementedError("contains of base geometry is not implemented")
\ No newline at end of file
+        raise NotImplementedError("contains of base geometry is not implemented")
+
+    def contains_many(self, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        raise NotImplementedError("contains_many of base geometry is not implemented")
@@ -1,20 +1,77 @@
-import time
-from typing import Type
+import csv
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tracemalloc
+from datetime import datetime
+from itertools import islice
+from math import ceil
+from time import perf_counter_ns
+from typing import Dict, List, Tuple, Type
 
-from geopandas import GeoDataFrame
+import numpy as np
+import shapely
 from shapely.geometry import Point
 
+from featurereader import read_features
+from queryexecutor import QueryExecutor
 from spatialindex import SpatialIndex
-import numpy as np
-from tqdm import tqdm
+from workload import Workload
+
+'''
+Benchmarks of spatial indexes over seeded workloads (see workload.Workload).
+
+Every measurement is a result row: the key fields below and the metrics of the operation. Latencies are timed per
+operation with perf_counter_ns after untimed warm-up runs, and reported as mean, p50, p95, p99 and max in
+microseconds. Rows are written as JSON or CSV and can be compared against a baseline run.
+'''
+
+KEY_FIELDS = ("index", "params", "workload", "op", "variant")
+METRIC_FIELDS = ("count", "mean_us", "p50_us", "p95_us", "p99_us", "max_us", "ops_per_sec", "index_bytes",
+                 "build_peak_bytes", "base_rss_bytes", "peak_rss_bytes", "worker_rss_bytes", "worker_pss_bytes",
+                 "hit_ratio")
+RESULT_FIELDS = KEY_FIELDS + METRIC_FIELDS
+# metrics checked by compare_results, lower is better for all of them
+COMPARED_METRICS = ("p50_us", "p95_us", "p99_us", "index_bytes", "peak_rss_bytes")
+
+# items of a per operation benchmark run untimed before measuring
+_WARMUP_ITEMS = 1000
+
+
+def latency_summary(ns, ops_per_sample: int = 1) -> dict:
+    """Count, mean, p50, p95, p99 and max in microseconds of samples in nanoseconds, each of ops_per_sample ops"""
+    ns = np.asarray(ns, dtype=np.float64)
+    p50, p95, p99 = np.percentile(ns, [50, 95, 99]).tolist()
+    total = ns.sum()
+    return {"count": len(ns), "mean_us": float(ns.mean()) / 1e3, "p50_us": p50 / 1e3, "p95_us": p95 / 1e3,
+            "p99_us": p99 / 1e3, "max_us": float(ns.max()) / 1e3,
+            "ops_per_sec": len(ns) * ops_per_sample / (total / 1e9) if total > 0 else None}
+
+
+def max_rss() -> int:
+    """Peak resident set size of this process so far, in bytes"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def environment() -> dict:
+    return {"timestamp": datetime.now().isoformat(), "python": platform.python_version(), "numpy": np.__version__,
+            "shapely": shapely.__version__, "platform": platform.platform(), "cpu_count": os.cpu_count()}
 
 
 class BenchmarkRunner(object):
-    def __init__(self, name: str, description: str, iterations: int = int(1e4)):
-        assert iterations > 1
+    """Times functions with perf_counter_ns, after warmup untimed runs"""
+
+    def __init__(self, name: str, description: str, iterations: int = 10, warmup: int = 1):
+        if iterations < 1:
+            raise ValueError("iterations must be positive")
         self.name = name
         self.description = description
         self._iterations = int(iterations)
+        self.warmup = warmup
 
     @property
     def iterations(self):
@@ -24,69 +81,298 @@ class BenchmarkRunner(object):
     def iterations(self, i):
         self._iterations = i
 
-    def __timeit(self, fn, *args, **kwargs):
-        begin = time.time()
-        for i in tqdm(range(self.iterations)):
+    def timeit(self, fn, *args, **kwargs) -> np.ndarray:
+        """Nanoseconds of each of iterations calls of fn"""
+        for _ in range(self.warmup):
             fn(*args, **kwargs)
-        return time.time() - begin
-
-    def __loop_cost(self):
-        begin = time.time()
+        times = np.empty(self.iterations, dtype=np.int64)
         for i in range(self.iterations):
-            pass
-        return time.time() - begin
+            begin = perf_counter_ns()
+            fn(*args, **kwargs)
+            times[i] = perf_counter_ns() - begin
+        return times
 
-    def timeit(self, fn, *args, **kwargs):
-        lc = self.__loop_cost()
-        runtime = self.__timeit(fn, *args, **kwargs)
-        return runtime, runtime - lc
+    def time_each(self, fn, items: List) -> np.ndarray:
+        """Nanoseconds of fn(item) for every item. Warm-up runs go over the first items"""
+        for _ in range(self.warmup):
+            for item in items[:_WARMUP_ITEMS]:
+                fn(item)
+        times = np.empty(len(items), dtype=np.int64)
+        for i, item in enumerate(items):
+            begin = perf_counter_ns()
+            fn(item)
+            times[i] = perf_counter_ns() - begin
+        return times
+
+
+def _build_rss(index_cls: Type[SpatialIndex], params: dict, spec: dict) -> Tuple[int, int]:
+    """Process pool task of BenchmarkSI.benchmark_rss: peak RSS before and after building an index"""
+    workload = Workload.from_spec(spec)
+    base = max_rss()
+    index_cls(**params).build(workload.dataset)
+    return base, max_rss()
 
 
 class BenchmarkSI(BenchmarkRunner):
-    def __init__(self, name: str, description: str, iterations: int = 10, test_size: int = int(1e6)):
-        super().__init__(name, description, iterations)
-        self._dataset: GeoDataFrame = GeoDataFrame()
-        self._si: Type[SpatialIndex] = Type[SpatialIndex]
-        self._test_size = test_size
-        self._rx = None
-        self._ry = None
-
-    def set_index(self, si: Type[SpatialIndex]):
+    """Benchmarks of one index configuration over a workload. Query benchmarks share one built index"""
+
+    def __init__(self, name: str, description: str, iterations: int = 10, warmup: int = 1):
+        super().__init__(name, description, iterations, warmup)
+        self._si: Type[SpatialIndex] = SpatialIndex
+        self._params = dict()
+        self._workload: Workload = None
+        self._index = None
+
+    def set_index(self, si: Type[SpatialIndex], params: dict = None):
         self._si = si
+        self._params = dict(params or {})
+        self._index = None
+
+    def set_workload(self, workload: Workload):
+        self._workload = workload
+        self._index = None
+
+    def supports(self, method: str) -> bool:
+        """Whether the index implements method, beyond the SpatialIndex stub"""
+        impl = getattr(self._si, method, None)
+        return impl is not None and impl is not getattr(SpatialIndex, method, None)
+
+    def __new_index(self):
+        if self._workload is None:
+            raise ValueError("workload is not set")
+        return self._si(**self._params)
+
+    def __built_index(self):
+        if self._index is None:
+            self._index = self.__new_index()
+            self._index.build(self._workload.dataset)
+        return self._index
+
+    def __row(self, op: str, variant: str = "", **metrics) -> dict:
+        row = {"index": self.name, "params": self.description, "workload": self._workload.name, "op": op,
+               "variant": variant}
+        row.update(metrics)
+        return row
+
+    def benchmark_build(self) -> dict:
+        print('{} {}: running {} builds...'.format(self.name, self.description, self.iterations))
+        times = self.timeit(lambda: self.__new_index().build(self._workload.dataset))
+        return self.__row("build", **latency_summary(times))
+
+    def benchmark_stream_build(self, path: str, sample_size: int = None) -> dict:
+        """Builds from the features of path (see featurereader.read_features) instead of the loaded dataset"""
+        print('{} {}: running {} streaming builds...'.format(self.name, self.description, self.iterations))
+        times = self.timeit(lambda: self.__new_index().build_from_stream(islice(read_features(path), sample_size)))
+        return self.__row("build_from_stream", os.path.basename(path), **latency_summary(times))
+
+    def benchmark_memory(self) -> dict:
+        """Bytes retained by a built index and peak bytes allocated while building it, as seen by tracemalloc"""
+        print('{} {}: measuring index memory...'.format(self.name, self.description))
+        tracemalloc.start()
+        idx = self.__new_index()
+        idx.build(self._workload.dataset)
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return self.__row("memory", index_bytes=retained, build_peak_bytes=peak)
+
+    def benchmark_rss(self) -> dict:
+        """
+        Peak RSS of a fresh process building the index, and its peak RSS before the build (interpreter and
+        dataset). Includes memory that tracemalloc does not see, e.g. GEOS geometries
+        """
+        print('{} {}: measuring peak RSS...'.format(self.name, self.description))
+        if self._workload.spec is None:
+            raise ValueError("workload can not be rebuilt in another process")
+        with multiprocessing.get_context("spawn").Pool(1) as pool:
+            base, peak = pool.apply(_build_rss, (self._si, self._params, self._workload.spec))
+        return self.__row("rss", base_rss_bytes=base, peak_rss_bytes=peak)
+
+    def benchmark_lookup(self, n: int, distribution=Workload.UNIFORM, cache_size: int = 0) -> dict:
+        """Single point lookups; with cache_size > 0 through the index lookup cache (see GeoTrieIndex.enable_cache)"""
+        variant = self.__variant(distribution)
+        print('{} {}: running {} {} lookups...'.format(self.name, self.description, n, variant))
+        idx = self.__built_index()
+        xs, ys = self._workload.points(n, distribution)
+        points = [Point(x, y) for x, y in zip(xs.tolist(), ys.tolist())]
+        if cache_size <= 0:
+            return self.__row("lookup", variant, **latency_summary(self.time_each(idx.lookup, points)))
+        idx.enable_cache(cache_size)
+        try:
+            times = self.time_each(idx.lookup, points)
+            stats = idx.cache_stats()
+        finally:
+            idx.disable_cache()
+        return self.__row("cached_lookup", "{} cache_size={}".format(variant, cache_size), hit_ratio=stats["hit_ratio"],
+                          **latency_summary(times))
+
+    def benchmark_lookup_many(self, n: int, distribution=Workload.UNIFORM) -> dict:
+        """Batched lookups of n points, iterations times. Latencies are per batch, ops_per_sec per point"""
+        variant = self.__variant(distribution)
+        print('{} {}: running {} batched {} lookups...'.format(self.name, self.description, n, variant))
+        idx = self.__built_index()
+        xs, ys = self._workload.points(n, distribution)
+        return self.__row("lookup_many", variant, **latency_summary(self.timeit(idx.lookup_many, xs, ys), n))
+
+    def benchmark_parallel(self, n: int, worker_counts: List[int], distribution=Workload.UNIFORM) -> List[dict]:
+        """
+        Batched lookups of n points through a QueryExecutor, for every worker count. Latencies are per batch,
+        ops_per_sec per point; worker memory (see QueryExecutor.worker_memory) is taken after the timed runs
+        """
+        variant = self.__variant(distribution)
+        idx = self.__built_index()
+        xs, ys = self._workload.points(n, distribution)
+        rows = []
+        for workers in worker_counts:
+            print('{} {}: running {} batched {} lookups over {} workers...'.format(self.name, self.description, n,
+                                                                                  variant, workers))
+            # a few batches per worker to even out their load
+            with QueryExecutor(idx, workers, max(1, ceil(n / (workers * 4)))) as executor:
+                times = self.timeit(executor.lookup_many, xs, ys)
+                memory = executor.worker_memory()
+            rows.append(self.__row("parallel_lookup_many", "{} workers={}".format(variant, workers),
+                                   worker_rss_bytes=memory["rss_bytes"], worker_pss_bytes=memory["pss_bytes"],
+                                   **latency_summary(times, n)))
+        return rows
+
+    def benchmark_region(self, n: int, size: float = 0.1, predicate: str = "intersects") -> dict:
+        print('{} {}: running {} region queries...'.format(self.name, self.description, n))
+        idx = self.__built_index()
+        times = self.time_each(lambda region: idx.query_region(region, predicate), self._workload.regions(n, size))
+        return self.__row("query_region", "{} size={}".format(predicate, size), **latency_summary(times))
+
+    def benchmark_nearest(self, n: int, k: int = 1) -> dict:
+        print('{} {}: running {} nearest queries...'.format(self.name, self.description, n))
+        idx = self.__built_index()
+        xs, ys = self._workload.points(n)
+        points = [Point(x, y) for x, y in zip(xs.tolist(), ys.tolist())]
+        times = self.time_each(lambda point: idx.nearest(point, k), points)
+        return self.__row("nearest", "k={}".format(k), **latency_summary(times))
+
+    def benchmark_update(self, n: int) -> dict:
+        """update() of n random features, moved by a small offset, on an index of its own"""
+        print('{} {}: running {} updates...'.format(self.name, self.description, n))
+        idx = self.__new_index()
+        idx.build(self._workload.dataset)
+        # warm-up runs would move the same features twice, updates are timed cold
+        warmup, self.warmup = self.warmup, 0
+        try:
+            times = self.time_each(lambda update: idx.update(*update), self._workload.updates(n))
+        finally:
+            self.warmup = warmup
+        return self.__row("update", **latency_summary(times))
+
+    @classmethod
+    def __variant(cls, distribution) -> str:
+        return "uniform" if distribution == Workload.UNIFORM else "hotspot"
+
+
+class BenchmarkSuite(object):
+    '''
+    Runs benchmarks over a list of index cases and collects their result rows.
+    A case is (index name, index class, constructor params, description, ops); ops lists the benchmarks of the case,
+    all of OPS when None. Ops the index does not implement are skipped. The parallel op runs lookup_many over
+    QueryExecutors of 1, 2, 4 ... max_workers processes, on ten times point_count points.
+    '''
+    OPS = ("build", "memory", "rss", "lookup", "lookup_many", "parallel", "cached_lookup", "region", "nearest",
+           "update")
+
+    def __init__(self, workload: Workload, iterations: int = 5, warmup: int = 1, point_count: int = 10000,
+                 query_count: int = 1000, update_count: int = 100, cache_size: int = 4096, max_workers: int = None):
+        self.workload = workload
+        self.iterations = iterations
+        self.warmup = warmup
+        self.point_count = point_count
+        self.query_count = query_count
+        self.update_count = update_count
+        self.cache_size = cache_size
+        self.max_workers = max_workers or os.cpu_count() or 1
+
+    def run(self, cases: List[Tuple], ops: List[str] = None) -> List[dict]:
+        """Result rows of every op of every case, restricted to ops if given"""
+        rows = []
+        for name, index_cls, params, description, case_ops in cases:
+            bm = BenchmarkSI(name, description, self.iterations, self.warmup)
+            bm.set_index(index_cls, params)
+            bm.set_workload(self.workload)
+            for op in case_ops or self.OPS:
+                if ops is None or op in ops:
+                    rows.extend(self.__run_op(bm, op))
+        return rows
+
+    def __run_op(self, bm: BenchmarkSI, op: str) -> List[dict]:
+        distributions = (Workload.UNIFORM, Workload.HOTSPOT)
+        if op == "build":
+            return [bm.benchmark_build()]
+        elif op == "memory":
+            return [bm.benchmark_memory()]
+        elif op == "rss":
+            return [bm.benchmark_rss()]
+        elif op == "lookup":
+            return [bm.benchmark_lookup(self.point_count, d) for d in distributions]
+        elif op == "lookup_many":
+            return [bm.benchmark_lookup_many(self.point_count, d) for d in distributions]
+        elif op == "parallel":
+            if not bm.supports("save"):
+                return []
+            worker_counts = [1 << i for i in range(self.max_workers.bit_length()) if 1 << i < self.max_workers]
+            return bm.benchmark_parallel(10 * self.point_count, worker_counts + [self.max_workers])
+        elif op == "cached_lookup":
+            if not bm.supports("enable_cache"):
+                return []
+            return [bm.benchmark_lookup(self.point_count, Workload.HOTSPOT, self.cache_size)]
+        elif op == "region":
+            return [bm.benchmark_region(self.query_count)] if bm.supports("query_region") else []
+        elif op == "nearest":
+            return [bm.benchmark_nearest(self.query_count)] if bm.supports("nearest") else []
+        elif op == "update":
+            return [bm.benchmark_update(self.update_count)] if bm.supports("update") else []
+        else:
+            raise Exception("Invalid benchmark op")
+
+
+def write_results(rows: List[dict], path: str, meta: dict = None):
+    """Writes result rows as CSV if path ends with .csv, as JSON (with meta) otherwise"""
+    if path.endswith(".csv"):
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(RESULT_FIELDS), extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(rows)
+    else:
+        with open(path, "w") as f:
+            json.dump({"meta": meta, "results": rows}, f, indent=1)
+
+
+def read_results(path: str) -> List[dict]:
+    if not path.endswith(".csv"):
+        with open(path) as f:
+            return json.load(f)["results"]
+    with open(path, newline="") as f:
+        rows = list(csv.DictReader(f))
+    for row in rows:
+        for field in METRIC_FIELDS:
+            if field in row:
+                row[field] = float(row[field]) if row[field] not in ("", None) else None
+    return rows
+
 
-    def set_dataset(self, gpd: GeoDataFrame):
-        self._dataset = gpd
-
-    def __prepare_test_points(self):
-        if self._dataset is None:
-            raise ValueError("dataset is not set")
-        max_bounds = self._dataset.bounds.max()
-        min_bounds = self._dataset.bounds.min()
-
-        max_lon = max_bounds["maxx"]
-        max_lat = max_bounds["maxy"]
-        min_lon = min_bounds["minx"]
-        min_lat = min_bounds["miny"]
-        self._rx = (max_lon - min_lon) * np.random.random(self._test_size) + min_lon
-        self._ry = (max_lat - min_lat) * np.random.random(self._test_size) + min_lat
-
-    def benchmark_build(self, *args, **kwargs):
-        print('{}: running build {} times...'.format(self.name, self.iterations))
-        times = np.array([])
-        total_runtime, _ = self.timeit(self._si(*args, **kwargs).build, self._dataset)
-        times = np.append(times, total_runtime)
-        return times.mean(), times.std()
-
-    def benchmark_lookup(self, *args, **kwargs):
-        print('{}: running {} lookups {} times...'.format(self.name, self._test_size, self.iterations))
-        times = np.array([])
-        idx = self._si(*args, **kwargs)
-        idx.build(self._dataset)
-        for i in tqdm(range(self.iterations)):
-            self.__prepare_test_points()
-            begin = time.time()
-            for pt in tqdm(zip(self._rx, self._ry)):
-                idx.lookup(Point(*pt))
-            end = time.time()
-            times = np.append(times, end - begin)
-        return times.mean(), times.std()
+def compare_results(baseline: List[dict], current: List[dict], threshold: float = 0.1) -> List[dict]:
+    """
+    Metric by metric comparison of the rows of current against the baseline rows with the same key. A metric
+    regresses when it grew by more than threshold (a fraction of its baseline value)
+    """
+    by_key: Dict[tuple, dict] = {tuple(row[k] for k in KEY_FIELDS): row for row in baseline}
+    out = []
+    for row in current:
+        base = by_key.get(tuple(row[k] for k in KEY_FIELDS))
+        if base is None:
+            continue
+        for metric in COMPARED_METRICS:
+            before, after = base.get(metric), row.get(metric)
+            if before is None or after is None or before <= 0:
+                continue
+            change = after / before - 1
+            diff = {k: row[k] for k in KEY_FIELDS}
+            diff.update({"metric": metric, "baseline": before, "current": after, "change": change,
+                         "regression": change > threshold})
+            out.append(diff)
+    return out
@@ -0,0 +1,101 @@
+from collections import OrderedDict
+
+
+class CellCache(object):
+    '''
+    Bounded cache of per-cell lookup state, keyed by geohash.
+
+    Two eviction policies are provided:
+    LRU: evicts the entry used least recently
+    LFU: evicts the entry used least often, the least recently used one among ties
+    '''
+    LRU = 1
+    LFU = 2
+
+    def __init__(self, capacity: int, policy=LRU):
+        if policy not in (self.LRU, self.LFU):
+            raise Exception("Invalid eviction policy")
+        self.capacity = capacity
+        self.policy = policy
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.clear()
+
+    def clear(self):
+        """Drops all entries, counters are kept"""
+        # key -> value for LRU, key -> [value, use count] for LFU
+        self._entries = OrderedDict() if self.policy == self.LRU else dict()
+        # LFU only: use count -> keys with that count, least recently used first
+        self._counts = dict()
+        self._min_count = 0
+
+    def invalidate(self):
+        """Drops all entries after a change to the index"""
+        if len(self._entries) > 0:
+            self.invalidations += 1
+        self.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __touch(self, key):
+        entry = self._entries[key]
+        keys = self._counts[entry[1]]
+        del keys[key]
+        if len(keys) == 0:
+            del self._counts[entry[1]]
+            if self._min_count == entry[1]:
+                self._min_count += 1
+        entry[1] += 1
+        self._counts.setdefault(entry[1], OrderedDict())[key] = None
+
+    def get(self, key):
+        """Cached value of key, or None"""
+        if key not in self._entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if self.policy == self.LRU:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        self.__touch(key)
+        return self._entries[key][0]
+
+    def put(self, key, value):
+        if self.capacity <= 0:
+            return
+        if key in self._entries:
+            if self.policy == self.LRU:
+                self._entries[key] = value
+                self._entries.move_to_end(key)
+            else:
+                self._entries[key][0] = value
+                self.__touch(key)
+            return
+        if len(self._entries) >= self.capacity:
+            self.__evict()
+        if self.policy == self.LRU:
+            self._entries[key] = value
+        else:
+            self._entries[key] = [value, 1]
+            self._counts.setdefault(1, OrderedDict())[key] = None
+            self._min_count = 1
+
+    def __evict(self):
+        if self.policy == self.LRU:
+            self._entries.popitem(last=False)
+        else:
+            keys = self._counts[self._min_count]
+            key, _ = keys.popitem(last=False)
+            if len(keys) == 0:
+                del self._counts[self._min_count]
+            del self._entries[key]
+        self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"size": len(self._entries), "capacity": self.capacity, "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "invalidations": self.invalidations,
+                "hit_ratio": self.hits / lookups if lookups > 0 else 0.0}
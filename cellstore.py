@@ -0,0 +1,285 @@
+from typing import Iterator, List, Tuple
+
+import numpy as np
+
+import geohashes
+from geotrie import CellPosting
+
+
+def expand_ranges(starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """Concatenation of range(start, start + count) for every (start, count) pair"""
+    heads = np.cumsum(counts) - counts
+    return np.arange(int(counts.sum()), dtype=np.int64) + np.repeat(starts - heads, counts)
+
+
+class HilbertCellStore(object):
+    '''
+    Array backed alternative to GeoTrie.
+
+    Every geohash is mapped to its integer hilbert code, left aligned to gh_len characters and tagged with its own
+    length in the low 4 bits. Keys are kept in a sorted uint64 array with CSR style offsets into flat arrays of
+    polygon ids and interior flags. Because of the hilbert ordering, all keys under a prefix form a contiguous
+    slice of the key array.
+    '''
+
+    _LEN_BITS = 4
+
+    def __init__(self, gh_len, values: List):
+        """values is the list that inserted values are stored in, indexed by value.pid"""
+        if gh_len > geohashes.MAX_PRECISION:
+            raise ValueError("Unsupported geohash length: {}".format(gh_len))
+        self.gh_len = gh_len
+        self.values = values
+        self.clear()
+
+    @classmethod
+    def from_arrays(cls, gh_len, values: List, keys: np.ndarray, offsets: np.ndarray, ids: np.ndarray,
+                    interior: np.ndarray, clips=None) -> 'HilbertCellStore':
+        """Store over existing (e.g. memory mapped) arrays"""
+        store = cls(gh_len, values)
+        store.keys, store.offsets, store.ids, store.interior, store.clips = keys, offsets, ids, interior, clips
+        store._update_levels()
+        return store
+
+    @classmethod
+    def from_items(cls, gh_len, values: List, items) -> 'HilbertCellStore':
+        """Store holding the (geohash, posting) pairs of another store"""
+        store = cls(gh_len, values)
+        for gh, posting in items:
+            for value in posting.interior:
+                store.insert(gh, value, True)
+            for value, clip in zip(posting.boundary, posting.clips):
+                store.insert(gh, value, False, clip)
+        store.finalize()
+        return store
+
+    def clear(self):
+        self.keys = np.empty(0, dtype=np.uint64)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.ids = np.empty(0, dtype=np.int32)
+        self.interior = np.empty(0, dtype=bool)
+        self.clips = None
+        self.multi_level = False
+        self._levels = []
+        self._pending = []
+        self._removed = set()
+
+    def _shift(self, length):
+        return geohashes.BITS_PER_CHAR * (self.gh_len - length)
+
+    def _key(self, code: int, length: int) -> int:
+        return ((code << self._shift(length)) << self._LEN_BITS) | length
+
+    def _key_str(self, key: int) -> str:
+        length = key & ((1 << self._LEN_BITS) - 1)
+        return geohashes.to_string((key >> self._LEN_BITS) >> self._shift(length), length)
+
+    def insert(self, key, value, interior: bool = False, clip=None):
+        if len(key) != self.gh_len:
+            self.multi_level = True
+        self._pending.append((self._key(geohashes.to_code(key), len(key)), value.pid, interior, clip))
+
+    def remove(self, key, value):
+        """Removes value from the store. Entries are dropped by polygon id, on the next finalize"""
+        self._removed.add(value.pid)
+
+    def finalize(self):
+        """Merges pending inserts and removals into the sorted arrays"""
+        if len(self._pending) == 0 and len(self._removed) == 0:
+            return
+        keys = np.array([p[0] for p in self._pending], dtype=np.uint64)
+        ids = np.array([p[1] for p in self._pending], dtype=np.int32)
+        interior = np.array([p[2] for p in self._pending], dtype=bool)
+        clips = [p[3] for p in self._pending]
+        has_clips = self.clips is not None or any(c is not None for c in clips)
+
+        if len(self.ids) > 0:
+            keep = np.ones(len(self.ids), dtype=bool)
+            if len(self._removed) > 0:
+                keep = ~np.isin(self.ids, np.fromiter(self._removed, dtype=np.int32))
+            old_keys = np.repeat(self.keys, np.diff(self.offsets))[keep]
+            keys = np.concatenate([old_keys, keys])
+            ids = np.concatenate([self.ids[keep], ids])
+            interior = np.concatenate([self.interior[keep], interior])
+            old_clips = self.clips if self.clips is not None else [None] * len(self.ids)
+            clips = [c for c, k in zip(old_clips, keep.tolist()) if k] + clips
+        self._pending = []
+        self._removed = set()
+
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        self.ids = ids[order]
+        self.interior = interior[order]
+        self.clips = [clips[i] for i in order] if has_clips else None
+        self.keys, starts = np.unique(keys, return_index=True)
+        self.offsets = np.append(starts, len(keys)).astype(np.int64)
+        self._update_levels()
+
+    def _update_levels(self):
+        lengths = self.keys & np.uint64((1 << self._LEN_BITS) - 1)
+        self._levels = sorted(int(l) for l in np.unique(lengths))
+        self.multi_level = self._levels not in ([], [self.gh_len])
+
+    def _posting(self, found: CellPosting, i: int):
+        for j in range(self.offsets[i], self.offsets[i + 1]):
+            value = self.values[int(self.ids[j])]
+            if self.interior[j]:
+                found.interior.append(value)
+            else:
+                found.boundary.append(value)
+                found.clips.append(None if self.clips is None else self.clips[j])
+
+    def _find(self, key: int) -> int:
+        i = int(np.searchsorted(self.keys, np.uint64(key)))
+        if i < len(self.keys) and int(self.keys[i]) == key:
+            return i
+        return -1
+
+    def search(self, key) -> CellPosting:
+        if len(key) != self.gh_len:
+            raise Exception("Incorrect key length")
+        if self.multi_level:
+            return self.search_prefixes(key)
+        self.finalize()
+        found = CellPosting()
+        i = self._find(self._key(geohashes.to_code(key), len(key)))
+        if i >= 0:
+            self._posting(found, i)
+        return found
+
+    def search_prefixes(self, key) -> CellPosting:
+        """Merges the postings of key and of every stored prefix of key"""
+        self.finalize()
+        found = CellPosting()
+        code = geohashes.to_code(key)
+        for length in self._levels:
+            if length > len(key):
+                break
+            prefix = code >> (geohashes.BITS_PER_CHAR * (len(key) - length))
+            i = self._find(self._key(prefix, length))
+            if i >= 0:
+                self._posting(found, i)
+        return found
+
+    def search_many(self, codes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Vectorized search for an array of gh_len codes, prefixes included.
+        Returns parallel arrays of (position in codes, position in the flat id arrays) for every entry found
+        """
+        self.finalize()
+        if len(self.keys) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        codes = np.asarray(codes, dtype=np.int64).astype(np.uint64)
+        found_codes, found_entries = [], []
+        for length in self._levels:
+            shift = np.uint64(self._shift(length))
+            keys = (((codes >> shift) << shift) << np.uint64(self._LEN_BITS)) | np.uint64(length)
+            i = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+            hit = np.flatnonzero(self.keys[i] == keys)
+            starts = self.offsets[i[hit]]
+            counts = self.offsets[i[hit] + 1] - starts
+            found_codes.append(np.repeat(hit, counts))
+            found_entries.append(expand_ranges(starts, counts))
+        return np.concatenate(found_codes), np.concatenate(found_entries)
+
+    def prefix_range(self, prefix: str) -> slice:
+        """Slice of keys stored at or below prefix"""
+        self.finalize()
+        shift = self._shift(len(prefix)) + self._LEN_BITS
+        code = geohashes.to_code(prefix)
+        lo = np.searchsorted(self.keys, np.uint64(code << shift))
+        end = (code + 1) << shift
+        hi = len(self.keys) if end >= 1 << 64 else np.searchsorted(self.keys, np.uint64(end))
+        return slice(int(lo), int(hi))
+
+    def key_codes(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Integer codes and lengths of every stored key"""
+        self.finalize()
+        lengths = self.keys & np.uint64((1 << self._LEN_BITS) - 1)
+        shifts = np.uint64(geohashes.BITS_PER_CHAR) * (np.uint64(self.gh_len) - lengths)
+        codes = (self.keys >> np.uint64(self._LEN_BITS)) >> shifts
+        return codes.astype(np.int64), lengths.astype(np.int64)
+
+    def scan_prefixes(self, prefixes: List[str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Entries related to a list of disjoint cells: those stored at or below a cell, and those stored at a prefix of
+        it. Returns parallel arrays of (position in prefixes, value pid, interior flag, length of the stored key)
+        """
+        self.finalize()
+        codes = [geohashes.to_code(prefix) for prefix in prefixes]
+        prefix_lengths = np.array([len(prefix) for prefix in prefixes], dtype=np.int64)
+        # keys at or below a prefix lie in [code << shift, (code + 1) << shift)
+        lo = [(code << (self._shift(len(p)) + self._LEN_BITS)) for code, p in zip(codes, prefixes)]
+        hi = [((code + 1) << (self._shift(len(p)) + self._LEN_BITS)) - 1 for code, p in zip(codes, prefixes)]
+        lo = np.searchsorted(self.keys, np.array(lo, dtype=np.uint64))
+        hi = np.searchsorted(self.keys, np.array(hi, dtype=np.uint64), side="right")
+        found = expand_ranges(lo, hi - lo)
+        counts = self.offsets[found + 1] - self.offsets[found]
+        cells = [np.repeat(np.repeat(np.arange(len(prefixes)), hi - lo), counts)]
+        entries = [expand_ranges(self.offsets[found], counts)]
+        lengths = [np.repeat((self.keys[found] & np.uint64((1 << self._LEN_BITS) - 1)).astype(np.int64), counts)]
+        if self.multi_level and len(self.keys) > 0:
+            codes = np.array(codes, dtype=np.int64).astype(np.uint64)
+            for length in self._levels:
+                shorter = np.flatnonzero(prefix_lengths > length)
+                if len(shorter) == 0:
+                    break
+                shifts = np.uint64(geohashes.BITS_PER_CHAR) * (prefix_lengths[shorter] - length).astype(np.uint64)
+                keys = (((codes[shorter] >> shifts) << np.uint64(self._shift(length))) << np.uint64(self._LEN_BITS)) \
+                    | np.uint64(length)
+                i = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+                hit = self.keys[i] == keys
+                starts = self.offsets[i[hit]]
+                counts = self.offsets[i[hit] + 1] - starts
+                cells.append(np.repeat(shorter[hit], counts))
+                entries.append(expand_ranges(starts, counts))
+                lengths.append(np.full(len(entries[-1]), length, dtype=np.int64))
+        entries = np.concatenate(entries)
+        return np.concatenate(cells), self.ids[entries], self.interior[entries], np.concatenate(lengths)
+
+    def iter_items(self) -> Iterator[Tuple[str, CellPosting]]:
+        """(geohash, posting) pairs, one at a time"""
+        self.finalize()
+        for i, key in enumerate(self.keys.tolist()):
+            found = CellPosting()
+            self._posting(found, i)
+            yield self._key_str(key), found
+
+    def posting_arrays(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Posting list length of every key, and the value pids and interior flags of all postings in key order"""
+        self.finalize()
+        return np.diff(self.offsets), self.ids, self.interior
+
+    @property
+    def search_probes(self) -> int:
+        """Binary searches of the key array run by a search"""
+        return len(self._levels) if self.multi_level else 1
+
+    @property
+    def nbytes(self) -> int:
+        return self.keys.nbytes + self.offsets.nbytes + self.ids.nbytes + self.interior.nbytes
+
+    def walk(self, fn):
+        """fn takes a dictionary of keys in store and their values"""
+        self.finalize()
+        out = dict()
+        for i, key in enumerate(self.keys.tolist()):
+            found = CellPosting()
+            self._posting(found, i)
+            out[self._key_str(key)] = found
+        fn(out)
+
+    def __len__(self):
+        self.finalize()
+        return len(self.keys)
+
+    def items(self, prefix: str = None) -> List:
+        """(geohash, posting) pairs, optionally restricted to keys at or below prefix"""
+        self.finalize()
+        rng = range(len(self.keys)) if prefix is None else range(*self.prefix_range(prefix).indices(len(self.keys)))
+        out = []
+        for i in rng:
+            found = CellPosting()
+            self._posting(found, i)
+            out.append((self._key_str(int(self.keys[i])), found))
+        return out
@@ -1,103 +1,122 @@
 import argparse
-
-import geopandas as gpd
-import os
 import logging
-import pandas as pd
-from datetime import datetime
-import numpy as np
-from geopandas.sindex import SpatialIndex
-
-from shapely.geometry import Point
-from shapely.strtree import STRtree
+import os
+import sys
 
-from benchmark import BenchmarkSI
+from benchmark import BenchmarkSuite, compare_results, environment, read_results, write_results
 from geotrieindex import GeoTrieIndex
-
-import time
-
+from shapelyindex import ShapelySTRtreeIndex
 from strtreeindex import STRTreeIndex
-
-
-def current_milli_time():
-    return int(round(time.time() * 1000))
+from workload import Workload
+
+SCAN_ALGORITHMS = ['SUBSAMPLE_GRID', 'NEIGHBOUR_BFS', 'TOP_DOWN', 'ADAPTIVE_COVER', 'VECTOR_GRID']
+BUILD_OPS = ('build', 'memory', 'rss')
+INDEXES = ('geotrie', 'strtree', 'shapely')
+
+
+def benchmark_cases(gh_lens, indexes) -> list:
+    """
+    (index name, class, params, description, ops) of every configuration benchmarked: builds of every scan
+    algorithm per geohash length, and all ops for both cell stores, all STR tree variants and shapely's STRtree
+    """
+    cases = []
+    if 'geotrie' in indexes:
+        for gh_len in gh_lens:
+            for alg_name in SCAN_ALGORITHMS:
+                params = {'gh_len': gh_len, 'scan_algorithm': getattr(GeoTrieIndex, alg_name)}
+                cases.append(('geotrie', GeoTrieIndex, params, 'gh_len={} scan_algorithm={}'.format(gh_len, alg_name),
+                              BUILD_OPS))
+            for store_name in ['TRIE_STORE', 'ARRAY_STORE']:
+                params = {'gh_len': gh_len, 'scan_algorithm': GeoTrieIndex.VECTOR_GRID,
+                          'store_type': getattr(GeoTrieIndex, store_name)}
+                cases.append(('geotrie', GeoTrieIndex, params,
+                              'gh_len={} scan_algorithm=VECTOR_GRID store_type={}'.format(gh_len, store_name), None))
+    if 'strtree' in indexes:
+        for tree_name in ['OBJECT_TREE', 'FLAT_TREE']:
+            for packing_name in ['STR_PACKING', 'HILBERT_PACKING']:
+                params = {'node_capacity': 10, 'tree_type': getattr(STRTreeIndex, tree_name),
+                          'packing': getattr(STRTreeIndex, packing_name)}
+                cases.append(('strtree', STRTreeIndex, params,
+                              'node_capacity=10 tree_type={} packing={}'.format(tree_name, packing_name), None))
+    if 'shapely' in indexes:
+        cases.append(('shapely', ShapelySTRtreeIndex, {'node_capacity': 10}, 'node_capacity=10', None))
+    return cases
 
 
 def main():
-    # TODO: Use logging
-    parser = argparse.ArgumentParser(prog="GeoTrie Driver", description="Driver program for GeoTrie algorithm")
-    parser.add_argument("-l", "--len-geohash", type=int, default=4,
-                        help="length of geohash, between 1 and 10 (inclusive)")
-    parser.add_argument("-i", "--input", help="path to input geojson", required=False)
-    parser.add_argument("-s", "--sample", help="sample size", type=int, required=False)
+    parser = argparse.ArgumentParser(prog="GeoTrie Driver", description="Benchmark suite for the spatial indexes")
+    parser.add_argument("-i", "--input", help="path to input geojson, a synthetic dataset is used if not given")
+    parser.add_argument("-s", "--sample", help="sample size of the input", type=int)
+    parser.add_argument("-n", "--polygons", type=int, default=10000, help="polygon count of the synthetic dataset")
+    parser.add_argument("-l", "--len-geohash", type=int, nargs="+", default=[4],
+                        help="lengths of geohash, between 1 and 10 (inclusive)")
+    parser.add_argument("--tune", action="store_true",
+                        help="benchmark the geohash length recommended by GeoTrieIndex.auto_tune instead of -l")
+    parser.add_argument("--memory-budget", type=int, help="index bytes allowed to auto_tune")
+    parser.add_argument("--indexes", default=",".join(INDEXES), help="comma separated subset of " + ",".join(INDEXES))
+    parser.add_argument("--ops", help="comma separated subset of " + ",".join(BenchmarkSuite.OPS))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--points", type=int, default=10000, help="points per lookup benchmark")
+    parser.add_argument("--queries", type=int, default=1000, help="queries per region and nearest benchmark")
+    parser.add_argument("--updates", type=int, default=100)
+    parser.add_argument("--rss", action="store_true", help="measure peak RSS of builds in fresh processes")
+    parser.add_argument("--workers", type=int,
+                        help="largest worker count of the parallel benchmark, all cores if not given")
+    parser.add_argument("-o", "--output", default="bm_results.json", help="results file, .json or .csv")
+    parser.add_argument("--compare", help="results file of a baseline run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative growth of a metric over the baseline reported as a regression")
     args = parser.parse_args()
-    gh_len = args.len_geohash
-    input_path = args.input
-    sample_size = args.sample
 
-    if gh_len <= 0 or gh_len > 10:
-        logging.error("Unsupported geohash length: {}. Must be between 1 and 10.".format(gh_len))
+    for gh_len in args.len_geohash:
+        if gh_len <= 0 or gh_len > 10:
+            logging.error("Unsupported geohash length: {}. Must be between 1 and 10.".format(gh_len))
+            return 2
 
-    if not os.path.exists(input_path):
-        logging.error("Invalid input file: No such file or directory: {}".format(input_path))
-        return
-
-    geojson = gpd.read_file(input_path)
-    if sample_size is not None and sample_size > 0:
-        input_data = geojson[:sample_size]
+    if args.input is not None:
+        if not os.path.exists(args.input):
+            logging.error("Invalid input file: No such file or directory: {}".format(args.input))
+            return 2
+        workload = Workload.from_file(args.input, args.sample, args.seed)
     else:
-        input_data = geojson
-
-    bm_results = []
-    bm_columns = ['index_type', 'op', 'op_count', 'total_time_ms', 'ops_per_sec', 'remark']
-    iters = 5
-    test_size = int(1e6)
-
-    b = BenchmarkSI("gti", "desc", test_size=test_size)
-    b.set_index(GeoTrieIndex)
-    b.set_dataset(input_data)
-    b.iterations = iters
-    build_bm = b.benchmark_build(gh_len=gh_len, scan_algorithm=GeoTrieIndex.SUBSAMPLE_GRID)
-    print('build: {}ms ± {}ms'.format(build_bm[0] * 1e3, build_bm[1] * 1e3))
-    lookup_bm = b.benchmark_lookup(gh_len=gh_len, scan_algorithm=GeoTrieIndex.SUBSAMPLE_GRID)
-    print('lookup: {}ms ± {}ms'.format(lookup_bm[0] * 1e3, lookup_bm[1] * 1e3))
-
-    bm_results.append(['geotrie', 'build', 1, build_bm[0] * 1e3, 1 / build_bm[0],
-                       'gh_len={} scan_algorithm=SUBSAMPLE_GRID iterations={}'.format(gh_len, b.iterations)])
-    bm_results.append(['geotrie', 'lookup', test_size, lookup_bm[0] * 1e3, test_size / lookup_bm[0],
-                       'gh_len={} scan_algorithm=SUBSAMPLE_GRID iterations={}'.format(gh_len, b.iterations)])
-
-    # b = BenchmarkSI("gti", "desc", test_size=test_size)
-    # b.set_index(GeoTrieIndex)
-    # b.set_dataset(input_data)
-    # b.iterations = iters
-    # build_bm = b.benchmark_build(gh_len=gh_len, scan_algorithm=GeoTrieIndex.NEIGHBOUR_BFS)
-    # print('build: {}ms ± {}ms'.format(build_bm[0] * 1e3, build_bm[1] * 1e3))
-    # lookup_bm = b.benchmark_lookup(gh_len=gh_len, scan_algorithm=GeoTrieIndex.NEIGHBOUR_BFS)
-    # print('lookup: {}ms ± {}ms'.format(lookup_bm[0] * 1e3, lookup_bm[1] * 1e3))
-    #
-    # bm_results.append(['geotrie', 'build', 1, build_bm[0] * 1e3, 1 / build_bm[0],
-    #                    'gh_len={} scan_algorithm=NEIGHBOUR_BFS iterations={}'.format(gh_len, b.iterations)])
-    # bm_results.append(['geotrie', 'lookup', test_size, lookup_bm[0] * 1e3, test_size / lookup_bm[0],
-    #                    'gh_len={} scan_algorithm=NEIGHBOUR_BFS iterations={}'.format(gh_len, b.iterations)])
-
-    s = BenchmarkSI("sti", "desc", test_size=test_size)
-    s.set_index(STRTreeIndex)
-    s.set_dataset(input_data)
-    s.iterations = iters
-    build_bm = s.benchmark_build()
-    print('build: {}ms ± {}ms'.format(build_bm[0] * 1e3, build_bm[1] * 1e3))
-    lookup_bm = s.benchmark_lookup(node_capacity=5)
-    print('lookup: {}ms ± {}ms'.format(lookup_bm[0] * 1e3, lookup_bm[1] * 1e3))
-
-    bm_results.append(['strtree', 'build', 1, build_bm[0] * 1e3, 1 / build_bm[0],
-                       'node_capacity=5 iterations={}'.format(s.iterations)])
-    bm_results.append(['strtree', 'lookup', test_size, lookup_bm[0] * 1e3, test_size / lookup_bm[0],
-                       'node_capacity=5 iterations={}'.format(s.iterations)])
-
-    bm_df = pd.DataFrame(bm_results, columns=bm_columns)
-    bm_df.to_csv("bm_all_10iter_nydata.csv", index=False)
+        workload = Workload.synthetic(args.polygons, args.seed)
+
+    if args.tune:
+        tuned = GeoTrieIndex.auto_tune(workload.dataset, args.memory_budget, seed=args.seed)
+        predicted = tuned["predicted"]
+        print("auto_tune: gh_len={} scan_algorithm={} predicted bytes={} candidates={:.2f} build_seconds={:.1f}"
+              .format(predicted["gh_len"], predicted["scan_algorithm"], predicted["bytes"], predicted["candidates"],
+                      predicted["build_seconds"]))
+        args.len_geohash = [tuned["params"]["gh_len"]]
+
+    ops = None if args.ops is None else args.ops.split(",")
+    if not args.rss:
+        ops = [op for op in (ops or BenchmarkSuite.OPS) if op != "rss"]
+    suite = BenchmarkSuite(workload, args.iterations, args.warmup, args.points, args.queries, args.updates,
+                           max_workers=args.workers)
+    rows = suite.run(benchmark_cases(args.len_geohash, args.indexes.split(",")), ops)
+
+    meta = dict(environment(), workload=workload.name, seed=args.seed, iterations=args.iterations,
+                warmup=args.warmup)
+    write_results(rows, args.output, meta)
+    for row in rows:
+        metrics = ["{}={}".format(k, round(row[k], 2)) for k in ("p50_us", "p95_us", "p99_us") if k in row]
+        metrics += ["{}={}".format(k, row[k]) for k in ("index_bytes", "peak_rss_bytes", "worker_pss_bytes",
+                                                         "hit_ratio") if k in row]
+        print("{} [{}] {} {}: {}".format(row["index"], row["params"], row["op"], row["variant"], " ".join(metrics)))
+
+    if args.compare is not None:
+        diffs = compare_results(read_results(args.compare), rows, args.threshold)
+        regressions = [d for d in diffs if d["regression"]]
+        for d in regressions:
+            print("REGRESSION {} [{}] {} {} {}: {} -> {} ({:+.1%})".format(
+                d["index"], d["params"], d["op"], d["variant"], d["metric"], d["baseline"], d["current"], d["change"]))
+        print("{} metrics compared, {} regressions".format(len(diffs), len(regressions)))
+        return 1 if len(regressions) > 0 else 0
+    return 0
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,141 @@
+import json
+import os
+from typing import Iterable, Iterator
+
+from geopandas import GeoDataFrame
+
+'''
+Readers yielding GeoJSON like features ({"id", "geometry", "properties"} mappings, see spatialindex.parse_feature)
+one at a time, for SpatialIndex.build_from_stream. Files are read in blocks, so memory stays bounded by the largest
+feature rather than by the size of the file.
+'''
+
+GEOJSON_SEQ_EXTENSIONS = (".geojsonl", ".geojsons", ".geojsonseq", ".ndjson", ".jsonl")
+
+
+class _JsonStream(object):
+    """Incremental decoder of consecutive JSON values in a text file"""
+
+    _WHITESPACE = " \t\n\r"
+
+    def __init__(self, f, block_size: int):
+        self.__f = f
+        self.__block_size = block_size
+        self.__decoder = json.JSONDecoder()
+        self.__buf = ""
+        self.__pos = 0
+        self.__eof = False
+
+    def __read(self, size: int) -> bool:
+        if self.__eof:
+            return False
+        block = self.__f.read(size)
+        if len(block) == 0:
+            self.__eof = True
+            return False
+        # drop what has been consumed already
+        self.__buf = self.__buf[self.__pos:] + block
+        self.__pos = 0
+        return True
+
+    def skip(self, chars: str = _WHITESPACE) -> str:
+        """Skips chars and returns the next character without consuming it, '' at the end of the file"""
+        while True:
+            while self.__pos < len(self.__buf) and self.__buf[self.__pos] in chars:
+                self.__pos += 1
+            if self.__pos < len(self.__buf):
+                return self.__buf[self.__pos]
+            if not self.__read(self.__block_size):
+                return ""
+
+    def expect(self, char: str):
+        if self.skip() != char:
+            raise ValueError("malformed JSON: expected '{}'".format(char))
+        self.__pos += 1
+
+    def value(self):
+        self.skip()
+        while True:
+            try:
+                value, end = self.__decoder.raw_decode(self.__buf, self.__pos)
+                # a number or literal running up to the end of the buffer may continue in the next block
+                if end < len(self.__buf) or self.__eof:
+                    self.__pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.__eof:
+                    raise
+            # read geometrically more, so that a value spanning many blocks is decoded a logarithmic number of times
+            self.__read(max(self.__block_size, len(self.__buf) - self.__pos))
+
+
+def read_geojson(path: str, block_size: int = 1 << 20) -> Iterator[dict]:
+    """Features of a GeoJSON FeatureCollection, decoded one at a time from blocks of block_size characters"""
+    with open(path, encoding="utf-8") as f:
+        stream = _JsonStream(f, block_size)
+        stream.expect("{")
+        while stream.skip(_JsonStream._WHITESPACE + ",") not in ("}", ""):
+            key = stream.value()
+            stream.expect(":")
+            if key != "features":
+                stream.value()
+                continue
+            stream.expect("[")
+            while stream.skip(_JsonStream._WHITESPACE + ",") != "]":
+                yield stream.value()
+            stream.expect("]")
+
+
+def read_geojsonseq(path: str) -> Iterator[dict]:
+    """Features of a newline delimited GeoJSON file (GeoJSONSeq, with or without record separators)"""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip().lstrip("\x1e")
+            if len(line) > 0:
+                yield json.loads(line)
+
+
+def read_shapefile(path: str, chunk_size: int = 1000) -> Iterator[dict]:
+    """Features of a shapefile (or any other OGR readable file), read chunk_size records at a time"""
+    try:
+        import pyogrio.raw
+    except ImportError:
+        yield from _read_fiona(path)
+        return
+    from shapely import from_wkb
+    count = pyogrio.read_info(path)["features"]
+    for skip in range(0, count, chunk_size):
+        meta, fids, geometries, fields = pyogrio.raw.read(path, skip_features=skip, max_features=chunk_size,
+                                                          return_fids=True)
+        for i, geometry in enumerate(from_wkb(geometries).tolist()):
+            properties = {column: _native(values[i]) for column, values in zip(meta["fields"].tolist(), fields)}
+            yield {"id": int(fids[i]), "geometry": geometry, "properties": properties}
+
+
+def _read_fiona(path: str) -> Iterator[dict]:
+    import fiona
+    with fiona.open(path) as src:
+        for feature in src:
+            yield {"id": int(feature.id), "geometry": feature.geometry, "properties": dict(feature.properties)}
+
+
+def _native(value):
+    return value.item() if hasattr(value, "item") else value
+
+
+def read_features(path: str, **kwargs) -> Iterator[dict]:
+    """Features of a file, read by read_geojson, read_geojsonseq or read_shapefile depending on its extension"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".geojson", ".json"):
+        return read_geojson(path, **kwargs)
+    if extension in GEOJSON_SEQ_EXTENSIONS:
+        return read_geojsonseq(path, **kwargs)
+    return read_shapefile(path, **kwargs)
+
+
+def dataframe_features(geo_df: GeoDataFrame) -> Iterable[dict]:
+    """Rows of a GeoDataFrame as features, with the index as id and every other column as properties"""
+    columns = [column for column in geo_df.columns if column != "geometry"]
+    for fid, geometry, values in zip(geo_df.index, geo_df["geometry"],
+                                     geo_df[columns].itertuples(index=False, name=None)):
+        yield {"id": fid, "geometry": geometry, "properties": dict(zip(columns, values))}
@@ -0,0 +1,394 @@
+from heapq import heappush, heappop
+from itertools import count
+from math import ceil, sqrt
+from time import perf_counter_ns
+from typing import Dict, List, Tuple
+
+import numpy as np
+import shapely
+from shapely.geometry import Point
+
+from cellstore import expand_ranges
+from geodatapoint import GeoDataPoint
+from indexstats import LookupTrace
+from spatialindex import refine_region, nearest_features
+from strtree import STRTree, hilbert_order, tree_stats
+
+
+def _bbox_hits(mbrs: np.ndarray, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+    return (mbrs[:, 0] <= xs) & (mbrs[:, 2] >= xs) & (mbrs[:, 1] <= ys) & (mbrs[:, 3] >= ys)
+
+
+def _bbox_intersects(mbrs: np.ndarray, bbox) -> np.ndarray:
+    return (mbrs[:, 0] <= bbox[2]) & (mbrs[:, 2] >= bbox[0]) & (mbrs[:, 1] <= bbox[3]) & (mbrs[:, 3] >= bbox[1])
+
+
+def _bbox_within(mbrs: np.ndarray, bbox) -> np.ndarray:
+    return (mbrs[:, 0] >= bbox[0]) & (mbrs[:, 1] >= bbox[1]) & (mbrs[:, 2] <= bbox[2]) & (mbrs[:, 3] <= bbox[3])
+
+
+def _bbox_distances(mbrs: np.ndarray, x: float, y: float) -> np.ndarray:
+    dx = np.maximum(np.maximum(mbrs[:, 0] - x, 0.0), x - mbrs[:, 2])
+    dy = np.maximum(np.maximum(mbrs[:, 1] - y, 0.0), y - mbrs[:, 3])
+    return np.hypot(dx, dy)
+
+
+def str_groups(mbrs: np.ndarray, node_capacity: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    One level of STR packing. Entries are sorted by x center into vertical slices of slice_count nodes each, then by
+    y center within every slice, and cut into nodes of node_capacity. Returns the packed order of entries and the
+    start of every node in it
+    """
+    n = len(mbrs)
+    slice_capacity = ceil(sqrt(ceil(n / node_capacity))) * node_capacity
+    by_x = np.argsort(mbrs[:, 0] + mbrs[:, 2], kind="stable")
+    slices = np.empty(n, dtype=np.int64)
+    slices[by_x] = np.arange(n) // slice_capacity
+    order = np.lexsort((mbrs[:, 1] + mbrs[:, 3], slices))
+    # nodes never straddle two slices
+    rank = np.arange(n) - np.searchsorted(slices[order], slices[order])
+    starts = np.flatnonzero(rank % node_capacity == 0)
+    return order, starts
+
+
+class FlatSTRTree(object):
+    '''
+    STR (or hilbert, see STRTree) packed R-tree held in flat arrays.
+
+    Nodes are stored in breadth first order, with their MBRs in one (n, 4) float array and the children of every
+    node in a contiguous range starting at node_child_start: node positions for inner nodes, positions in
+    leaf_pids/leaf_mbr for leaves. This is the layout written by STRTree.to_arrays, so an index file can be searched
+    straight from its mapped sections. Lookups only compare floats until they reach a leaf entry, and the batched
+    search moves all points down the tree one level at a time.
+
+    Updates do not touch the arrays: deleted polygons are masked out and inserted ones are kept in a pending list
+    that is scanned on every search, until the number of updates exceeds repack_ratio of the tree size and the
+    tree is packed again.
+    '''
+
+    def __init__(self, node_capacity: int = 10, repack_ratio: float = 0.25, packing=STRTree.STR_PACKING):
+        self._node_capacity = node_capacity
+        self._repack_ratio = repack_ratio
+        self._packing = packing
+        self._arrays: Dict[str, np.ndarray] = None
+        self._views = None
+        # polygons by pid
+        self._polygons: List[GeoDataPoint] = []
+        self._pending: List[GeoDataPoint] = []
+        self._removed = set()
+        self._total_polygons = 0
+
+    def build(self, polygons: List[GeoDataPoint]):
+        self._polygons = [None] * (max((gdp.pid for gdp in polygons), default=-1) + 1)
+        for gdp in polygons:
+            self._polygons[gdp.pid] = gdp
+        self._pending = []
+        self._removed = set()
+        self._total_polygons = len(polygons)
+
+        leaf_mbr = np.array([gdp.bbox for gdp in polygons], dtype=np.float64).reshape(-1, 4)
+        leaf_pids = np.array([gdp.pid for gdp in polygons], dtype=np.int32)
+        # levels from the leaves up, as (mbr, child_start, child_count)
+        levels = []
+        mbrs = leaf_mbr
+        while True:
+            if len(mbrs) <= self._node_capacity:
+                order, starts = np.arange(len(mbrs)), np.zeros(1, dtype=np.int64)
+            elif self._packing == STRTree.STR_PACKING:
+                order, starts = str_groups(mbrs, self._node_capacity)
+            elif self._packing == STRTree.HILBERT_PACKING:
+                order, starts = hilbert_order(mbrs), np.arange(0, len(mbrs), self._node_capacity)
+            else:
+                raise Exception("Invalid packing")
+            mbrs = mbrs[order]
+            if len(levels) == 0:
+                leaf_mbr, leaf_pids = mbrs, leaf_pids[order]
+            else:
+                # reorder the level below to match, along with the children ranges of its nodes
+                below_mbr, below_start, below_count = levels[-1]
+                levels[-1] = (below_mbr[order], below_start[order], below_count[order])
+            counts = np.diff(np.append(starts, len(mbrs)))
+            if len(mbrs) == 0:
+                node_mbr = np.zeros((1, 4), dtype=np.float64)
+            else:
+                node_mbr = np.stack([np.minimum.reduceat(mbrs[:, 0], starts), np.minimum.reduceat(mbrs[:, 1], starts),
+                                     np.maximum.reduceat(mbrs[:, 2], starts), np.maximum.reduceat(mbrs[:, 3], starts)],
+                                    axis=1)
+            levels.append((node_mbr, starts, counts))
+            if len(node_mbr) == 1:
+                break
+            mbrs = node_mbr
+
+        # breadth first: the root level first; child starts of inner nodes become node positions
+        levels.reverse()
+        offsets = np.cumsum([0] + [len(level[0]) for level in levels])
+        child_start = [start + (offsets[i + 1] if i + 1 < len(levels) else 0)
+                       for i, (_, start, _) in enumerate(levels)]
+        node_leaf = np.zeros(offsets[-1], dtype=bool)
+        node_leaf[offsets[-2]:] = True
+        self.__set_arrays({
+            "node_mbr": np.concatenate([level[0] for level in levels]),
+            "node_child_start": np.concatenate(child_start).astype(np.int64),
+            "node_child_count": np.concatenate([level[2] for level in levels]).astype(np.int32),
+            "node_leaf": node_leaf,
+            "leaf_pids": leaf_pids,
+            "leaf_mbr": leaf_mbr,
+        })
+
+    def __set_arrays(self, arrays: Dict[str, np.ndarray]):
+        self._arrays = arrays
+        self._views = tuple(np.ascontiguousarray(arrays[name]).ravel().data for name in (
+            "node_mbr", "node_child_start", "node_child_count", "node_leaf", "leaf_mbr", "leaf_pids"))
+
+    def insert(self, gdp: GeoDataPoint):
+        if self._arrays is None:
+            raise ValueError("index is not built")
+        if gdp.pid >= len(self._polygons):
+            self._polygons.extend([None] * (gdp.pid + 1 - len(self._polygons)))
+        self._polygons[gdp.pid] = gdp
+        self._pending.append(gdp)
+        self._total_polygons += 1
+
+    def delete(self, gdp: GeoDataPoint) -> bool:
+        """Masks gdp out of the tree. Returns whether it was found"""
+        if self._arrays is None:
+            raise ValueError("index is not built")
+        if gdp.pid >= len(self._polygons) or self._polygons[gdp.pid] is not gdp:
+            return False
+        if any(p is gdp for p in self._pending):
+            self._pending = [p for p in self._pending if p is not gdp]
+        else:
+            self._removed.add(gdp.pid)
+        self._polygons[gdp.pid] = None
+        self._total_polygons -= 1
+        return True
+
+    @property
+    def needs_repack(self) -> bool:
+        return len(self._pending) + len(self._removed) > self._repack_ratio * max(1, self._total_polygons)
+
+    def polygons(self) -> List[GeoDataPoint]:
+        """All polygons in the tree"""
+        return [gdp for gdp in self._polygons if gdp is not None]
+
+    def repack(self):
+        """Packs the tree again from its current polygons"""
+        self.build(self.polygons())
+
+    def __live(self, entries: np.ndarray) -> np.ndarray:
+        if len(self._removed) == 0:
+            return entries
+        return entries[~np.isin(self._arrays["leaf_pids"][entries], np.fromiter(self._removed, dtype=np.int32))]
+
+    def __leaf_entries(self, nodes: List[int]) -> np.ndarray:
+        """Positions in leaf_pids of all entries under nodes"""
+        child_start, child_count = self._arrays["node_child_start"], self._arrays["node_child_count"]
+        node_leaf = self._arrays["node_leaf"]
+        nodes = np.array(nodes, dtype=np.int64)
+        entries = []
+        while len(nodes) > 0:
+            leaf = node_leaf[nodes]
+            entries.append(expand_ranges(child_start[nodes[leaf]], child_count[nodes[leaf]]))
+            nodes = expand_ranges(child_start[nodes[~leaf]], child_count[nodes[~leaf]])
+        return np.concatenate(entries) if len(entries) > 0 else np.empty(0, dtype=np.int64)
+
+    def search(self, point: Point) -> List[GeoDataPoint]:
+        if self._arrays is None:
+            raise ValueError("index is not built")
+        x, y = point.coords[0]
+        # for a single point, indexing memoryviews of the arrays beats numpy calls on a handful of children
+        node_mbr, child_start, child_count, node_leaf, leaf_mbr, leaf_pids = self._views
+        containers = []
+        stack = [0]
+        while len(stack) > 0:
+            node = stack.pop()
+            start, end = child_start[node], child_start[node] + child_count[node]
+            if node_leaf[node]:
+                for j in range(start, end):
+                    if leaf_mbr[4 * j] <= x <= leaf_mbr[4 * j + 2] and leaf_mbr[4 * j + 1] <= y <= leaf_mbr[4 * j + 3]:
+                        gdp = self._polygons[leaf_pids[j]]
+                        if gdp is not None and gdp.contains(point):
+                            containers.append(gdp)
+            else:
+                for j in range(start, end):
+                    if node_mbr[4 * j] <= x <= node_mbr[4 * j + 2] and node_mbr[4 * j + 1] <= y <= node_mbr[4 * j + 3]:
+                        stack.append(j)
+        for gdp in self._pending:
+            if gdp.contains(point):
+                containers.append(gdp)
+        return containers
+
+    def traced_search(self, point: Point, trace: LookupTrace) -> List[GeoDataPoint]:
+        """search, counting nodes entered, candidates and exact tests into trace"""
+        if self._arrays is None:
+            raise ValueError("index is not built")
+        x, y = point.coords[0]
+        node_mbr, child_start, child_count, node_leaf, leaf_mbr, leaf_pids = self._views
+        candidates = []
+        stack = [0]
+        while len(stack) > 0:
+            node = stack.pop()
+            trace.probes += 1
+            start, end = child_start[node], child_start[node] + child_count[node]
+            if node_leaf[node]:
+                for j in range(start, end):
+                    if leaf_mbr[4 * j] <= x <= leaf_mbr[4 * j + 2] and leaf_mbr[4 * j + 1] <= y <= leaf_mbr[4 * j + 3]:
+                        gdp = self._polygons[leaf_pids[j]]
+                        if gdp is not None:
+                            candidates.append(gdp)
+            else:
+                for j in range(start, end):
+                    if node_mbr[4 * j] <= x <= node_mbr[4 * j + 2] and node_mbr[4 * j + 1] <= y <= node_mbr[4 * j + 3]:
+                        stack.append(j)
+        candidates.extend(self._pending)
+        trace.candidates += len(candidates)
+        trace.pip_tests += len(candidates)
+        start = perf_counter_ns()
+        containers = [gdp for gdp in candidates if gdp.contains(point)]
+        trace.geos_ns += perf_counter_ns() - start
+        return containers
+
+    def search_many(self, xs: np.ndarray, ys: np.ndarray) -> List[Tuple[np.ndarray, GeoDataPoint]]:
+        """
+        (point indices, polygon) pairs for every polygon containing some points. Points are pushed down the tree
+        together, every node splitting its points among its children with one bounding box test over all of them
+        """
+        if self._arrays is None:
+            raise ValueError("index is not built")
+        node_mbr, leaf_mbr = self._arrays["node_mbr"], self._arrays["leaf_mbr"]
+        child_start, child_count = self._arrays["node_child_start"], self._arrays["node_child_count"]
+        node_leaf, leaf_pids = self._arrays["node_leaf"], self._arrays["leaf_pids"]
+
+        out = []
+        stack = [(0, np.flatnonzero(_bbox_hits(node_mbr[:1], xs, ys)))]
+        while len(stack) > 0:
+            node, pts = stack.pop()
+            start, end = child_start[node], child_start[node] + child_count[node]
+            mbrs = leaf_mbr[start:end] if node_leaf[node] else node_mbr[start:end]
+            px, py = xs[pts], ys[pts]
+            # (children, points) matrix of bounding box hits
+            hits = (mbrs[:, 0, None] <= px) & (mbrs[:, 2, None] >= px) & (mbrs[:, 1, None] <= py) & \
+                (mbrs[:, 3, None] >= py)
+            for j in np.flatnonzero(hits.any(axis=1)).tolist():
+                child_pts = pts[hits[j]]
+                if not node_leaf[node]:
+                    stack.append((start + j, child_pts))
+                    continue
+                gdp = self._polygons[leaf_pids[start + j]]
+                if gdp is None:
+                    continue
+                inside = gdp.contains_xy(xs[child_pts], ys[child_pts])
+                if inside.any():
+                    out.append((child_pts[inside], gdp))
+        for gdp in self._pending:
+            inside = gdp.contains_many(xs, ys)
+            if inside.any():
+                out.append((np.flatnonzero(inside), gdp))
+        return out
+
+    def search_region(self, geometry, predicate: str) -> List[GeoDataPoint]:
+        """Polygons intersecting or lying within geometry, by an MBR pruned traversal and a batched exact test"""
+        if self._arrays is None:
+            raise ValueError("index is not built")
+        shapely.prepare(geometry)
+        bbox = geometry.bounds
+        node_mbr, leaf_mbr = self._arrays["node_mbr"], self._arrays["leaf_mbr"]
+        child_start, child_count = self._arrays["node_child_start"], self._arrays["node_child_count"]
+        node_leaf = self._arrays["node_leaf"]
+        within = predicate == "within"
+
+        accepted_nodes, candidates = [], []
+        stack = [0] if _bbox_intersects(node_mbr[:1], bbox)[0] else []
+        while len(stack) > 0:
+            node = stack.pop()
+            # subtrees whose MBR lies inside the query need no exact test
+            if _bbox_within(node_mbr[node:node + 1], bbox)[0] and geometry.contains(shapely.box(*node_mbr[node])):
+                accepted_nodes.append(node)
+                continue
+            start, end = child_start[node], child_start[node] + child_count[node]
+            if node_leaf[node]:
+                hit = _bbox_within(leaf_mbr[start:end], bbox) if within else _bbox_intersects(leaf_mbr[start:end], bbox)
+                candidates.append(start + np.flatnonzero(hit))
+            else:
+                stack.extend((start + np.flatnonzero(_bbox_intersects(node_mbr[start:end], bbox))).tolist())
+
+        leaf_pids = self._arrays["leaf_pids"]
+        accepted = [self._polygons[pid] for pid in leaf_pids[self.__live(self.__leaf_entries(accepted_nodes))].tolist()]
+        entries = self.__live(np.concatenate(candidates)) if len(candidates) > 0 else np.empty(0, dtype=np.int64)
+        candidates = [self._polygons[pid] for pid in leaf_pids[entries].tolist()] + self._pending
+        mask = refine_region(geometry, candidates, predicate)
+        return accepted + [gdp for gdp, m in zip(candidates, mask) if m]
+
+    def nearest(self, point: Point, k: int = 1, max_distance: float = None) -> List[Tuple[GeoDataPoint, float]]:
+        """Best-first search over MBR distances, see STRTree.nearest. Pending polygons are measured up front"""
+        if self._arrays is None:
+            raise ValueError("index is not built")
+        x, y = point.coords[0]
+        node_mbr, leaf_mbr = self._arrays["node_mbr"], self._arrays["leaf_mbr"]
+        child_start, child_count = self._arrays["node_child_start"], self._arrays["node_child_count"]
+        node_leaf, leaf_pids = self._arrays["node_leaf"], self._arrays["leaf_pids"]
+
+        tie = count()
+        # heap items are (distance, tie, kind, position); kind 0: node, 1: leaf entry on MBR distance, 2: exact
+        heap = [(float(_bbox_distances(node_mbr[:1], x, y)[0]), next(tie), 0, 0)]
+        for gdp in self._pending:
+            heappush(heap, (gdp.poly.distance(point), next(tie), 2, gdp.pid))
+        polygons, distances, seen = [], [], set()
+        while len(heap) > 0 and len(polygons) < k:
+            distance, _, kind, i = heappop(heap)
+            if max_distance is not None and distance > max_distance:
+                break
+            if kind == 0:
+                start, end = child_start[i], child_start[i] + child_count[i]
+                if node_leaf[i]:
+                    child_kind, mbrs = 1, leaf_mbr[start:end]
+                else:
+                    child_kind, mbrs = 0, node_mbr[start:end]
+                for j, d in enumerate(_bbox_distances(mbrs, x, y).tolist()):
+                    heappush(heap, (d, next(tie), child_kind, start + j))
+            elif kind == 1:
+                gdp = self._polygons[int(leaf_pids[i])]
+                if gdp is not None:
+                    heappush(heap, (gdp.poly.distance(point), next(tie), 2, gdp.pid))
+            elif self._polygons[i].fid not in seen:
+                seen.add(self._polygons[i].fid)
+                polygons.append(self._polygons[i])
+                distances.append(distance)
+        return nearest_features(polygons, np.array(distances, dtype=np.float64), k, max_distance)
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        """The tree arrays, packed again first if there are pending updates"""
+        if self._arrays is None:
+            raise ValueError("index is not built")
+        if len(self._pending) > 0 or len(self._removed) > 0:
+            self.repack()
+        return dict(self._arrays)
+
+    @classmethod
+    def from_arrays(cls, node_capacity: int, arrays: Dict[str, np.ndarray], polygons: List[GeoDataPoint],
+                    repack_ratio: float = 0.25, packing=STRTree.STR_PACKING) -> 'FlatSTRTree':
+        """
+        Tree over arrays written by to_arrays (or STRTree.to_arrays); polygons are indexed by pid. The tree keeps a
+        copy of the list, as build does, so that it never depends on the caller's list being the one it was given
+        """
+        tree = cls(node_capacity, repack_ratio, packing)
+        arrays = dict(arrays)
+        if "leaf_mbr" not in arrays:
+            arrays["leaf_mbr"] = np.array([polygons[pid].bbox for pid in arrays["leaf_pids"].tolist()],
+                                          dtype=np.float64).reshape(-1, 4)
+        tree.__set_arrays(arrays)
+        tree._polygons = list(polygons)
+        tree._total_polygons = len(arrays["leaf_pids"])
+        return tree
+
+    def stats(self) -> dict:
+        """Shape of the packed tree (see tree_stats), and the updates not packed into it yet"""
+        if self._arrays is None:
+            raise ValueError("index is not built")
+        return dict(tree_stats(self._arrays), pending=len(self._pending), removed=len(self._removed))
+
+    @property
+    def nbytes(self) -> int:
+        if self._arrays is None:
+            return 0
+        return sum(arr.nbytes for arr in self._arrays.values())
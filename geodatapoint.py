@@ -1,20 +1,97 @@
+from typing import List
+
+import numpy as np
+import shapely
 from shapely.geometry import Polygon, Point
 
 from basegeometrypoint import BaseGeometryPoint
+from pipkernel import EdgeGrid
 
 
 class GeoDataPoint(BaseGeometryPoint):
-    def __init__(self, meta: dict = None, poly: Polygon = None):
-        if meta is None:
+    """
+    Polygon record of an index: part `part` of feature `fid`, stored at position `pid`. Feature attributes are held
+    once per feature by a MetaStore and read from row `row` on demand; a standalone GeoDataPoint holds its own meta
+    """
+    __slots__ = ("_meta", "_poly", "_prepared", "_grid", "pid", "_fid", "part", "_row", "_store", "_source")
+
+    def __init__(self, meta: dict = None, poly: Polygon = None, pid: int = None, fid=None, part: int = 0,
+                 row: int = None, store=None):
+        if meta is None and store is None:
             meta = dict()
-        self.meta = meta
-        self.poly = poly
+        self._meta = meta
+        self._poly = poly
+        self._prepared = False
+        # EdgeGrid of the polygon once built, False when it does not support one
+        self._grid = None
+        # position of this polygon in the owning index, used by batched lookups
+        self.pid = pid
+        # id of the feature (row of the source data) this polygon is a part of, and the position among its parts
+        self._fid = fid
+        self.part = part
+        # row of the feature in store, a MetaStore
+        self._row = row
+        self._store = store
+        # blob tables of a loaded index file; polygon and feature id are decoded from them on first use
+        self._source = None
+
+    @classmethod
+    def lazy(cls, source, pid: int, row: int, store):
+        """GeoDataPoint backed by a loaded index file, with source.fid(pid) and source.geometry(pid)"""
+        gdp = cls(None, None, pid, None, 0, row, store)
+        gdp._source = source
+        return gdp
+
+    @property
+    def meta(self) -> dict:
+        if self._store is not None:
+            return self._store.row(self._row)
+        return self._meta
+
+    @property
+    def row(self) -> int:
+        return self._row
+
+    @property
+    def fid(self):
+        if self._fid is None and self._source is not None:
+            self._fid = self._source.fid(self.pid)
+        return self._fid
+
+    @property
+    def poly(self) -> Polygon:
+        if self._poly is None and self._source is not None:
+            self._poly = self._source.geometry(self.pid)
+        return self._poly
+
+    @property
+    def decoded(self) -> bool:
+        """Whether the polygon is in memory, i.e. not waiting to be decoded from a loaded index file"""
+        return self._poly is not None
+
+    def relocate(self, pid: int, row: int, store):
+        """Moves the polygon to position pid and its attributes to row of store; a lazy polygon is decoded first"""
+        if self._source is not None:
+            self._poly, self._fid = self.poly, self.fid
+            self._source = None
+        self.pid = pid
+        if self._store is not None:
+            self._row, self._store = row, store
 
     def set_meta(self, meta: dict):
-        self.meta = meta
+        self._meta = meta
+        self._store = None
 
     def set_polygon(self, poly: Polygon):
-        self.poly = poly
+        self._poly = poly
+        self._prepared = False
+        self._grid = None
+
+    def prepare(self):
+        """Prepares the polygon once, so that repeated containment tests run against cached GEOS indices"""
+        if not self._prepared:
+            shapely.prepare(self.poly)
+            self._prepared = True
 
     def set(self, meta, poly):
         self.set_meta(meta)
@@ -32,4 +109,33 @@ class GeoDataPoint(BaseGeometryPoint):
         return self.poly.centroid.coords[0]
 
     def contains(self, point: Point):
+        self.prepare()
         return self.poly.contains(point)
+
+    def contains_many(self, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        min_lon, min_lat, max_lon, max_lat = self.poly.bounds
+        mask = (xs >= min_lon) & (xs <= max_lon) & (ys >= min_lat) & (ys <= max_lat)
+        if mask.any():
+            mask[mask] = self.contains_xy(xs[mask], ys[mask])
+        return mask
+
+    def contains_xy(self, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        """
+        Exact containment of a batch of points. Large polygons get an EdgeGrid on their first large enough batch,
+        and batches it is faster for run on it; everything else runs on the prepared polygon in GEOS
+        """
+        if self._grid is None and len(xs) * shapely.get_num_coordinates(self.poly) >= EdgeGrid.MIN_WORK:
+            self._grid = EdgeGrid.build(self.poly) or False
+        if self._grid and self._grid.use_for(len(xs)):
+            return self._grid.contains_xy(xs, ys)
+        self.prepare()
+        return shapely.contains_xy(self.poly, xs, ys)
+
+
+def polygon_parts(geometry) -> List[Polygon]:
+    """Polygons of a Polygon or MultiPolygon"""
+    if geometry.geom_type == "Polygon":
+        return [geometry]
+    if geometry.geom_type == "MultiPolygon":
+        return list(geometry.geoms)
+    raise ValueError("unsupported geometry type: {}".format(geometry.geom_type))
@@ -0,0 +1,174 @@
+from typing import Tuple
+
+import geohash_hilbert as ghh
+import numpy as np
+
+'''
+Array helpers for the base64 hilbert geohashes produced by geohash_hilbert.
+
+Every character carries 6 bits, i.e. 3 levels of the hilbert curve, so a geohash of length l is an integer
+code of 6 * l bits. Codes of up to 10 characters fit in an int64 and are used as cell ids wherever many
+geohashes are handled at once.
+'''
+
+BITS_PER_CHAR = 6
+MAX_PRECISION = 10
+
+_BASE64 = (
+    '0123456789'  # noqa: E262    #   10    0x30 - 0x39
+    '@'  # +  1    0x40
+    'ABCDEFGHIJKLMNOPQRSTUVWXYZ'  # + 26    0x41 - 0x5A
+    '_'  # +  1    0x5F
+    'abcdefghijklmnopqrstuvwxyz'  # + 26    0x61 - 0x7A
+)  # = 64    0x30 - 0x7A
+_BASE64_BYTES = np.frombuffer(_BASE64.encode('ascii'), dtype=np.uint8)
+_BASE64_MAP = {c: i for i, c in enumerate(_BASE64)}
+
+
+def _check_precision(precision: int):
+    if precision <= 0 or precision > MAX_PRECISION:
+        raise ValueError("Unsupported geohash length: {}. Must be between 1 and {}.".format(precision, MAX_PRECISION))
+
+
+def _dim(precision: int) -> int:
+    return 1 << (precision * BITS_PER_CHAR // 2)
+
+
+def grid_size(precision: int) -> int:
+    """Number of cells along each axis of the grid at given precision"""
+    _check_precision(precision)
+    return _dim(precision)
+
+
+def coords_to_xy(lons, lats, precision: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Map lon/lat arrays to integer cell coordinates of the grid at given precision"""
+    _check_precision(precision)
+    dim = _dim(precision)
+    lons = np.asarray(lons, dtype=np.float64)
+    lats = np.asarray(lats, dtype=np.float64)
+    x = np.floor((lons + 180.0) / 360.0 * dim).astype(np.int64)
+    y = np.floor((lats + 90.0) / 180.0 * dim).astype(np.int64)
+    return np.clip(x, 0, dim - 1), np.clip(y, 0, dim - 1)
+
+
+def to_xy(lon: float, lat: float, precision: int) -> Tuple[int, int]:
+    """Scalar coords_to_xy, cheaper than an encode when only the cell is needed"""
+    dim = _dim(precision)
+    x = int((lon + 180.0) / 360.0 * dim)
+    y = int((lat + 90.0) / 180.0 * dim)
+    return min(max(x, 0), dim - 1), min(max(y, 0), dim - 1)
+
+
+def xy_bounds(x: int, y: int, precision: int) -> Tuple[float, float, float, float]:
+    """(min_lon, min_lat, max_lon, max_lat) of the cell at grid coordinates x, y"""
+    dim = _dim(precision)
+    return x / dim * 360.0 - 180.0, y / dim * 180.0 - 90.0, (x + 1) / dim * 360.0 - 180.0, \
+        (y + 1) / dim * 180.0 - 90.0
+
+
+def xy_to_codes(x: np.ndarray, y: np.ndarray, precision: int) -> np.ndarray:
+    """Vectorized port of geohash_hilbert's xy -> hilbert code conversion"""
+    x = np.array(x, dtype=np.int64)
+    y = np.array(y, dtype=np.int64)
+    codes = np.zeros(x.shape, dtype=np.int64)
+    lvl = _dim(precision) >> 1
+    while lvl > 0:
+        rx = (x & lvl) > 0
+        ry = (y & lvl) > 0
+        codes += lvl * lvl * ((3 * rx.astype(np.int64)) ^ ry.astype(np.int64))
+        flip = rx & ~ry
+        x = np.where(flip, lvl - 1 - x, x)
+        y = np.where(flip, lvl - 1 - y, y)
+        x, y = np.where(ry, x, y), np.where(ry, y, x)
+        lvl >>= 1
+    return codes
+
+
+def codes_to_xy(codes: np.ndarray, precision: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Vectorized port of geohash_hilbert's hilbert code -> xy conversion"""
+    codes = np.array(codes, dtype=np.int64)
+    x = np.zeros(codes.shape, dtype=np.int64)
+    y = np.zeros(codes.shape, dtype=np.int64)
+    dim = _dim(precision)
+    lvl = 1
+    while lvl < dim:
+        rx = 1 & (codes >> 1)
+        ry = 1 & (codes ^ rx)
+        flip = (rx == 1) & (ry == 0)
+        x = np.where(flip, lvl - 1 - x, x)
+        y = np.where(flip, lvl - 1 - y, y)
+        x, y = np.where(ry == 1, x, y), np.where(ry == 1, y, x)
+        x += lvl * rx
+        y += lvl * ry
+        codes = codes >> 2
+        lvl <<= 1
+    return x, y
+
+
+def encode_many(lons, lats, precision: int) -> np.ndarray:
+    """Integer geohash codes of given precision for arrays of longitudes and latitudes"""
+    x, y = coords_to_xy(lons, lats, precision)
+    return xy_to_codes(x, y, precision)
+
+
+def to_strings(codes: np.ndarray, precision: int) -> np.ndarray:
+    """Convert integer codes to geohash strings, as an array of python strings"""
+    codes = np.asarray(codes, dtype=np.int64)
+    shifts = np.arange(precision - 1, -1, -1, dtype=np.int64) * BITS_PER_CHAR
+    digits = (codes[:, None] >> shifts[None, :]) & 0b111111
+    chars = np.ascontiguousarray(_BASE64_BYTES[digits])
+    return chars.view('S{}'.format(precision)).ravel().astype('U{}'.format(precision))
+
+
+def to_code(gh: str) -> int:
+    """Integer code of a single geohash string"""
+    code = 0
+    for ch in gh:
+        code = (code << BITS_PER_CHAR) + _BASE64_MAP[ch]
+    return code
+
+
+def to_string(code: int, precision: int) -> str:
+    """Geohash string of a single integer code"""
+    chars = []
+    for _ in range(precision):
+        chars.append(_BASE64[code & 0b111111])
+        code >>= BITS_PER_CHAR
+    return ''.join(reversed(chars))
+
+
+def bounds(gh: str) -> Tuple[float, float, float, float]:
+    """(min_lon, min_lat, max_lon, max_lat) of a geohash cell"""
+    lng, lat, lng_err, lat_err = ghh.decode_exactly(gh)
+    return lng - lng_err, lat - lat_err, lng + lng_err, lat + lat_err
+
+
+def bounds_many(codes: np.ndarray, precision: int) -> np.ndarray:
+    """(n, 4) array of cell bounds for integer codes of given precision"""
+    x, y = codes_to_xy(codes, precision)
+    dim = _dim(precision)
+    out = np.empty((len(x), 4), dtype=np.float64)
+    out[:, 0] = x / dim * 360.0 - 180.0
+    out[:, 1] = y / dim * 180.0 - 90.0
+    out[:, 2] = (x + 1) / dim * 360.0 - 180.0
+    out[:, 3] = (y + 1) / dim * 180.0 - 90.0
+    return out
+
+
+def xy_extent(codes: np.ndarray, lengths: np.ndarray, precision: int) -> Tuple[int, int, int, int]:
+    """
+    (min_x, min_y, max_x, max_y) on the grid at given precision, of cells given by codes of varying lengths.
+    All lengths must be at most precision
+    """
+    min_x, min_y, max_x, max_y = None, None, None, None
+    for length in np.unique(lengths).tolist():
+        x, y = codes_to_xy(codes[lengths == length], length)
+        scale = _dim(precision) // _dim(length)
+        extent = (int(x.min()) * scale, int(y.min()) * scale, (int(x.max()) + 1) * scale - 1,
+                  (int(y.max()) + 1) * scale - 1)
+        if min_x is None:
+            min_x, min_y, max_x, max_y = extent
+        else:
+            min_x, min_y = min(min_x, extent[0]), min(min_y, extent[1])
+            max_x, max_y = max(max_x, extent[2]), max(max_y, extent[3])
+    return min_x, min_y, max_x, max_y
@@ -1,43 +1,280 @@
+import sys
+from array import array
+from typing import Iterator, List, Tuple
+from weakref import WeakValueDictionary
+
+import numpy as np
 import pygtrie as trie
 
+import geohashes
+
+
+class CellPosting(object):
+    """
+    Values stored under a geohash, split by how the cell relates to them:
+    interior values contain the whole cell, boundary values only intersect it and need an exact test.
+    clips runs parallel to boundary and holds, where available, the part of the value's geometry inside the cell
+    """
+    __slots__ = ("interior", "boundary", "clips")
+
+    def __init__(self):
+        self.interior = []
+        self.boundary = []
+        self.clips = []
+
+    def __len__(self):
+        return len(self.interior) + len(self.boundary)
+
+    def __iter__(self):
+        yield from self.interior
+        yield from self.boundary
+
+
+class CompactPosting(object):
+    """
+    Posting as held by GeoTrie: pids of the interior and boundary values in uint32 arrays, and the clips of the
+    boundary values, or None when none of them has one. Postings without clips are interned by GeoTrie, so that
+    cells holding the same values share one instance; they must not be modified in place
+    """
+    __slots__ = ("interior", "boundary", "clips", "__weakref__")
+
+    def __init__(self, interior: array, boundary: array, clips: tuple = None):
+        self.interior = interior
+        self.boundary = boundary
+        self.clips = clips
+
+    def __len__(self):
+        return len(self.interior) + len(self.boundary)
+
+    @property
+    def nbytes(self) -> int:
+        return sys.getsizeof(self) + sys.getsizeof(self.interior) + sys.getsizeof(self.boundary) + \
+            (0 if self.clips is None else sys.getsizeof(self.clips))
+
 
 class GeoTrie(object):
-    ''' An implementation of GeoTrie '''
+    '''
+    An implementation of GeoTrie.
 
-    def __init__(self, gh_len):
+    Values are referenced by pid. Inserts are collected per key until finalize, which merges them into compact
+    postings (see CompactPosting) and interns those by content, so that neighbouring cells holding the same
+    candidates share one posting
+    '''
+
+    def __init__(self, gh_len, values: List = None):
+        """values is the list that inserted values are stored in, indexed by value.pid"""
         self.gh_len = gh_len
-        # TODO: Add precision filter
-        self.precision = 0
-        self.trie = trie.StringTrie()
-
-    def insert(self, key, value):
-        # if len(key) != self.gh_len:
-        #     raise Exception("Incorrect key length")
-        node_val = self.trie.setdefault(key, [])
-        node_val.append(value)
-        self.trie[key] = node_val
-
-    def search(self, key):
+        self.values = values if values is not None else []
+        # keys shorter than gh_len hold polygons for every geohash below them
+        self.multi_level = False
+        self.trie = trie.CharTrie()
+        # key -> (interior pids, boundary pids, clips) inserted since the last finalize
+        self._pending = dict()
+        # (interior bytes, boundary bytes) -> shared posting, dropped once no cell holds it
+        self._interned = WeakValueDictionary()
+
+    def insert(self, key, value, interior: bool = False, clip=None):
+        if len(key) != self.gh_len:
+            self.multi_level = True
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = ([], [], [])
+        if interior:
+            pending[0].append(value.pid)
+        else:
+            pending[1].append(value.pid)
+            pending[2].append(clip)
+
+    def __intern(self, interior: List[int], boundary: List[int], clips: List) -> CompactPosting:
+        if any(clip is not None for clip in clips):
+            return CompactPosting(array("I", interior), array("I", boundary), tuple(clips))
+        posting = CompactPosting(array("I", interior), array("I", boundary))
+        content = (posting.interior.tobytes(), posting.boundary.tobytes())
+        shared = self._interned.get(content)
+        if shared is None:
+            self._interned[content] = posting
+            return posting
+        return shared
+
+    @classmethod
+    def __lists(cls, posting: CompactPosting) -> Tuple[List[int], List[int], List]:
+        clips = list(posting.clips) if posting.clips is not None else [None] * len(posting.boundary)
+        return posting.interior.tolist(), posting.boundary.tolist(), clips
+
+    def finalize(self):
+        """Merges pending inserts into the postings of their keys"""
+        if len(self._pending) == 0:
+            return
+        for key, (interior, boundary, clips) in self._pending.items():
+            current = self.trie.get(key)
+            if current is not None:
+                old_interior, old_boundary, old_clips = self.__lists(current)
+                interior, boundary, clips = old_interior + interior, old_boundary + boundary, old_clips + clips
+            self.trie[key] = self.__intern(interior, boundary, clips)
+        self._pending = dict()
+
+    def remove(self, key, value):
+        """Removes value from key, dropping the key once nothing is left under it"""
+        pending = self._pending.get(key)
+        if pending is not None:
+            if value.pid in pending[0]:
+                pending[0].remove(value.pid)
+            elif value.pid in pending[1]:
+                i = pending[1].index(value.pid)
+                del pending[1][i]
+                del pending[2][i]
+            if len(pending[0]) == 0 and len(pending[1]) == 0:
+                del self._pending[key]
+        posting = self.trie.get(key)
+        if posting is None:
+            return
+        interior, boundary, clips = self.__lists(posting)
+        if value.pid in interior:
+            interior.remove(value.pid)
+        elif value.pid in boundary:
+            i = boundary.index(value.pid)
+            del boundary[i]
+            del clips[i]
+        else:
+            return
+        if len(interior) == 0 and len(boundary) == 0:
+            del self.trie[key]
+        else:
+            self.trie[key] = self.__intern(interior, boundary, clips)
+
+    def __expand(self, posting: CompactPosting, found: CellPosting):
+        """Appends the values of a compact posting to found"""
+        values = self.values
+        found.interior.extend([values[i] for i in posting.interior])
+        found.boundary.extend([values[i] for i in posting.boundary])
+        if posting.clips is None:
+            found.clips.extend([None] * len(posting.boundary))
+        else:
+            found.clips.extend(posting.clips)
+
+    def search(self, key) -> CellPosting:
         if len(key) != self.gh_len:
             raise Exception("Incorrect key length")
-        if self.trie.has_node(key):
-            return self.trie[key]
-        return []
+        if self.multi_level:
+            return self.search_prefixes(key)
+        self.finalize()
+        found = CellPosting()
+        posting = self.trie.get(key)
+        if posting is not None:
+            self.__expand(posting, found)
+        return found
 
-    def clear(self):
-        self.trie.clear()
+    def search_prefixes(self, key) -> CellPosting:
+        """Merges the postings of key and of every stored prefix of key"""
+        self.finalize()
+        found = CellPosting()
+        for step in self.trie.prefixes(key):
+            self.__expand(step.value, found)
+        return found
 
-    @staticmethod
-    def __traverse_cb(path_conv, path, children, value=None):
-        if value:
-            return {path_conv(path): value}
-        if children is None:
-            return {}
-        out = {}
-        for c in children:
-            out.update(c)
+    def items(self, prefix: str = None):
+        """(geohash, posting) pairs, optionally restricted to keys at or below prefix"""
+        self.finalize()
+        if prefix is None:
+            pairs = self.trie.iteritems()
+        else:
+            try:
+                pairs = list(self.trie.iteritems(prefix=prefix))
+            except KeyError:
+                return []
+        out = []
+        for key, posting in pairs:
+            found = CellPosting()
+            self.__expand(posting, found)
+            out.append((key, found))
         return out
 
+    def iter_items(self) -> Iterator[Tuple[str, CellPosting]]:
+        """(geohash, posting) pairs, one at a time"""
+        self.finalize()
+        for key, posting in self.trie.iteritems():
+            found = CellPosting()
+            self.__expand(posting, found)
+            yield key, found
+
+    def posting_arrays(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Posting list length of every key, and the value pids and interior flags of all postings in key order"""
+        self.finalize()
+        lengths, pids, interior = [], array("I"), []
+        for posting in self.trie.itervalues():
+            lengths.append(len(posting))
+            pids.extend(posting.interior)
+            pids.extend(posting.boundary)
+            interior.extend([True] * len(posting.interior))
+            interior.extend([False] * len(posting.boundary))
+        return np.array(lengths, dtype=np.int64), np.frombuffer(pids, dtype=np.uint32).astype(np.int32), \
+            np.array(interior, dtype=bool)
+
+    @property
+    def search_probes(self) -> int:
+        """Trie nodes visited by a search"""
+        return self.gh_len if self.multi_level else 1
+
+    def posting_stats(self) -> dict:
+        """Postings held by keys and distinct posting instances, with their bytes with and without interning"""
+        self.finalize()
+        distinct = dict()
+        keys, unshared = 0, 0
+        for posting in self.trie.itervalues():
+            keys += 1
+            nbytes = posting.nbytes
+            unshared += nbytes
+            distinct[id(posting)] = nbytes
+        return {"postings": keys, "distinct_postings": len(distinct), "posting_bytes": sum(distinct.values()),
+                "unshared_posting_bytes": unshared}
+
+    @property
+    def nbytes(self) -> int:
+        """Estimated bytes of keys and of distinct postings; trie nodes are not counted"""
+        self.finalize()
+        return sum(sys.getsizeof(key) for key in self.trie.iterkeys()) + self.posting_stats()["posting_bytes"]
+
+    def key_codes(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Integer codes and lengths of every stored key"""
+        self.finalize()
+        keys = list(self.trie.iterkeys())
+        return np.array([geohashes.to_code(k) for k in keys], dtype=np.int64), \
+            np.array([len(k) for k in keys], dtype=np.int64)
+
+    def scan_prefixes(self, prefixes: List[str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Entries related to a list of disjoint cells: those stored at or below a cell, and those stored at a prefix of
+        it. Returns parallel arrays of (position in prefixes, value pid, interior flag, length of the stored key)
+        """
+        self.finalize()
+        rows = []
+
+        def add(i, key, posting):
+            rows.extend((i, pid, True, len(key)) for pid in posting.interior)
+            rows.extend((i, pid, False, len(key)) for pid in posting.boundary)
+
+        for i, prefix in enumerate(prefixes):
+            try:
+                for key, posting in self.trie.iteritems(prefix=prefix):
+                    add(i, key, posting)
+            except KeyError:
+                pass
+            if self.multi_level and len(prefix) > 1:
+                for step in self.trie.prefixes(prefix[:-1]):
+                    add(i, step.key, step.value)
+        if len(rows) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32), np.empty(0, dtype=bool), \
+                np.empty(0, dtype=np.int64)
+        cells, pids, interior, lengths = zip(*rows)
+        return np.array(cells, dtype=np.int64), np.array(pids, dtype=np.int32), np.array(interior, dtype=bool), \
+            np.array(lengths, dtype=np.int64)
+
+    def clear(self):
+        self.trie.clear()
+        self.multi_level = False
+        self._pending = dict()
+        self._interned = WeakValueDictionary()
+
     def walk(self, fn):
         """fn takes a dictionary of keys in trie and their values"""
-        fn(self.trie.traverse(GeoTrie.__traverse_cb))
+        fn(dict(self.iter_items()))
@@ -1,16 +1,32 @@
 from datetime import datetime
 from geopandas import GeoDataFrame
+from pandas import DataFrame
 from shapely.geometry import Polygon, Point
 from shapely.geometry import shape
+import shapely
 
-from spatialindex import SpatialIndex
-from geodatapoint import GeoDataPoint
-from geotrie import GeoTrie
-from typing import List, Iterable, Union
+from spatialindex import SpatialIndex, collect_pairs, parse_feature, feature_map, needs_compaction, compaction, \
+    next_feature_id, refine_region, nearest_features, feature_polygons, polygon_feature_ids, polygon_metadata, \
+    REGION_PREDICATES
+from featurereader import dataframe_features
+from metastore import MetaStore
+from geodatapoint import GeoDataPoint, polygon_parts
+from geotrie import GeoTrie, CellPosting
+from cellstore import HilbertCellStore, expand_ranges
+from cellcache import CellCache
+from indexstats import LookupCounters, LookupTrace, length_histogram, polygon_stats, value_summary
+from typing import List, Iterable, Iterator, Union, Tuple
 from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from math import ceil
+from time import perf_counter_ns
 import geohash_hilbert as ghh
 import numpy as np
 
+import geohashes
+import indexfile
+
 
 class FifoQueue(object):
     def __init__(self):
@@ -43,10 +59,35 @@ class GeoTrieIndex(SpatialIndex):
     SUBSAMPLE_GRID: Divides bounding box of given polygon into a grid and maps select points in the grid as geohashes
     NEIGHBOUR_BFS: Performs BFS search on centroid of given polygon till it keeps finding neighbours that intersect
     TOP_DOWN: Performs a top-down search of overlapping grids, starting from largest geohash(es) that contain polygon 
+    ADAPTIVE_COVER: Multi-resolution cover in the spirit of a region coverer. Cells fully inside the polygon are kept
+                    as short prefixes (no shorter than min_gh_len), only boundary cells are refined down to gh_len,
+                    and refinement stops early once the cover would exceed max_cells.
+    VECTOR_GRID: Vectorized top-down search. Cell bounds come from arithmetic on integer hilbert codes, all children
+                 of a level are filtered by bounding box overlap and then tested against the polygon in one shapely
+                 call. Cells found to be interior are expanded without further tests.
     '''
     SUBSAMPLE_GRID = 1
     NEIGHBOUR_BFS = 2
     TOP_DOWN = 3
+    ADAPTIVE_COVER = 4
+    VECTOR_GRID = 5
+
+    '''
+    Two cell stores are provided:
+    TRIE_STORE: pygtrie backed GeoTrie
+    ARRAY_STORE: HilbertCellStore, sorted uint64 hilbert keys with CSR offsets into a flat polygon id array
+    '''
+    TRIE_STORE = 1
+    ARRAY_STORE = 2
+
+    # rings scanned by nearest at one level before moving a level up
+    _NEAREST_RINGS = 4
+
+    # auto_tune: bytes per key (uint64 key, int64 offset) and per entry (int32 id, bool flag) of the array store,
+    # and the mean cover cells per sampled polygon beyond which longer geohashes are not considered
+    _KEY_BYTES = 16
+    _ENTRY_BYTES = 5
+    _TUNE_MAX_COVER = 1 << 14
 
     _BASE64 = (
         '0123456789'  # noqa: E262    #   10    0x30 - 0x39
@@ -56,10 +97,30 @@ class GeoTrieIndex(SpatialIndex):
         'abcdefghijklmnopqrstuvwxyz'  # + 26    0x61 - 0x7A
     )  # = 64    0x30 - 0x7A
 
-    def __init__(self, gh_len: int, scan_algorithm=SUBSAMPLE_GRID):
+    def __init__(self, gh_len: int, scan_algorithm=SUBSAMPLE_GRID, min_gh_len: int = 1, max_cells: int = None,
+                 clip_boundary: bool = False, store_type=TRIE_STORE):
         self.gh_len = gh_len
         self.gt = None
+        self.polygons: List[GeoDataPoint] = []
+        # feature id -> pids of its polygons. None until needed on a loaded index
+        self.features: Union[dict, None] = dict()
+        # attributes of every feature, referenced by row from self.polygons
+        self.metas = MetaStore()
+        self._next_fid = None
+        # grid bounding box of all stored cells at gh_len, bounds the ring expansion of nearest
+        self._extent = None
         self.scan_algorithm = scan_algorithm
+        # only used by ADAPTIVE_COVER
+        self.min_gh_len = min(min_gh_len, gh_len)
+        self.max_cells = max_cells
+        # store, for every boundary cell, the part of polygon inside the cell and test points against that instead
+        self.clip_boundary = clip_boundary
+        self.store_type = store_type
+        # optional cache of cell postings for lookup, see enable_cache
+        self.cache: Union[CellCache, None] = None
+        # postings of sub-cells of boundary cells, in a cache of their own, see enable_cache
+        self.sub_cache: Union[CellCache, None] = None
+        self.cache_sub_len = 0
 
     def __gh_encode(self, lon, lat):
         return ghh.encode(lon, lat, precision=self.gh_len)
@@ -168,6 +229,118 @@ class GeoTrieIndex(SpatialIndex):
             overlaps.extend(self.__search_gh_box(poly, tgh))
         return overlaps
 
+    def __adaptive_cover(self, poly: Polygon) -> Tuple[List[str], List[bool]]:
+        smallest_gh = self.__smallest_container(poly)
+        if smallest_gh is None:
+            frontier = self.__neighbour_bfs(poly, 1)
+        else:
+            frontier = [smallest_gh]
+        shapely.prepare(poly)
+
+        geos, interiors = [], []
+        # refine level by level, so that a max_cells budget leaves a cover of even resolution
+        while len(frontier) > 0:
+            level = len(frontier[0])
+            codes = np.array([geohashes.to_code(gh) for gh in frontier], dtype=np.int64)
+            cells = shapely.box(*geohashes.bounds_many(codes, level).T)
+            interior = shapely.contains_properly(poly, cells)
+            next_frontier = []
+            for i, gh in enumerate(frontier):
+                if interior[i] and level >= self.min_gh_len:
+                    geos.append(gh)
+                    interiors.append(True)
+                    continue
+                if level == self.gh_len:
+                    geos.append(gh)
+                    interiors.append(bool(interior[i]))
+                    continue
+                children = codes[i] * 64 + np.arange(64, dtype=np.int64)
+                if interior[i]:
+                    hits = children
+                else:
+                    boxes = shapely.box(*geohashes.bounds_many(children, level + 1).T)
+                    hits = children[shapely.intersects(poly, boxes)]
+                remaining = len(frontier) - i - 1
+                over_budget = self.max_cells is not None and \
+                    len(geos) + len(next_frontier) + remaining + len(hits) > self.max_cells
+                if over_budget and level >= self.min_gh_len:
+                    # boundary cell left coarse: lookups run an exact test for it
+                    geos.append(gh)
+                    interiors.append(False)
+                    continue
+                next_frontier.extend(geohashes.to_strings(hits, level + 1).tolist())
+            frontier = next_frontier
+        return geos, interiors
+
+    def __vector_start(self, poly_bbox) -> Tuple[np.ndarray, int]:
+        """Codes of the cells covering polygon's bounding box, at the finest level where they are at most 64"""
+        level = 1
+        for precision in range(1, self.gh_len + 1):
+            x0, y0 = geohashes.coords_to_xy(poly_bbox[0], poly_bbox[1], precision)
+            x1, y1 = geohashes.coords_to_xy(poly_bbox[2], poly_bbox[3], precision)
+            if (x1 - x0 + 1) * (y1 - y0 + 1) > 64:
+                break
+            level = precision
+        x0, y0 = geohashes.coords_to_xy(poly_bbox[0], poly_bbox[1], level)
+        x1, y1 = geohashes.coords_to_xy(poly_bbox[2], poly_bbox[3], level)
+        xs, ys = np.meshgrid(np.arange(x0, x1 + 1), np.arange(y0, y1 + 1))
+        return geohashes.xy_to_codes(xs.ravel(), ys.ravel(), level), level
+
+    def __vector_grid(self, poly: Polygon) -> Tuple[List[str], np.ndarray]:
+        shapely.prepare(poly)
+        poly_bbox = poly.bounds
+        boundary, level = self.__vector_start(poly_bbox)
+        interior = np.empty(0, dtype=np.int64)
+        children = np.arange(64, dtype=np.int64)
+        while True:
+            cells = shapely.box(*geohashes.bounds_many(boundary, level).T)
+            hits = shapely.intersects(poly, cells)
+            inside = shapely.contains_properly(poly, cells[hits])
+            interior = np.concatenate([interior, boundary[hits][inside]])
+            boundary = boundary[hits][~inside]
+            if level == self.gh_len:
+                break
+            interior = (interior[:, None] * 64 + children).ravel()
+            boundary = (boundary[:, None] * 64 + children).ravel()
+            level += 1
+            # cheap pre-filter: drop children outside the polygon's bounding box before any exact test
+            b = geohashes.bounds_many(boundary, level)
+            boundary = boundary[(b[:, 0] <= poly_bbox[2]) & (b[:, 2] >= poly_bbox[0]) &
+                                (b[:, 1] <= poly_bbox[3]) & (b[:, 3] >= poly_bbox[1])]
+        codes = np.concatenate([interior, boundary])
+        interiors = np.arange(len(codes)) < len(interior)
+        return geohashes.to_strings(codes, self.gh_len).tolist(), interiors
+
+    def __region_cover(self, geometry, max_cells: int) -> Tuple[List[str], np.ndarray]:
+        """
+        Multi-resolution cover of a query geometry. Cells inside the geometry stay as coarse as they were found,
+        boundary cells are refined towards gh_len while there are at most max_cells of them
+        """
+        shapely.prepare(geometry)
+        bbox = geometry.bounds
+        boundary, level = self.__vector_start(bbox)
+        geos, interiors = [], []
+        children = np.arange(64, dtype=np.int64)
+        while True:
+            cells = shapely.box(*geohashes.bounds_many(boundary, level).T)
+            hits = shapely.intersects(geometry, cells)
+            inside = shapely.contains_properly(geometry, cells[hits])
+            interior, boundary = boundary[hits][inside], boundary[hits][~inside]
+            geos.extend(geohashes.to_strings(interior, level).tolist())
+            interiors.extend([True] * len(interior))
+            if level < self.gh_len:
+                refined = (boundary[:, None] * 64 + children).ravel()
+                b = geohashes.bounds_many(refined, level + 1)
+                refined = refined[(b[:, 0] <= bbox[2]) & (b[:, 2] >= bbox[0]) &
+                                  (b[:, 1] <= bbox[3]) & (b[:, 3] >= bbox[1])]
+            if level == self.gh_len or len(refined) > max_cells:
+                geos.extend(geohashes.to_strings(boundary, level).tolist())
+                interiors.extend([False] * len(boundary))
+                break
+            boundary = refined
+            level += 1
+        return geos, np.array(interiors, dtype=bool)
+
     def __gh_intersecting(self, poly: Polygon) -> List[str]:
         if self.scan_algorithm == self.SUBSAMPLE_GRID:
             return self.__subsample_grid(poly)
@@ -175,46 +348,788 @@ class GeoTrieIndex(SpatialIndex):
             return self.__neighbour_bfs(poly, self.gh_len)
         elif self.scan_algorithm == self.TOP_DOWN:
             return self.__top_down_search(poly)
+        elif self.scan_algorithm == self.ADAPTIVE_COVER:
+            return self.__adaptive_cover(poly)[0]
+        elif self.scan_algorithm == self.VECTOR_GRID:
+            return self.__vector_grid(poly)[0]
         else:
             raise Exception("Invalid scan algorithm")
 
-    def build(self, geo_df: GeoDataFrame):
-        self.gt = GeoTrie(self.gh_len)
-        df_columns = list(geo_df.columns)
-        for i, row in geo_df.iterrows():
-            polygons: List[Polygon] = row["geometry"].geoms
-            # TODO: Check for non-polygon entries
-            for poly in polygons:
-                meta = {column: row[column] for column in list(filter(lambda x: x != "geometry", df_columns))}
-                gdp = GeoDataPoint(meta, poly)
-                geos = self.__gh_intersecting(poly)
-                for gh in geos:
-                    self.gt.insert(gh, gdp)
+    @classmethod
+    def __gh_interior(cls, geos: List[str], poly: Polygon) -> np.ndarray:
+        """Flags cells that lie in the interior of polygon, so that points in them need no containment test"""
+        if len(geos) == 0:
+            return np.zeros(0, dtype=bool)
+        cell_bounds = np.array([geohashes.bounds(gh) for gh in geos])
+        shapely.prepare(poly)
+        return shapely.contains_properly(poly, shapely.box(*cell_bounds.T))
 
-    def lookup(self, point: Point):
+    @classmethod
+    def __gh_clips(cls, geos: List[str], interiors: List[bool], poly: Polygon) -> List[Union[Polygon, None]]:
+        """
+        Prepared pieces of polygon inside each boundary cell. Cells are padded by a tiny margin, so that points on a
+        cell's own edges never fall on the edges of its clipped piece.
+        """
+        clips: List[Union[Polygon, None]] = [None] * len(geos)
+        boundary = [i for i, interior in enumerate(interiors) if not interior]
+        if len(boundary) == 0:
+            return clips
+        cell_bounds = np.array([geohashes.bounds(geos[i]) for i in boundary])
+        pad = (cell_bounds[:, 2] - cell_bounds[:, 0]) * 1e-6
+        cells = shapely.box(cell_bounds[:, 0] - pad, cell_bounds[:, 1] - pad,
+                            cell_bounds[:, 2] + pad, cell_bounds[:, 3] + pad)
+        pieces = shapely.intersection(poly, cells)
+        shapely.prepare(pieces)
+        for i, piece in zip(boundary, pieces):
+            clips[i] = piece
+        return clips
+
+    def __gh_cover(self, poly: Polygon) -> Tuple[List[str], List[bool]]:
+        """Geohashes intersecting polygon, along with their interior flags"""
+        if self.scan_algorithm == self.ADAPTIVE_COVER:
+            return self.__adaptive_cover(poly)
+        if self.scan_algorithm == self.VECTOR_GRID:
+            return self.__vector_grid(poly)
+        geos = self.__gh_intersecting(poly)
+        return geos, self.__gh_interior(geos, poly)
+
+    def __new_store(self) -> Union[GeoTrie, HilbertCellStore]:
+        if self.store_type == self.TRIE_STORE:
+            return GeoTrie(self.gh_len, self.polygons)
+        elif self.store_type == self.ARRAY_STORE:
+            return HilbertCellStore(self.gh_len, self.polygons)
+        else:
+            raise Exception("Invalid store type")
+
+    def cover(self, poly: Polygon) -> Tuple[List[str], List[bool], List[Union[Polygon, None]]]:
+        """Geohashes to index polygon under, with their interior flags and, if clip_boundary is set, clipped pieces"""
+        geos, interiors = self.__gh_cover(poly)
+        if self.clip_boundary:
+            clips = self.__gh_clips(geos, interiors, poly)
+        else:
+            clips = [None] * len(geos)
+        return geos, interiors, clips
+
+    def __params(self) -> dict:
+        return {"gh_len": self.gh_len, "scan_algorithm": self.scan_algorithm, "min_gh_len": self.min_gh_len,
+                "max_cells": self.max_cells, "clip_boundary": self.clip_boundary}
+
+    def __covers(self, polygons: Iterable[GeoDataPoint], workers: int,
+                 chunk_size: int) -> Iterator[Tuple[GeoDataPoint, Tuple[List[str], List[bool], List]]]:
+        """
+        (polygon, cover) pairs for a stream of polygons, in order. With workers > 1, covers are computed over a
+        process pool, chunk_size polygons per task and at most two tasks per worker in flight
+        """
+        if workers <= 1:
+            for gdp in polygons:
+                yield gdp, self.cover(gdp.poly)
+            return
+
+        polygons = iter(polygons)
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            while True:
+                while len(pending) < 2 * workers:
+                    chunk = list(islice(polygons, chunk_size))
+                    if len(chunk) == 0:
+                        break
+                    # polygons travel as WKB
+                    wkbs = shapely.to_wkb([gdp.poly for gdp in chunk]).tolist()
+                    pending.append((chunk, executor.submit(_cover_chunk, self.__params(), wkbs)))
+                if len(pending) == 0:
+                    return
+                chunk, future = pending.popleft()
+                for gdp, (geos, interiors, clips) in zip(chunk, future.result()):
+                    if clips is None:
+                        clips = [None] * len(geos)
+                    else:
+                        clips = [None if c is None else shapely.from_wkb(c) for c in clips]
+                        shapely.prepare(clips)
+                    yield gdp, (geos, interiors, clips)
+
+    def build(self, geo_df: GeoDataFrame, workers: int = 1):
+        """Builds the index. With workers > 1, polygon covers are computed over a pool of that many processes"""
+        # a few chunks per worker to even out uneven polygon sizes
+        self.build_from_stream(dataframe_features(geo_df), workers, max(1, ceil(len(geo_df) / (workers * 8))))
+
+    def build_from_stream(self, features: Iterable, workers: int = 1, chunk_size: int = 256):
+        """
+        Builds the index from GeoJSON like features (see feature_polygons), parsed, covered and inserted one at a
+        time so that only the index itself is held in memory. With workers > 1, polygon covers are computed over a
+        pool of that many processes, chunk_size polygons per task
+        """
+        self.polygons = []
+        self.features = dict()
+        self.metas = MetaStore()
+        self._next_fid = None
+        self._extent = None
+        self.__invalidate_cache()
+        self.gt = self.__new_store()
+        polygons = feature_polygons(features, self.polygons, self.features, self.metas)
+        for gdp, (geos, interiors, clips) in self.__covers(polygons, workers, chunk_size):
+            for gh, interior, clip in zip(geos, interiors, clips):
+                self.gt.insert(gh, gdp, bool(interior), clip)
+        self.gt.finalize()
+        self.metas.finalize()
+
+    def metadata(self, pids, columns: List[str] = None) -> DataFrame:
+        """Attributes of the features of polygons pids (e.g. from lookup_many), one row per pid"""
+        return polygon_metadata(self.polygons, self.metas, pids, columns)
+
+    def feature_ids(self, pids) -> np.ndarray:
+        return polygon_feature_ids(self.polygons, pids)
+
+    def __feature_map(self) -> dict:
+        if self.features is None:
+            self.features = feature_map(self.polygons)
+        return self.features
+
+    def __add_feature(self, fid, geometry, meta: dict):
+        self._extent = None
+        self.__invalidate_cache()
+        pids = []
+        row = self.metas.append(meta)
+        for part, poly in enumerate(polygon_parts(geometry)):
+            gdp = GeoDataPoint(None, poly, len(self.polygons), fid, part, row, self.metas)
+            self.polygons.append(gdp)
+            pids.append(gdp.pid)
+            geos, interiors, clips = self.cover(poly)
+            for gh, interior, clip in zip(geos, interiors, clips):
+                self.gt.insert(gh, gdp, bool(interior), clip)
+        self.features[fid] = pids
+
+    def __remove_feature(self, fid):
+        self._extent = None
+        self.__invalidate_cache()
+        for pid in self.features.pop(fid):
+            gdp = self.polygons[pid]
+            if self.store_type == self.TRIE_STORE:
+                for gh in self.__gh_cover(gdp.poly)[0]:
+                    self.gt.remove(gh, gdp)
+            else:
+                # the array store drops entries by polygon id, there is no need to recompute the cover
+                self.gt.remove(None, gdp)
+            self.polygons[pid] = None
+
+    def insert(self, feature):
+        """Indexes a GeoJSON like feature (see parse_feature). Returns its id, a new integer one if it has none"""
         if self.gt is None:
             raise ValueError("index is not built")
-        gh = self.__gh_encode(*(point.coords[0]))
-        candidates = self.gt.search(gh)
-        containers = []
-        for c in candidates:
-            if c.poly.contains(point):
+        fid, geometry, meta = parse_feature(feature)
+        features = self.__feature_map()
+        if self._next_fid is None:
+            self._next_fid = next_feature_id(features)
+        if fid is None:
+            fid = self._next_fid
+        if fid in features:
+            raise KeyError("feature {} is already indexed".format(fid))
+        if isinstance(fid, (int, np.integer)):
+            self._next_fid = max(self._next_fid, fid + 1)
+        self.__add_feature(fid, geometry, meta)
+        self.gt.finalize()
+        return fid
+
+    def delete(self, feature_id):
+        """Removes all polygons of a feature from every cell of their covers"""
+        if self.gt is None:
+            raise ValueError("index is not built")
+        if feature_id not in self.__feature_map():
+            raise KeyError("feature {} is not indexed".format(feature_id))
+        self.__remove_feature(feature_id)
+        self.gt.finalize()
+
+    def update(self, feature_id, geometry=None, meta: dict = None):
+        """Replaces geometry and/or meta of a feature; whichever is None is kept"""
+        if self.gt is None:
+            raise ValueError("index is not built")
+        features = self.__feature_map()
+        if feature_id not in features:
+            raise KeyError("feature {} is not indexed".format(feature_id))
+        parts = [self.polygons[pid] for pid in features[feature_id]]
+        if geometry is None:
+            geometry = parts[0].poly if len(parts) == 1 else shapely.multipolygons([gdp.poly for gdp in parts])
+        if meta is None:
+            meta = parts[0].meta
+        self.__remove_feature(feature_id)
+        self.__add_feature(feature_id, geometry, meta)
+        self.gt.finalize()
+
+    def compact(self):
+        """
+        Drops deleted polygons, and the attribute rows of deleted and updated features: live polygons are numbered
+        again densely, in order, over cells remapped to the new pids. pids returned before are invalid afterwards
+        """
+        if self.gt is None:
+            raise ValueError("index is not built")
+        self.gt.finalize()
+        if not needs_compaction(self.polygons, self.metas):
+            return
+        pids, rows, metas = compaction(self.polygons, self.metas)
+        live = [gdp for gdp in self.polygons if gdp is not None]
+        for pid, (gdp, row) in enumerate(zip(live, rows.tolist())):
+            gdp.relocate(pid, row, metas)
+        old = self.gt
+        self.polygons, self.metas, self.features = live, metas, None
+        if isinstance(old, HilbertCellStore):
+            self.gt = HilbertCellStore.from_arrays(self.gh_len, self.polygons, old.keys, old.offsets, pids[old.ids],
+                                                   old.interior, old.clips)
+        else:
+            # the old trie reads its values from the old polygon list, whose GeoDataPoints now carry the new pids
+            self.gt = GeoTrie(self.gh_len, self.polygons)
+            for gh, posting in old.iter_items():
+                for gdp in posting.interior:
+                    self.gt.insert(gh, gdp, True)
+                for gdp, clip in zip(posting.boundary, posting.clips):
+                    self.gt.insert(gh, gdp, False, clip)
+            self.gt.finalize()
+        self.__invalidate_cache()
+
+    def enable_cache(self, capacity: int, policy=CellCache.LRU, sub_len: int = 1, sub_capacity: int = None):
+        """
+        Caches the postings of up to capacity cells for lookup, keyed by grid cell, evicting by policy (see CellCache).
+        Cells with boundary candidates are additionally split into sub-cells sub_len characters longer, which keep
+        only the candidates still undecided within them; up to sub_capacity of them (capacity by default) are cached
+        apart, so that they never evict cells. A posting without boundary candidates is the full answer for every
+        point in its cell. The cache is dropped on every change to the index
+        """
+        self.cache = CellCache(capacity, policy)
+        self.cache_sub_len = max(0, min(sub_len, geohashes.MAX_PRECISION - self.gh_len))
+        self.sub_cache = CellCache(capacity if sub_capacity is None else sub_capacity, policy) \
+            if self.cache_sub_len > 0 else None
+
+    def disable_cache(self):
+        self.cache = None
+        self.sub_cache = None
+        self.cache_sub_len = 0
+
+    def cache_stats(self) -> Union[dict, None]:
+        """
+        Hit, miss and eviction counters of the lookup cache, None if it is not enabled. Every cached lookup probes
+        the cell cache once, so that hits and misses count lookups; lookups in boundary cells then probe the sub-cell
+        cache, counted under sub_cells
+        """
+        if self.cache is None:
+            return None
+        return dict(self.cache.stats(), sub_cells=None if self.sub_cache is None else self.sub_cache.stats())
+
+    def __invalidate_cache(self):
+        if self.cache is not None:
+            self.cache.invalidate()
+        if self.sub_cache is not None:
+            self.sub_cache.invalidate()
+
+    def __cached_search(self, lon: float, lat: float, trace: LookupTrace = None) -> CellPosting:
+        # entries are keyed by cell grid coordinates, so that hits need no geohash encoding
+        precision = self.gh_len + self.cache_sub_len
+        x, y = geohashes.to_xy(lon, lat, precision)
+        shift = self.cache_sub_len * geohashes.BITS_PER_CHAR // 2
+        key = (self.gh_len, x >> shift, y >> shift)
+        posting = self.cache.get(key)
+        if posting is None:
+            posting = self.gt.search(self.__gh_encode(lon, lat))
+            self.cache.put(key, posting)
+            if trace is not None:
+                trace.probes += self.gt.search_probes
+        if len(posting.boundary) == 0 or self.cache_sub_len == 0:
+            return posting
+        sub_posting = self.sub_cache.get((x, y))
+        if sub_posting is None:
+            sub_posting = self.__split_posting(posting, shapely.box(*geohashes.xy_bounds(x, y, precision)))
+            self.sub_cache.put((x, y), sub_posting)
+        return sub_posting
+
+    @classmethod
+    def __split_posting(cls, posting: CellPosting, cell: Polygon) -> CellPosting:
+        """Posting of a sub-cell: boundary candidates containing it become interior, those missing it are dropped"""
+        geoms = [c.poly if clip is None else clip for c, clip in zip(posting.boundary, posting.clips)]
+        inside = shapely.contains_properly(geoms, cell)
+        hits = shapely.intersects(geoms, cell)
+        found = CellPosting()
+        found.interior = list(posting.interior)
+        for c, clip, c_inside, c_hits in zip(posting.boundary, posting.clips, inside.tolist(), hits.tolist()):
+            if c_inside:
+                found.interior.append(c)
+            elif c_hits:
+                found.boundary.append(c)
+                found.clips.append(clip)
+        return found
+
+    @classmethod
+    def __containers(cls, candidates: CellPosting, point: Point) -> List[GeoDataPoint]:
+        containers = list(candidates.interior)
+        for c, clip in zip(candidates.boundary, candidates.clips):
+            if clip is None:
+                inside = c.contains(point)
+            else:
+                inside = clip.contains(point)
+            if inside:
                 containers.append(c)
         return containers
 
+    def lookup(self, point: Point):
+        if self.gt is None:
+            raise ValueError("index is not built")
+        if self.cache is None:
+            candidates = self.gt.search(self.__gh_encode(*(point.coords[0])))
+        else:
+            candidates = self.__cached_search(*(point.coords[0]))
+        return self.__containers(candidates, point)
+
+    def _traced_lookup(self, point: Point, trace: LookupTrace):
+        if self.gt is None:
+            raise ValueError("index is not built")
+        if self.cache is None:
+            candidates = self.gt.search(self.__gh_encode(*(point.coords[0])))
+            trace.probes = self.gt.search_probes
+        else:
+            hits, misses = self.cache.hits, self.cache.misses
+            candidates = self.__cached_search(*(point.coords[0]), trace)
+            trace.cache_hits = self.cache.hits - hits
+            trace.cache_misses = self.cache.misses - misses
+        trace.candidates = len(candidates)
+        trace.pip_tests = len(candidates.boundary)
+        start = perf_counter_ns()
+        containers = self.__containers(candidates, point)
+        trace.geos_ns = perf_counter_ns() - start
+        return containers
+
+    def lookup_many(self, lons: np.ndarray, lats: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Batched lookup. Points are grouped by geohash so that every posting list is fetched once, and
+        containment is then tested per candidate polygon against all of its points at once.
+        Returns parallel arrays of (point index, polygon id); polygon ids index into self.polygons.
+        """
+        if self.gt is None:
+            raise ValueError("index is not built")
+        lons = np.asarray(lons, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+        codes = geohashes.encode_many(lons, lats, self.gh_len)
+        cells, inverse = np.unique(codes, return_inverse=True)
+        order = np.argsort(inverse, kind="stable")
+        counts = np.bincount(inverse, minlength=len(cells))
+        if self.store_type == self.ARRAY_STORE:
+            return self.__lookup_many_arrays(lons, lats, cells, order, counts)
+        splits = np.cumsum(counts)[:-1]
+
+        point_chunks, pid_chunks = [], []
+        by_polygon = dict()
+        for gh, pts in zip(geohashes.to_strings(cells, self.gh_len), np.split(order, splits)):
+            candidates = self.gt.search(gh)
+            for c in candidates.interior:
+                point_chunks.append(pts)
+                pid_chunks.append(np.full(len(pts), c.pid))
+            for c, clip in zip(candidates.boundary, candidates.clips):
+                if clip is None:
+                    by_polygon.setdefault(c.pid, []).append(pts)
+                    continue
+                inside = shapely.contains_xy(clip, lons[pts], lats[pts])
+                point_chunks.append(pts[inside])
+                pid_chunks.append(np.full(np.count_nonzero(inside), c.pid))
+
+        for pid, chunks in by_polygon.items():
+            pts = np.concatenate(chunks)
+            inside = self.polygons[pid].contains_many(lons[pts], lats[pts])
+            point_chunks.append(pts[inside])
+            pid_chunks.append(np.full(np.count_nonzero(inside), pid))
+        return collect_pairs(point_chunks, pid_chunks)
+
+    def __lookup_many_arrays(self, lons, lats, cells, order, counts) -> Tuple[np.ndarray, np.ndarray]:
+        """lookup_many on the array store: posting lists of all cells are fetched and expanded with array ops"""
+        cell_idx, entries = self.gt.search_many(cells)
+        heads = np.cumsum(counts) - counts
+        pts = order[expand_ranges(heads[cell_idx], counts[cell_idx])]
+        entries = np.repeat(entries, counts[cell_idx])
+        interior = self.gt.interior[entries]
+        point_chunks, pid_chunks = [pts[interior]], [self.gt.ids[entries[interior]]]
+
+        pts, entries = pts[~interior], entries[~interior]
+        # boundary pairs are tested per clipped piece when there are any, else per polygon
+        group_keys = entries if self.gt.clips is not None else self.gt.ids[entries]
+        group_order = np.argsort(group_keys, kind="stable")
+        keys, starts = np.unique(group_keys[group_order], return_index=True)
+        for key, group in zip(keys, np.split(group_order, starts[1:])):
+            group_pts = pts[group]
+            pid = int(self.gt.ids[key]) if self.gt.clips is not None else int(key)
+            clip = self.gt.clips[key] if self.gt.clips is not None else None
+            if clip is None:
+                inside = self.polygons[pid].contains_many(lons[group_pts], lats[group_pts])
+            else:
+                inside = shapely.contains_xy(clip, lons[group_pts], lats[group_pts])
+            point_chunks.append(group_pts[inside])
+            pid_chunks.append(np.full(np.count_nonzero(inside), pid))
+        return collect_pairs(point_chunks, pid_chunks)
+
+    def query_region(self, geometry, predicate: str = "intersects", max_cells: int = 256) -> List[GeoDataPoint]:
+        """
+        Polygons intersecting (predicate="intersects") or lying within (predicate="within") geometry, ordered by pid.
+        The geometry is covered with at most about max_cells boundary cells, and every cell's subtree is enumerated by
+        prefix. A polygon is accepted without an exact test when it is stored under a cell inside the geometry, or is
+        interior to a cell at or above a cover cell
+        """
+        if self.gt is None:
+            raise ValueError("index is not built")
+        if predicate not in REGION_PREDICATES:
+            raise Exception("Invalid predicate")
+        geos, interiors = self.__region_cover(geometry, max_cells)
+        if len(geos) == 0:
+            return []
+        cells, pids, entry_interior, lengths = self.gt.scan_prefixes(geos)
+        cell_lengths = np.array([len(gh) for gh in geos], dtype=np.int64)[cells]
+        candidates = np.unique(pids)
+        if predicate == "intersects":
+            accepted = np.unique(pids[(interiors[cells] & (lengths >= cell_lengths)) |
+                                      (entry_interior & (lengths <= cell_lengths))])
+            candidates = np.setdiff1d(candidates, accepted, assume_unique=True)
+        else:
+            accepted = np.empty(0, dtype=np.int32)
+        polygons = [self.polygons[pid] for pid in candidates.tolist()]
+        refined = candidates[refine_region(geometry, polygons, predicate)]
+        return [self.polygons[pid] for pid in np.union1d(accepted, refined).tolist()]
+
+    def __grid_extent(self) -> Union[Tuple[int, int, int, int], None]:
+        if self._extent is None:
+            codes, lengths = self.gt.key_codes()
+            if len(codes) > 0:
+                self._extent = geohashes.xy_extent(codes, lengths, self.gh_len)
+        return self._extent
+
+    @classmethod
+    def __square_radius(cls, lon: float, lat: float, square: Tuple[int, int, int, int], level: int) -> float:
+        """Distance from a point inside a square of cells to the nearest side of it that is not on the world's edge"""
+        dim = geohashes.grid_size(level)
+        x0, y0, x1, y1 = square
+        sides = []
+        if x0 > 0:
+            sides.append(lon - (x0 / dim * 360.0 - 180.0))
+        if x1 < dim - 1:
+            sides.append((x1 + 1) / dim * 360.0 - 180.0 - lon)
+        if y0 > 0:
+            sides.append(lat - (y0 / dim * 180.0 - 90.0))
+        if y1 < dim - 1:
+            sides.append((y1 + 1) / dim * 180.0 - 90.0 - lat)
+        return min(sides, default=np.inf)
+
+    def nearest(self, point: Point, k: int = 1, max_distance: float = None) -> List[Tuple[GeoDataPoint, float]]:
+        """
+        Ring expansion around the point's cell. Every scanned ring grows a square of cells around the point, and
+        no polygon outside the scanned square is closer than the square's nearest side, so expansion stops once k
+        features are found within that distance. After _NEAREST_RINGS rings at a level, expansion continues one
+        level up, so that sparse areas are crossed in a few rings of large cells
+        """
+        if self.gt is None:
+            raise ValueError("index is not built")
+        extent = self.__grid_extent()
+        if extent is None:
+            return []
+        lon, lat = point.coords[0]
+        level = self.gh_len
+        x, y = geohashes.coords_to_xy(lon, lat, level)
+        square = (int(x), int(y), int(x), int(y))
+        scanned = None
+        rings = 0
+        polygons, distances = [], np.empty(0, dtype=np.float64)
+        seen = set()
+        while True:
+            dim = geohashes.grid_size(level)
+            scale = geohashes.grid_size(self.gh_len) // dim
+            ex0, ey0, ex1, ey1 = (v // scale for v in extent)
+            xs, ys = np.meshgrid(np.arange(square[0], square[2] + 1), np.arange(square[1], square[3] + 1))
+            xs, ys = xs.ravel(), ys.ravel()
+            new = (xs >= ex0) & (xs <= ex1) & (ys >= ey0) & (ys <= ey1)
+            if scanned is not None:
+                new &= (xs < scanned[0]) | (xs > scanned[2]) | (ys < scanned[1]) | (ys > scanned[3])
+            if new.any():
+                codes = geohashes.xy_to_codes(xs[new], ys[new], level)
+                pids = self.gt.scan_prefixes(geohashes.to_strings(codes, level).tolist())[1]
+                pids = [pid for pid in np.unique(pids).tolist() if pid not in seen]
+                seen.update(pids)
+                found = [self.polygons[pid] for pid in pids]
+                polygons.extend(found)
+                distances = np.concatenate([distances, shapely.distance(point, [gdp.poly for gdp in found])])
+
+            radius = self.__square_radius(lon, lat, square, level)
+            best = nearest_features(polygons, distances, k, max_distance)
+            if (len(best) == k and best[-1][1] <= radius) or (max_distance is not None and radius > max_distance) or \
+                    (square[0] <= ex0 and square[1] <= ey0 and square[2] >= ex1 and square[3] >= ey1):
+                return best
+
+            scanned = square
+            if rings == self._NEAREST_RINGS and level > 1:
+                # the square continues one level up; cells partly covered by the scanned square are scanned again
+                level -= 1
+                square = tuple(v // (dim // geohashes.grid_size(level)) for v in square)
+                scanned = None
+                rings = 0
+            else:
+                square = (max(square[0] - 1, 0), max(square[1] - 1, 0), min(square[2] + 1, dim - 1),
+                          min(square[3] + 1, dim - 1))
+                rings += 1
+
+    def save(self, path: str):
+        """
+        Writes the index to path; cells are always written in the array store layout. Deleted polygons and stale
+        attribute rows are left out of the file, which holds the index as compact would leave it; this index and
+        the pids it returned are unchanged
+        """
+        if self.gt is None:
+            raise ValueError("index is not built")
+        self.gt.finalize()
+        if isinstance(self.gt, HilbertCellStore):
+            store = self.gt
+        else:
+            store = HilbertCellStore.from_items(self.gh_len, self.polygons, self.gt.items())
+        polygons, metas, ids, rows = self.polygons, self.metas, store.ids, None
+        if needs_compaction(self.polygons, self.metas):
+            # live polygons keep their order, so cells stay sorted by pid once renumbered
+            pids, rows, metas = compaction(self.polygons, self.metas)
+            polygons = [gdp for gdp in self.polygons if gdp is not None]
+            ids = pids[store.ids]
+        header = {
+            "kind": "geotrie",
+            "gh_len": self.gh_len,
+            "scan_algorithm": self.scan_algorithm,
+            "min_gh_len": self.min_gh_len,
+            "max_cells": self.max_cells,
+            "clip_boundary": self.clip_boundary,
+        }
+        sections = {
+            "cell_keys": store.keys,
+            "cell_offsets": store.offsets,
+            "cell_ids": ids,
+            "cell_interior": store.interior,
+        }
+        if store.clips is not None:
+            sections["cell_clips"], sections["cell_clips_offsets"] = indexfile.pack_geometries(list(store.clips))
+        sections.update(indexfile.pack_polygons(polygons, rows))
+        sections.update(metas.to_sections())
+        indexfile.write_index(path, header, sections)
+
+    @classmethod
+    def load(cls, path: str) -> 'GeoTrieIndex':
+        """Maps an index written by save. The loaded index uses the array store over the mapped file"""
+        header, sections = indexfile.read_index(path)
+        if header.get("kind") != "geotrie":
+            raise ValueError("not a geotrie index file: {}".format(path))
+        idx = cls(header["gh_len"], header["scan_algorithm"], header["min_gh_len"], header["max_cells"],
+                  header["clip_boundary"], cls.ARRAY_STORE)
+        idx.metas = MetaStore.from_sections(sections)
+        idx.polygons = indexfile.load_polygons(sections, idx.metas)
+        idx.features = None
+        clips = None
+        if "cell_clips" in sections:
+            table = indexfile.BlobTable(sections["cell_clips"], sections["cell_clips_offsets"])
+            clips = indexfile.LazyGeometries(table)
+        idx.gt = HilbertCellStore.from_arrays(idx.gh_len, idx.polygons, sections["cell_keys"], sections["cell_offsets"],
+                                              sections["cell_ids"], sections["cell_interior"], clips)
+        return idx
+
+    def stats(self) -> dict:
+        """
+        Cell and entry counts, posting list lengths, cells per polygon cover and bytes per structure. Bytes of the
+        trie store are an estimate (see GeoTrie.nbytes), polygon bytes only count polygons in memory. For the trie
+        store, interning reports how many postings are shared (see GeoTrie.posting_stats)
+        """
+        if self.gt is None:
+            raise ValueError("index is not built")
+        lengths, pids, interior = self.gt.posting_arrays()
+        key_lengths = self.gt.key_codes()[1]
+        polygons = polygon_stats(self.polygons)
+        live = np.array([gdp is not None for gdp in self.polygons], dtype=bool)
+        cover_cells = np.bincount(pids, minlength=len(self.polygons))[live]
+        levels, level_counts = np.unique(key_lengths, return_counts=True)
+        return {
+            "cells": len(lengths),
+            "entries": len(pids),
+            "interior_entries": int(np.count_nonzero(interior)),
+            "cells_per_level": dict(zip(levels.tolist(), level_counts.tolist())),
+            "posting_lengths": value_summary(lengths),
+            "posting_histogram": length_histogram(lengths),
+            "cover_cells": value_summary(cover_cells),
+            "polygons": polygons["polygons"],
+            "deleted_polygons": polygons["deleted"],
+            "stale_meta_rows": len(self.metas) - polygons["rows"],
+            "bytes": {
+                "cells": self.gt.nbytes,
+                "polygons": polygons["coordinate_bytes"],
+                "meta": self.metas.nbytes,
+            },
+            "interning": self.gt.posting_stats() if self.store_type == self.TRIE_STORE else None,
+            "cache": self.cache_stats(),
+        }
+
+    @classmethod
+    def __cover_model(cls, polygons, gh_len: int, scan_algorithm, extent) -> dict:
+        """Means per polygon of cover cells, cell area inside extent and cover time, for one configuration"""
+        idx = cls(gh_len, scan_algorithm)
+        min_lon, min_lat, max_lon, max_lat = extent
+        start = perf_counter_ns()
+        covers = [idx.cover(poly)[:2] for poly in polygons]
+        seconds = (perf_counter_ns() - start) / 1e9
+        entries, boundary, area, boundary_area = 0, 0, 0.0, 0.0
+        levels = set()
+        for geos, interiors in covers:
+            interiors = np.asarray(interiors, dtype=bool)
+            lengths = np.array([len(gh) for gh in geos], dtype=np.int64)
+            codes = np.array([geohashes.to_code(gh) for gh in geos], dtype=np.int64)
+            for length in np.unique(lengths).tolist():
+                at = lengths == length
+                b = geohashes.bounds_many(codes[at], length)
+                cell_area = np.clip(np.minimum(b[:, 2], max_lon) - np.maximum(b[:, 0], min_lon), 0, None) * \
+                    np.clip(np.minimum(b[:, 3], max_lat) - np.maximum(b[:, 1], min_lat), 0, None)
+                area += float(cell_area.sum())
+                boundary_area += float(cell_area[~interiors[at]].sum())
+                levels.add(length)
+            entries += len(geos)
+            boundary += int(np.count_nonzero(~interiors))
+        n = max(len(polygons), 1)
+        return {"cover_cells": entries / n, "boundary_cells": boundary / n, "area": area / n,
+                "boundary_area": boundary_area / n, "cover_seconds": seconds / n, "levels": len(levels)}
+
+    @classmethod
+    def __tune_pick(cls, rows: List[dict], memory_budget: int, target_candidates: float) -> dict:
+        """
+        Shortest gh_len with at most target_candidates within memory_budget, else the fewest candidates within
+        budget, else the fewest bytes. Configurations of the chosen length are ranked by probes, then bytes
+        """
+        fitting = [r for r in rows if memory_budget is None or r["bytes"] <= memory_budget]
+        if len(fitting) == 0:
+            return min(rows, key=lambda r: r["bytes"])
+        on_target = [r for r in fitting if r["candidates"] <= target_candidates]
+        if len(on_target) > 0:
+            gh_len = min(r["gh_len"] for r in on_target)
+        else:
+            gh_len = min(fitting, key=lambda r: r["candidates"])["gh_len"]
+        return min([r for r in fitting if r["gh_len"] == gh_len], key=lambda r: (r["probes"], r["bytes"]))
+
+    @classmethod
+    def auto_tune(cls, geo_df: GeoDataFrame, memory_budget: int = None, target_candidates: float = 4.0,
+                  sample_size: int = 500, max_len: int = 8, benchmark_points: int = 0, seed: int = 0) -> dict:
+        """
+        Recommends gh_len and scan algorithm for geo_df from a cost model fitted on a sample of its polygons.
+
+        Every gh_len from 1 up to max_len is covered with VECTOR_GRID and ADAPTIVE_COVER. The sample covers give
+        cover cells and cover time per polygon, which are scaled to the whole dataset into: entries; cells, at
+        most one per entry and per grid cell over the dataset's extent; bytes of the array store plus polygon
+        coordinates; build seconds; and expected candidates and exact tests per lookup for points uniform over the
+        extent, which is the area of every entry's cell over the extent area, summed over entries.
+
+        The recommendation is the shortest gh_len with at most target_candidates within memory_budget bytes, see
+        __tune_pick. With benchmark_points > 0, array store indexes of the recommended configuration and of the
+        neighbouring lengths within budget are built on the whole dataset and timed over that many lookups, and the
+        pick is made again from the measured numbers.
+
+        Returns {"params": GeoTrieIndex arguments, "predicted": model of the recommendation, "model": model of
+        every configuration, "benchmark": measured configurations or None}
+        """
+        polygons = shapely.get_parts(np.asarray(geo_df.geometry.values))
+        if len(polygons) == 0:
+            raise ValueError("no polygons to tune for")
+        rng = np.random.default_rng(seed)
+        sample = polygons[rng.choice(len(polygons), size=min(sample_size, len(polygons)), replace=False)]
+        shapely.prepare(sample)
+        extent = tuple(shapely.total_bounds(polygons).tolist())
+        extent_area = max((extent[2] - extent[0]) * (extent[3] - extent[1]), np.finfo(np.float64).tiny)
+        polygon_bytes = int(shapely.get_num_coordinates(polygons).sum()) * 16
+
+        rows = []
+        on_target = None
+        for gh_len in range(1, min(max_len, geohashes.MAX_PRECISION) + 1):
+            x0, y0 = geohashes.to_xy(extent[0], extent[1], gh_len)
+            x1, y1 = geohashes.to_xy(extent[2], extent[3], gh_len)
+            grid_cells = (x1 - x0 + 1) * (y1 - y0 + 1)
+            level_rows = []
+            for scan_algorithm in (cls.VECTOR_GRID, cls.ADAPTIVE_COVER):
+                model = cls.__cover_model(sample, gh_len, scan_algorithm, extent)
+                entries = model["cover_cells"] * len(polygons)
+                cells = min(entries, grid_cells)
+                level_rows.append({
+                    "gh_len": gh_len,
+                    "scan_algorithm": scan_algorithm,
+                    "cover_cells": model["cover_cells"],
+                    "entries": int(entries),
+                    "cells": int(cells),
+                    "bytes": int(cells * cls._KEY_BYTES + entries * cls._ENTRY_BYTES) + polygon_bytes,
+                    "build_seconds": model["cover_seconds"] * len(polygons),
+                    "candidates": model["area"] * len(polygons) / extent_area,
+                    "pip_tests": model["boundary_area"] * len(polygons) / extent_area,
+                    "probes": model["levels"] if scan_algorithm == cls.ADAPTIVE_COVER else 1,
+                })
+            rows.extend(level_rows)
+            if memory_budget is not None and min(r["bytes"] for r in level_rows) > memory_budget:
+                break
+            if max(r["cover_cells"] for r in level_rows) > cls._TUNE_MAX_COVER:
+                break
+            # the benchmark also needs the length past the first one on target, as a neighbour
+            if on_target is not None:
+                break
+            if any(r["candidates"] <= target_candidates for r in level_rows):
+                on_target = gh_len
+                if benchmark_points <= 0:
+                    break
+
+        best = cls.__tune_pick(rows, memory_budget, target_candidates)
+        measured = None
+        if benchmark_points > 0:
+            lons = rng.uniform(extent[0], extent[2], benchmark_points)
+            lats = rng.uniform(extent[1], extent[3], benchmark_points)
+            points = shapely.points(lons, lats).tolist()
+            measured = []
+            for row in rows:
+                if row["scan_algorithm"] != best["scan_algorithm"] or abs(row["gh_len"] - best["gh_len"]) > 1 or \
+                        (memory_budget is not None and row["bytes"] > memory_budget):
+                    continue
+                idx = cls(row["gh_len"], row["scan_algorithm"], store_type=cls.ARRAY_STORE)
+                start = perf_counter_ns()
+                idx.build(geo_df)
+                build_seconds = (perf_counter_ns() - start) / 1e9
+                counters = LookupCounters()
+                idx.set_lookup_hook(counters)
+                for p in points:
+                    idx.lookup(p)
+                totals = counters.stats()
+                stats = idx.stats()
+                measured.append({
+                    "gh_len": row["gh_len"],
+                    "scan_algorithm": row["scan_algorithm"],
+                    "entries": stats["entries"],
+                    "cells": stats["cells"],
+                    "bytes": stats["bytes"]["cells"] + stats["bytes"]["polygons"],
+                    "build_seconds": build_seconds,
+                    "candidates": totals["candidates_mean"],
+                    "pip_tests": totals["pip_tests_mean"],
+                    "probes": totals["probes_mean"],
+                    "lookup_us": totals["total_ns_mean"] / 1000,
+                })
+            picked = cls.__tune_pick(measured, memory_budget, target_candidates)
+            best = [r for r in rows if (r["gh_len"], r["scan_algorithm"]) ==
+                    (picked["gh_len"], picked["scan_algorithm"])][0]
+
+        params = {"gh_len": best["gh_len"], "scan_algorithm": best["scan_algorithm"]}
+        return {"params": params, "predicted": best, "model": rows, "benchmark": measured}
+
     def gh_boxes(self, gh):
         return self.gt.search(gh)
 
     def show(self, long_format=False):
+        """Prints every cell with its polygons, or their count, one cell at a time"""
         if self.gt is None:
             raise ValueError("index is not built")
+        for gh, posting in self.gt.iter_items():
+            if long_format:
+                print(gh, "->", ', '.join([str(i) for i in posting]))
+            else:
+                print(gh, "->", len(posting))
 
-        def print_formatted(trie_dict: dict):
-            for k, v in trie_dict.items():
-                if long_format:
-                    print(k, "->", ', '.join([str(i) for i in v]))
-                else:
-                    print(k, "->", len(v))
 
-        print("walking...")
-        self.gt.walk(print_formatted)
+def _cover_chunk(params: dict, wkbs: List[bytes]) -> List[Tuple[List[str], np.ndarray, Union[List[bytes], None]]]:
+    """Process pool task of GeoTrieIndex.build: covers of a chunk of WKB polygons, clipped pieces as WKB"""
+    idx = GeoTrieIndex(**params)
+    results = []
+    for poly in shapely.from_wkb(wkbs):
+        geos, interiors, clips = idx.cover(poly)
+        if idx.clip_boundary:
+            clips = [None if c is None else shapely.to_wkb(c) for c in clips]
+        else:
+            clips = None
+        results.append((geos, np.asarray(interiors, dtype=bool), clips))
+    return results
@@ -0,0 +1,211 @@
+import json
+import mmap
+import struct
+from typing import Dict, List, Tuple
+
+import numpy as np
+import shapely
+
+from geodatapoint import GeoDataPoint
+
+'''
+Versioned binary index format.
+
+    magic (8 bytes) | version (uint32) | header length (uint32) | header (json) | sections
+
+The json header carries index parameters and a section table of (dtype, shape, offset) for every array. Sections
+are 64 byte aligned raw arrays, so that loading only maps the file and wraps each section in a read-only numpy view.
+Pages are then shared by every process mapping the same file. Geometries are stored as WKB blobs with an offset
+table and decoded on first use.
+'''
+
+MAGIC = b"GEOTRIX\x00"
+VERSION = 2
+_ALIGN = 64
+_PREAMBLE = struct.Struct("<8sII")
+
+
+def _aligned(n: int) -> int:
+    return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def write_index(path: str, header: dict, sections: Dict[str, np.ndarray]):
+    sections = {name: np.ascontiguousarray(arr) for name, arr in sections.items()}
+    table = dict()
+    # the header holds the section table, so section offsets are relative to the end of the header
+    relative = 0
+    for name, arr in sections.items():
+        table[name] = {"dtype": arr.dtype.str, "shape": list(arr.shape), "offset": relative}
+        relative = _aligned(relative + arr.nbytes)
+    header = dict(header, sections=table)
+    header_bytes = json.dumps(header).encode("utf-8")
+    start = _aligned(_PREAMBLE.size + len(header_bytes))
+
+    with open(path, "wb") as f:
+        f.write(_PREAMBLE.pack(MAGIC, VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        for name, arr in sections.items():
+            f.seek(start + table[name]["offset"])
+            f.write(arr.tobytes())
+        f.truncate(start + relative)
+
+
+def _read_header(f, path: str) -> Tuple[dict, int]:
+    magic, version, header_len = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+    if magic != MAGIC:
+        raise ValueError("not an index file: {}".format(path))
+    if version != VERSION:
+        raise ValueError("unsupported index file version: {}".format(version))
+    return json.loads(f.read(header_len).decode("utf-8")), header_len
+
+
+def read_header(path: str) -> dict:
+    """Header of an index file, without mapping its sections"""
+    with open(path, "rb") as f:
+        return _read_header(f, path)[0]
+
+
+def read_index(path: str) -> Tuple[dict, Dict[str, np.ndarray]]:
+    """Maps an index file. Returns its header and read-only array views of its sections"""
+    with open(path, "rb") as f:
+        header, header_len = _read_header(f, path)
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    start = _aligned(_PREAMBLE.size + header_len)
+    sections = dict()
+    for name, s in header["sections"].items():
+        dtype = np.dtype(s["dtype"])
+        count = int(np.prod(s["shape"], dtype=np.int64))
+        if count == 0:
+            sections[name] = np.empty(s["shape"], dtype=dtype)
+            continue
+        arr = np.frombuffer(mm, dtype=dtype, count=count, offset=start + s["offset"])
+        sections[name] = arr.reshape(s["shape"])
+    return header, sections
+
+
+def pack_blobs(blobs: List[bytes]) -> Tuple[np.ndarray, np.ndarray]:
+    """Concatenates byte strings into a uint8 array and an int64 offset table of len(blobs) + 1"""
+    offsets = np.zeros(len(blobs) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in blobs])
+    return np.frombuffer(b"".join(blobs), dtype=np.uint8), offsets
+
+
+def pack_geometries(geoms: List) -> Tuple[np.ndarray, np.ndarray]:
+    """WKB blob of geometries; None entries are stored as empty blobs"""
+    return pack_blobs([b"" if g is None else shapely.to_wkb(g) for g in geoms])
+
+
+def _json_default(value):
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+
+def pack_meta(metas: List) -> Tuple[np.ndarray, np.ndarray]:
+    """JSON blob of meta dicts or other json serializable values"""
+    return pack_blobs([json.dumps(m, default=_json_default).encode("utf-8") for m in metas])
+
+
+class BlobTable(object):
+    """Read side of a blob section, decoding entries on first access"""
+
+    def __init__(self, data: np.ndarray, offsets: np.ndarray):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def raw(self, i: int) -> bytes:
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes()
+
+    def geometry(self, i: int):
+        blob = self.raw(i)
+        if len(blob) == 0:
+            return None
+        return shapely.from_wkb(blob)
+
+    def json_value(self, i: int):
+        return json.loads(self.raw(i).decode("utf-8"))
+
+
+class LazyGeometries(object):
+    """Sequence of prepared geometries decoded from a blob section on first use"""
+
+    def __init__(self, table: BlobTable):
+        self._table = table
+        self._cache = dict()
+
+    def __len__(self):
+        return len(self._table)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        i = int(i)
+        if i not in self._cache:
+            geom = self._table.geometry(i)
+            if geom is not None:
+                shapely.prepare(geom)
+            self._cache[i] = geom
+        return self._cache[i]
+
+
+class JsonValues(object):
+    """Sequence of JSON values decoded from a blob section on access"""
+
+    def __init__(self, table: BlobTable):
+        self._table = table
+
+    def __len__(self):
+        return len(self._table)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        return self._table.json_value(int(i))
+
+
+class PolygonSource(object):
+    """Polygons of a loaded index file along with their feature ids"""
+
+    def __init__(self, sections: Dict[str, np.ndarray]):
+        self.geometries = BlobTable(sections["poly_wkb"], sections["poly_wkb_offsets"])
+        self.fids = BlobTable(sections["poly_fid"], sections["poly_fid_offsets"])
+
+    def __len__(self):
+        return len(self.geometries)
+
+    def geometry(self, i: int):
+        return self.geometries.geometry(i)
+
+    def fid(self, i: int):
+        return self.fids.json_value(i)
+
+
+def pack_polygons(polygons: List[GeoDataPoint], rows: np.ndarray = None) -> Dict[str, np.ndarray]:
+    """
+    Sections for a list of GeoDataPoints, indexed by their position in the list. Deleted polygons (None) are stored
+    as empty blobs. rows are the attribute rows of the polygons, their own rows if None; the attributes are written
+    separately, by MetaStore.to_sections
+    """
+    wkb, wkb_offsets = pack_geometries([None if gdp is None else gdp.poly for gdp in polygons])
+    fid, fid_offsets = pack_meta([None if gdp is None else gdp.fid for gdp in polygons])
+    if rows is None:
+        rows = [-1 if gdp is None else gdp.row for gdp in polygons]
+    rows = np.asarray(rows, dtype=np.int64)
+    return {"poly_wkb": wkb, "poly_wkb_offsets": wkb_offsets, "poly_fid": fid, "poly_fid_offsets": fid_offsets,
+            "poly_row": rows}
+
+
+def load_polygons(sections: Dict[str, np.ndarray], store) -> List[GeoDataPoint]:
+    """Lazy GeoDataPoints over the polygon sections of a loaded index file, with attributes in store (a MetaStore)"""
+    source = PolygonSource(sections)
+    offsets = sections["poly_wkb_offsets"]
+    deleted = (offsets[1:] == offsets[:-1]).tolist()
+    rows = sections["poly_row"].tolist()
+    return [None if deleted[pid] else GeoDataPoint.lazy(source, pid, rows[pid], store) for pid in range(len(source))]
@@ -0,0 +1,105 @@
+from typing import Callable, Dict, List
+
+import numpy as np
+import shapely
+
+
+class LookupTrace(object):
+    '''
+    Counters of a single lookup, passed to the hook installed by SpatialIndex.set_lookup_hook.
+
+    probes: cells (geotrie) or tree nodes (strtree) looked up
+    candidates: polygons reached by the lookup, before any exact test
+    pip_tests: exact point in polygon tests run
+    geos_ns: time spent in those tests, in nanoseconds
+    cache_hits, cache_misses: lookup cache accesses, if the index has a cache
+    results: polygons found
+    total_ns: time spent in the whole lookup, hook excluded
+    '''
+    __slots__ = ("probes", "candidates", "pip_tests", "geos_ns", "cache_hits", "cache_misses", "results", "total_ns")
+
+    def __init__(self):
+        self.probes = 0
+        self.candidates = 0
+        self.pip_tests = 0
+        self.geos_ns = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.results = 0
+        self.total_ns = 0
+
+    def as_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __str__(self):
+        return str(self.as_dict())
+
+
+class LookupCounters(object):
+    """Lookup hook summing the traces of every lookup, e.g. to be exported periodically"""
+
+    def __init__(self):
+        self.lookups = 0
+        self.totals = LookupTrace()
+
+    def __call__(self, trace: LookupTrace):
+        self.lookups += 1
+        for name in LookupTrace.__slots__:
+            setattr(self.totals, name, getattr(self.totals, name) + getattr(trace, name))
+
+    def reset(self):
+        self.lookups = 0
+        self.totals = LookupTrace()
+
+    def stats(self) -> dict:
+        """Totals, along with their mean per lookup"""
+        out = {"lookups": self.lookups}
+        for name, total in self.totals.as_dict().items():
+            out[name] = total
+            out[name + "_mean"] = total / self.lookups if self.lookups > 0 else 0.0
+        return out
+
+
+LookupHook = Callable[[LookupTrace], None]
+
+
+def length_histogram(lengths: np.ndarray) -> Dict[str, int]:
+    """Counts of lengths in power of two buckets, "1", "2-3", "4-7" and so on; zero lengths are counted as "0" """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    out = dict()
+    if len(lengths) == 0:
+        return out
+    zeros = int(np.count_nonzero(lengths == 0))
+    if zeros > 0:
+        out["0"] = zeros
+    positive = lengths[lengths > 0]
+    if len(positive) == 0:
+        return out
+    buckets = np.bincount(np.floor(np.log2(positive)).astype(np.int64))
+    for b, count in enumerate(buckets.tolist()):
+        if count > 0:
+            lo, hi = 1 << b, (2 << b) - 1
+            out[str(lo) if lo == hi else "{}-{}".format(lo, hi)] = count
+    return out
+
+
+def value_summary(values: np.ndarray) -> dict:
+    """count, mean, p50, p90, p99 and max of values"""
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return {"count": 0}
+    p50, p90, p99 = np.percentile(values, [50, 90, 99]).tolist()
+    return {"count": len(values), "mean": float(values.mean()), "p50": p50, "p90": p90, "p99": p99,
+            "max": float(values.max())}
+
+
+def polygon_stats(polygons: List) -> dict:
+    """
+    Polygon counts, attribute rows in use, and bytes of the coordinates of polygons in memory. Polygons of a loaded
+    index that were never decoded stay in the mapped file and are not counted, nor decoded
+    """
+    live = [gdp for gdp in polygons if gdp is not None]
+    decoded = [gdp.poly for gdp in live if gdp.decoded]
+    coordinates = int(shapely.get_num_coordinates(decoded).sum()) if len(decoded) > 0 else 0
+    return {"polygons": len(live), "deleted": len(polygons) - len(live), "decoded": len(decoded),
+            "rows": len(set(gdp.row for gdp in live) - {None}), "coordinate_bytes": coordinates * 16}
@@ -0,0 +1,276 @@
+import argparse
+import asyncio
+import json
+import sys
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from time import perf_counter_ns
+from typing import List, Tuple
+
+import numpy as np
+
+from benchmark import latency_summary
+from indexstats import value_summary
+from queryexecutor import QueryExecutor, load_index
+from spatialindex import SpatialIndex
+
+'''
+Point in polygon lookup service over asyncio.
+
+The protocol is JSON lines over a TCP or unix socket. A request is an object per line, {"id": 1, "lon": .., "lat": ..},
+answered by {"id": 1, "features": [..]} with the ids of the features containing the point, or by {"id": 1, "error": ..}.
+Responses of a connection may come out of order, clients match them by id. {"id": 1, "op": "stats"} is answered by
+{"id": 1, "stats": {..}}, see LookupBatcher.stats.
+'''
+
+# batch sizes and waits kept for the stats of a batcher
+_RECENT_BATCHES = 10000
+
+
+def _json_default(value):
+    return value.item() if hasattr(value, "item") else str(value)
+
+
+class LookupBatcher(object):
+    '''
+    Micro-batches concurrent single point lookups. Points wait until max_batch of them are pending or the first of
+    them has waited max_delay_ms, then run as one lookup_many of the index on executor, off the event loop. The
+    default executor is a single thread, as indexes are not thread safe; give an index a QueryExecutor to spread
+    batches over processes.
+    '''
+
+    def __init__(self, index: SpatialIndex, max_batch: int = 256, max_delay_ms: float = 2.0, executor: Executor = None,
+                 flush_idle: bool = False):
+        if max_batch <= 0:
+            raise ValueError("max_batch must be positive")
+        self.index = index
+        self.flush_idle = flush_idle
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1e3
+        self.executor = executor or ThreadPoolExecutor(1)
+        self.__pending: List[Tuple[float, float, asyncio.Future, int]] = []
+        self.__timer = None
+        self.__in_flight = 0
+        self.__batches = 0
+        self.__points = 0
+        self.__batch_sizes = deque(maxlen=_RECENT_BATCHES)
+        self.__waits_us = deque(maxlen=_RECENT_BATCHES)
+
+    async def lookup(self, lon: float, lat: float) -> list:
+        """Ids of the features containing the point"""
+        future = asyncio.get_running_loop().create_future()
+        self.__pending.append((lon, lat, future, perf_counter_ns()))
+        if len(self.__pending) >= self.max_batch or (self.flush_idle and self.__in_flight == 0):
+            self.__flush()
+        elif self.__timer is None:
+            self.__timer = asyncio.get_running_loop().call_later(self.max_delay, self.__flush)
+        return await future
+
+    def __flush(self):
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+        if len(self.__pending) == 0:
+            return
+        batch, self.__pending = self.__pending, []
+        self.__in_flight += len(batch)
+        asyncio.get_running_loop().create_task(self.__run(batch))
+
+    async def __run(self, batch: List[Tuple[float, float, asyncio.Future, int]]):
+        lons = np.array([b[0] for b in batch], dtype=np.float64)
+        lats = np.array([b[1] for b in batch], dtype=np.float64)
+        start = perf_counter_ns()
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(self.executor, self.__resolve, lons, lats)
+        except Exception as e:
+            results = None
+            for _, _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self.__in_flight -= len(batch)
+        self.__batches += 1
+        self.__points += len(batch)
+        self.__batch_sizes.append(len(batch))
+        self.__waits_us.extend((start - b[3]) / 1e3 for b in batch)
+        if self.flush_idle and self.__in_flight == 0:
+            self.__flush()
+        if results is None:
+            return
+        for (_, _, future, _), features in zip(batch, results):
+            if not future.done():
+                future.set_result(features)
+
+    def __resolve(self, lons: np.ndarray, lats: np.ndarray) -> List[list]:
+        # one call, so that an index serving snapshots resolves the ids on the snapshot it looked up
+        points, fids = self.index.lookup_features(lons, lats)
+        bounds = np.searchsorted(points, np.arange(len(lons) + 1))
+        # parts of one feature may both contain the point, keep the feature once
+        return [list(dict.fromkeys(fids[bounds[i]:bounds[i + 1]].tolist())) for i in range(len(lons))]
+
+    def stats(self) -> dict:
+        """
+        Queue depth (points waiting for a batch, and points of batches running), batch and point counts, and
+        summaries of the sizes of recent batches and of the time their points waited before running, in microseconds
+        """
+        return {"queue_depth": len(self.__pending), "in_flight": self.__in_flight, "batches": self.__batches,
+                "points": self.__points, "batch_size": value_summary(self.__batch_sizes),
+                "wait_us": value_summary(self.__waits_us)}
+
+
+class LookupServer(object):
+    """JSON lines lookup service of a LookupBatcher, over TCP (host, port) or a unix socket (path)"""
+
+    def __init__(self, batcher: LookupBatcher):
+        self.batcher = batcher
+        self.server = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8470, path: str = None):
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self.__serve, path)
+        else:
+            self.server = await asyncio.start_server(self.__serve, host, port)
+        return self.server
+
+    async def serve_forever(self, host: str = "127.0.0.1", port: int = 8470, path: str = None):
+        server = await self.start(host, port, path)
+        async with server:
+            await server.serve_forever()
+
+    async def __serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                task = asyncio.get_running_loop().create_task(self.__answer(line, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if len(tasks) > 0:
+                await asyncio.wait(tasks)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def __answer(self, line: bytes, writer: asyncio.StreamWriter):
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get("id")
+            if request.get("op", "lookup") == "stats":
+                response = {"id": request_id, "stats": self.batcher.stats()}
+            elif request.get("op", "lookup") == "lookup":
+                features = await self.batcher.lookup(float(request["lon"]), float(request["lat"]))
+                response = {"id": request_id, "features": features}
+            else:
+                raise Exception("Invalid op")
+        except Exception as e:
+            response = {"id": request_id, "error": "{}: {}".format(type(e).__name__, e)}
+        if not writer.is_closing():
+            writer.write(json.dumps(response, default=_json_default).encode("utf-8") + b"\n")
+            await writer.drain()
+
+
+async def _load_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, points: deque,
+                           concurrency: int, latencies: list):
+    """Keeps concurrency lookups of points outstanding on one connection until points run out"""
+    sent = dict()
+    next_id = 0
+
+    def send():
+        nonlocal next_id
+        lon, lat = points.popleft()
+        sent[next_id] = perf_counter_ns()
+        writer.write(json.dumps({"id": next_id, "lon": lon, "lat": lat}).encode("utf-8") + b"\n")
+        next_id += 1
+
+    while len(sent) < concurrency and len(points) > 0:
+        send()
+    while len(sent) > 0:
+        response = json.loads(await reader.readline())
+        latencies.append(perf_counter_ns() - sent.pop(response["id"]))
+        if "error" in response:
+            raise Exception("lookup failed: {}".format(response["error"]))
+        if len(points) > 0:
+            send()
+    writer.close()
+
+
+async def load_test(lons: np.ndarray, lats: np.ndarray, concurrency: int, connections: int = 4,
+                    host: str = "127.0.0.1", port: int = 8470, path: str = None) -> dict:
+    """
+    Closed loop load of a lookup server: every point looked up once, with concurrency lookups outstanding over
+    connections connections. Latency summary per lookup (see benchmark.latency_summary), ops_per_sec over the run
+    """
+    points = deque(zip(lons.tolist(), lats.tolist()))
+    latencies = []
+    streams = [await (asyncio.open_unix_connection(path) if path is not None else asyncio.open_connection(host, port))
+               for _ in range(connections)]
+    start = perf_counter_ns()
+    await asyncio.gather(*[_load_connection(reader, writer, points, max(1, concurrency // connections), latencies)
+                           for reader, writer in streams])
+    elapsed = perf_counter_ns() - start
+    out = latency_summary(latencies)
+    out.update({"concurrency": concurrency, "ops_per_sec": len(latencies) / (elapsed / 1e9)})
+    return out
+
+
+async def server_stats(host: str = "127.0.0.1", port: int = 8470, path: str = None) -> dict:
+    """Batcher stats of a running lookup server"""
+    reader, writer = await (asyncio.open_unix_connection(path) if path is not None else
+                            asyncio.open_connection(host, port))
+    writer.write(b'{"id": 0, "op": "stats"}\n')
+    response = json.loads(await reader.readline())
+    writer.close()
+    return response["stats"]
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="lookupserver", description="Micro-batching point in polygon lookup service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8470)
+    parser.add_argument("--unix", help="unix socket path, instead of TCP")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve = commands.add_parser("serve", help="serve lookups of an index file")
+    serve.add_argument("index", help="index file written by an index save")
+    serve.add_argument("--max-batch", type=int, default=256)
+    serve.add_argument("--max-delay-ms", type=float, default=2.0)
+    serve.add_argument("--flush-idle", action="store_true",
+                       help="run pending points at once while no batch is running, instead of waiting")
+    serve.add_argument("--workers", type=int, default=0, help="lookup over a QueryExecutor of that many processes")
+    load = commands.add_parser("load", help="measure tail latency against throughput of a running server")
+    load.add_argument("--bounds", type=float, nargs=4, default=[-180, -90, 180, 90],
+                      metavar=("MIN_LON", "MIN_LAT", "MAX_LON", "MAX_LAT"), help="extent of the random points")
+    load.add_argument("--requests", type=int, default=20000, help="lookups per concurrency level")
+    load.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 64, 256])
+    load.add_argument("--connections", type=int, default=4)
+    load.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        index = QueryExecutor(args.index, args.workers) if args.workers > 0 else load_index(args.index)
+        batcher = LookupBatcher(index, args.max_batch, args.max_delay_ms, flush_idle=args.flush_idle)
+        try:
+            asyncio.run(LookupServer(batcher).serve_forever(args.host, args.port, args.unix))
+        finally:
+            if isinstance(index, QueryExecutor):
+                index.close()
+        return 0
+
+    rng = np.random.default_rng(args.seed)
+    min_lon, min_lat, max_lon, max_lat = args.bounds
+    for concurrency in args.concurrency:
+        lons = rng.uniform(min_lon, max_lon, args.requests)
+        lats = rng.uniform(min_lat, max_lat, args.requests)
+        row = asyncio.run(load_test(lons, lats, concurrency, min(args.connections, concurrency), args.host, args.port,
+                                    args.unix))
+        print("concurrency={} ops_per_sec={:.0f} p50_us={:.0f} p95_us={:.0f} p99_us={:.0f} max_us={:.0f}".format(
+            concurrency, row["ops_per_sec"], row["p50_us"], row["p95_us"], row["p99_us"], row["max_us"]))
+    print("server: {}".format(json.dumps(asyncio.run(server_stats(args.host, args.port, args.unix)))))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
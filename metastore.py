@@ -0,0 +1,189 @@
+import json
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+from pandas import DataFrame
+
+from indexfile import BlobTable, JsonValues, pack_meta
+
+
+def _native(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def _objects(values) -> np.ndarray:
+    out = np.empty(len(values), dtype=object)
+    # element-wise, so that list values are not broadcast into the array
+    for i, value in enumerate(values):
+        out[i] = value
+    return out
+
+
+def _column(values: List) -> np.ndarray:
+    """Array of column values: bool, int64 or float64 when every value is one, an object array otherwise"""
+    kinds = set(type(v) for v in values)
+    if len(kinds) > 0:
+        if all(issubclass(k, (bool, np.bool_)) for k in kinds):
+            return np.array(values, dtype=bool)
+        if all(issubclass(k, (int, np.integer)) and not issubclass(k, (bool, np.bool_)) for k in kinds):
+            try:
+                return np.array(values, dtype=np.int64)
+            except OverflowError:
+                pass
+        if all(issubclass(k, (float, np.floating)) for k in kinds):
+            return np.array(values, dtype=np.float64)
+    return _objects(values)
+
+
+def _take(column: Sequence, rows: np.ndarray) -> np.ndarray:
+    if isinstance(column, np.ndarray):
+        return column[rows]
+    return _column([column[i] for i in rows.tolist()])
+
+
+class MetaStore(object):
+    '''
+    Feature attributes, held once per feature in one column per attribute.
+
+    Rows are appended as features are indexed and are only dropped by compact; an updated feature gets a new row.
+    Appended rows are kept as dicts until finalize converts them into a chunk of every column: numpy arrays for
+    boolean, integer and float columns, object arrays otherwise. Attributes missing from a row read as None. Chunks
+    are concatenated once, when the column is read; a column with chunks of different types becomes an object column,
+    so that appends never rebuild the rows already stored. On a loaded index file, numeric columns are views of the
+    mapped file and other columns are decoded per value on access.
+    '''
+
+    # pending rows converted at once while appending, bounds the memory held in row dicts
+    _FLUSH_ROWS = 1 << 14
+
+    def __init__(self):
+        # merged columns, followed by the chunks of their later rows
+        self._columns: Dict[str, Sequence] = dict()
+        self._chunks: Dict[str, List[np.ndarray]] = dict()
+        self._dtypes: Dict[str, np.dtype] = dict()
+        # rows held in columns and chunks, the pending rows follow them
+        self._size = 0
+        self._pending: List[dict] = []
+
+    def __len__(self):
+        return self._size + len(self._pending)
+
+    @property
+    def columns(self) -> Dict[str, Sequence]:
+        """Columns of the rows converted so far, merged"""
+        for name in self._dtypes:
+            self.__merge(name)
+        return self._columns
+
+    def append(self, meta: dict) -> int:
+        """Adds a row, returns its position"""
+        self._pending.append(meta)
+        if len(self._pending) >= self._FLUSH_ROWS:
+            self.finalize()
+        return len(self) - 1
+
+    def row(self, i: int) -> dict:
+        if i >= self._size:
+            return self._pending[i - self._size]
+        return {name: _native(column[i]) for name, column in self.columns.items()}
+
+    def finalize(self):
+        """Converts pending rows into a chunk of every column"""
+        if len(self._pending) == 0:
+            return
+        names = list(self._dtypes)
+        seen = set(names)
+        for meta in self._pending:
+            for name in meta:
+                if name not in seen:
+                    seen.add(name)
+                    names.append(name)
+        for name in names:
+            chunk = _column([meta.get(name) for meta in self._pending])
+            if name not in self._dtypes:
+                # earlier rows read as None
+                self._chunks[name] = [np.full(self._size, None, dtype=object)] if self._size > 0 else []
+                self._dtypes[name] = np.dtype(object) if self._size > 0 else chunk.dtype
+            if chunk.dtype != self._dtypes[name]:
+                self._dtypes[name] = np.dtype(object)
+            self._chunks.setdefault(name, []).append(chunk)
+        self._size += len(self._pending)
+        self._pending = []
+
+    def __merge(self, name: str) -> Sequence:
+        """Concatenates the chunks of a column into it, converted to the column type"""
+        chunks = self._chunks.get(name)
+        if not chunks:
+            return self._columns[name]
+        dtype = self._dtypes[name]
+        parts = []
+        column = self._columns.get(name)
+        if isinstance(column, np.ndarray):
+            parts.append(column.astype(dtype, copy=False))
+        elif column is not None:
+            parts.append(_objects([column[i] for i in range(len(column))]))
+        parts.extend(chunk.astype(dtype, copy=False) for chunk in chunks)
+        self._columns[name] = np.concatenate(parts) if len(parts) > 1 else parts[0]
+        self._chunks[name] = []
+        return self._columns[name]
+
+    def take(self, rows, columns: List[str] = None) -> Dict[str, np.ndarray]:
+        """Values of rows, one array per column"""
+        self.finalize()
+        rows = np.asarray(rows, dtype=np.int64)
+        names = list(self._dtypes) if columns is None else columns
+        return {name: _take(self.__merge(name), rows) for name in names}
+
+    def compact(self, rows) -> Tuple['MetaStore', np.ndarray]:
+        """Store of the distinct rows among rows, in order, and the position in it of every entry of rows"""
+        self.finalize()
+        kept, positions = np.unique(np.asarray(rows, dtype=np.int64), return_inverse=True)
+        store = MetaStore()
+        for name, dtype in self._dtypes.items():
+            column = self.__merge(name)
+            store._columns[name] = column[kept] if isinstance(column, np.ndarray) else \
+                _objects([column[i] for i in kept.tolist()])
+            store._dtypes[name] = dtype
+        store._size = len(kept)
+        return store, positions
+
+    def frame(self, rows, columns: List[str] = None, index=None) -> DataFrame:
+        return DataFrame(self.take(rows, columns), index=index)
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes of the column arrays; values of object columns are not counted"""
+        arrays = [column for column in self._columns.values() if isinstance(column, np.ndarray)]
+        arrays += [chunk for chunks in self._chunks.values() for chunk in chunks]
+        return sum(array.nbytes for array in arrays)
+
+    def to_sections(self) -> Dict[str, np.ndarray]:
+        """Index file sections: numeric columns as raw arrays, others as JSON blobs"""
+        self.finalize()
+        schema = {"rows": self._size, "columns": []}
+        sections = dict()
+        for k, (name, column) in enumerate(self.columns.items()):
+            key = "meta_column_{}".format(k)
+            if isinstance(column, np.ndarray) and column.dtype != object:
+                sections[key] = column
+                schema["columns"].append([name, "array"])
+            else:
+                sections[key], sections[key + "_offsets"] = pack_meta([_native(v) for v in column])
+                schema["columns"].append([name, "json"])
+        sections["meta_schema"] = np.frombuffer(json.dumps(schema).encode("utf-8"), dtype=np.uint8)
+        return sections
+
+    @classmethod
+    def from_sections(cls, sections: Dict[str, np.ndarray]) -> 'MetaStore':
+        store = cls()
+        schema = json.loads(sections["meta_schema"].tobytes().decode("utf-8"))
+        for k, (name, kind) in enumerate(schema["columns"]):
+            key = "meta_column_{}".format(k)
+            if kind == "array":
+                store._columns[name] = sections[key]
+                store._dtypes[name] = sections[key].dtype
+            else:
+                store._columns[name] = JsonValues(BlobTable(sections[key], sections[key + "_offsets"]))
+                store._dtypes[name] = np.dtype(object)
+        store._size = schema["rows"]
+        return store
@@ -0,0 +1,124 @@
+from typing import Tuple, Union
+
+import numpy as np
+import shapely
+from shapely.geometry import Polygon
+
+from cellstore import expand_ranges
+
+# relative error bound of _orientation, with a wide margin over the few ulps of the exact bound
+_ORIENTATION_ERROR = 1e-12
+
+
+def _orientation(ax, ay, bx, by, cx, cy) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Twice the signed area of triangles (a, b, c), positive when c lies left of a -> b, and whether its sign is
+    uncertain, i.e. within the rounding error of the floating point evaluation
+    """
+    left, right = (bx - ax) * (cy - ay), (by - ay) * (cx - ax)
+    det = left - right
+    return det, np.abs(det) <= _ORIENTATION_ERROR * (np.abs(left) + np.abs(right))
+
+
+class EdgeGrid(object):
+    '''
+    Vectorized point in polygon test over a uniform grid laid on the polygon's bounding box.
+
+    Every grid cell lists the ring edges (exterior and holes) whose bounding box overlaps it, and knows whether its
+    center lies inside the polygon. A point is inside when the center of its cell is, flipped once for every listed
+    edge that the segment from the point to the center crosses, i.e. a crossing number test against a handful of
+    edges instead of whole rings. Points whose segment touches an edge or vertex exactly are left to GEOS, so that
+    results match shapely.contains_xy, points on the boundary included.
+
+    The grid pays off for large polygons tested against many points at once, see use_for. Other geometries than
+    valid polygons are not supported, see build
+    '''
+
+    # polygons with fewer vertices, or batches with fewer points per vertex, are faster with a prepared GEOS test
+    MIN_VERTICES = 512
+    MIN_WORK = 1 << 17
+    # grid cells per ring edge, and the largest number of cells along an axis
+    _CELLS_PER_EDGE = 2
+    _MAX_SIZE = 256
+
+    def __init__(self, poly: Polygon, size: int = None):
+        self.poly = poly
+        rings = [np.asarray(poly.exterior.coords)[:, :2]] + [np.asarray(r.coords)[:, :2] for r in poly.interiors]
+        edges = np.concatenate([np.hstack([ring[:-1], ring[1:]]) for ring in rings])
+        self.vertices = len(edges)
+        if size is None:
+            size = int(np.clip(np.ceil(np.sqrt(len(edges) * self._CELLS_PER_EDGE)), 1, self._MAX_SIZE))
+        self.size = size
+        min_x, min_y, max_x, max_y = poly.bounds
+        self.origin = (min_x, min_y)
+        self.cell_size = (max((max_x - min_x) / size, np.finfo(np.float64).tiny),
+                          max((max_y - min_y) / size, np.finfo(np.float64).tiny))
+
+        # cell ranges of every edge's bounding box, padded so that rounding never drops an edge from a cell
+        x0, x1 = self.__cells(np.minimum(edges[:, 0], edges[:, 2]), 0, -1e-9), \
+            self.__cells(np.maximum(edges[:, 0], edges[:, 2]), 0, 1e-9)
+        y0, y1 = self.__cells(np.minimum(edges[:, 1], edges[:, 3]), 1, -1e-9), \
+            self.__cells(np.maximum(edges[:, 1], edges[:, 3]), 1, 1e-9)
+        widths, counts = x1 - x0 + 1, (x1 - x0 + 1) * (y1 - y0 + 1)
+        k = expand_ranges(np.zeros(len(edges), dtype=np.int64), counts)
+        cells = (np.repeat(y0, counts) + k // np.repeat(widths, counts)) * size + np.repeat(x0, counts) + \
+            k % np.repeat(widths, counts)
+        order = np.argsort(cells, kind="stable")
+        self.edges = edges[np.repeat(np.arange(len(edges)), counts)[order]]
+        self.offsets = np.searchsorted(cells[order], np.arange(size * size + 1))
+
+        xs, ys = np.meshgrid(min_x + (np.arange(size) + 0.5) * self.cell_size[0],
+                             min_y + (np.arange(size) + 0.5) * self.cell_size[1])
+        self.centers = np.stack([xs.ravel(), ys.ravel()], axis=1)
+        shapely.prepare(poly)
+        self.inside = shapely.contains_xy(poly, self.centers[:, 0], self.centers[:, 1])
+
+    def __cells(self, values: np.ndarray, axis: int, pad: float) -> np.ndarray:
+        cells = np.floor((values - self.origin[axis]) / self.cell_size[axis] + pad)
+        return np.clip(cells, 0, self.size - 1).astype(np.int64)
+
+    @classmethod
+    def build(cls, geometry) -> Union['EdgeGrid', None]:
+        """Grid of a valid Polygon with at least MIN_VERTICES vertices, None for any other geometry"""
+        if geometry is None or geometry.geom_type != "Polygon" or geometry.is_empty:
+            return None
+        if shapely.get_num_coordinates(geometry) < cls.MIN_VERTICES or not geometry.is_valid:
+            return None
+        return cls(geometry)
+
+    def use_for(self, point_count: int) -> bool:
+        """Whether a batch of point_count points is faster on the grid than with GEOS"""
+        return point_count * self.vertices >= self.MIN_WORK
+
+    def contains_xy(self, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        """Whether each point lies in the interior of the polygon, as shapely.contains_xy"""
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        out = np.zeros(len(xs), dtype=bool)
+        cx = np.floor((xs - self.origin[0]) / self.cell_size[0])
+        cy = np.floor((ys - self.origin[1]) / self.cell_size[1])
+        pts = np.flatnonzero((cx >= 0) & (cx < self.size) & (cy >= 0) & (cy < self.size))
+        if len(pts) == 0:
+            return out
+        cells = cy[pts].astype(np.int64) * self.size + cx[pts].astype(np.int64)
+        inside = self.inside[cells]
+
+        starts = self.offsets[cells]
+        counts = self.offsets[cells + 1] - starts
+        pairs = np.repeat(np.arange(len(pts)), counts)
+        edges = self.edges[expand_ranges(starts, counts)]
+        px, py = xs[pts][pairs], ys[pts][pairs]
+        qx, qy = self.centers[cells[pairs], 0], self.centers[cells[pairs], 1]
+        ax, ay, bx, by = edges[:, 0], edges[:, 1], edges[:, 2], edges[:, 3]
+        d1, u1 = _orientation(ax, ay, bx, by, px, py)
+        d2, u2 = _orientation(ax, ay, bx, by, qx, qy)
+        d3, u3 = _orientation(px, py, qx, qy, ax, ay)
+        d4, u4 = _orientation(px, py, qx, qy, bx, by)
+        crossed = ((d1 > 0) != (d2 > 0)) & ((d3 > 0) != (d4 > 0))
+        inside ^= np.bincount(pairs[crossed], minlength=len(pts)) % 2 == 1
+        # touching, collinear or nearly so: the crossing count is unreliable, ask GEOS
+        exact = np.bincount(pairs[u1 | u2 | u3 | u4], minlength=len(pts)) > 0
+        if exact.any():
+            inside[exact] = shapely.contains_xy(self.poly, xs[pts[exact]], ys[pts[exact]])
+        out[pts] = inside
+        return out
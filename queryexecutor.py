@@ -0,0 +1,149 @@
+import multiprocessing
+import os
+import tempfile
+from typing import List, Tuple
+
+import numpy as np
+from pandas import DataFrame
+from shapely.geometry import Point
+
+import geohashes
+import indexfile
+from geotrieindex import GeoTrieIndex
+from spatialindex import SpatialIndex, collect_pairs
+from strtreeindex import STRTreeIndex
+
+# index classes by the kind written in the header of their index files
+INDEX_KINDS = {"geotrie": GeoTrieIndex, "strtree": STRTreeIndex}
+
+# index of a worker process, loaded once by _init_worker
+_worker_index: SpatialIndex = None
+
+
+def load_index(path: str) -> SpatialIndex:
+    """Maps an index file written by the save of any index kind"""
+    kind = indexfile.read_header(path).get("kind")
+    if kind not in INDEX_KINDS:
+        raise ValueError("unsupported index kind {}: {}".format(kind, path))
+    return INDEX_KINDS[kind].load(path)
+
+
+def process_memory(pid: int) -> Tuple[int, int]:
+    """
+    (rss, pss) of a process in bytes. Pages of a mapped index file count fully in the RSS of every process mapping
+    them, and are split between those processes in their PSS. Read from /proc, (None, None) where it is missing
+    """
+    try:
+        with open("/proc/{}/smaps_rollup".format(pid)) as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+    except OSError:
+        return None, None
+    return tuple(int(fields[name].split()[0]) * 1024 if name in fields else None for name in ("Rss", "Pss"))
+
+
+def _init_worker(path: str):
+    global _worker_index
+    _worker_index = load_index(path)
+
+
+def _lookup_batch(batch: Tuple[int, np.ndarray, np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    start, lons, lats = batch
+    points, pids = _worker_index.lookup_many(lons, lats)
+    return points + start, pids
+
+
+class QueryExecutor(SpatialIndex):
+    '''
+    Batched lookups fanned out to a pool of worker processes sharing one index.
+
+    Every worker maps the same index file (see indexfile), so the cell and tree arrays and the WKB of the polygons
+    are held once in the page cache whatever the number of workers. Only the polygons a worker decodes for its
+    exact tests, and its lookup caches, are private to it. lookup_many orders the points along a hilbert curve and
+    splits them into batches of batch_size, so that a batch falls on few polygons, and gathers the results of the
+    workers in input order; everything else runs on an index mapped in this process, so sjoin_points joins over
+    the workers too.
+
+    Workers are spawned, not forked, so that they never inherit the memory of an index built in this process.
+    Close the executor, or use it as a context manager, to stop the workers.
+    '''
+
+    # geohash precision of the hilbert order of batched points
+    _ORDER_PRECISION = 6
+
+    def __init__(self, index, workers: int = None, batch_size: int = 16384, start_method: str = "spawn"):
+        """index is a built index, written to a temporary file for the workers, or the path of an index file"""
+        if batch_size <= 0:
+            raise ValueError("batch_size must be positive")
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.__temp_path = None
+        if isinstance(index, SpatialIndex):
+            fd, self.__temp_path = tempfile.mkstemp(suffix=".idx")
+            os.close(fd)
+            index.save(self.__temp_path)
+            self.path = self.__temp_path
+        else:
+            self.path = index
+        self.index = load_index(self.path)
+        ctx = multiprocessing.get_context(start_method)
+        before = set(multiprocessing.active_children())
+        self.__pool = ctx.Pool(self.workers, initializer=_init_worker, initargs=(self.path,))
+        self.__worker_pids = [p.pid for p in multiprocessing.active_children() if p not in before]
+
+    def close(self):
+        """Stops the workers and removes the temporary index file, if any"""
+        if self.__pool is not None:
+            self.__pool.terminate()
+            self.__pool.join()
+            self.__pool = None
+        if self.__temp_path is not None:
+            # the index of this process keeps its mapping, removing the file only unlinks it
+            os.remove(self.__temp_path)
+            self.__temp_path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def lookup(self, p: Point):
+        return self.index.lookup(p)
+
+    def lookup_many(self, lons: np.ndarray, lats: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        if self.__pool is None:
+            raise ValueError("executor is closed")
+        lons = np.asarray(lons, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+        order = np.argsort(geohashes.encode_many(lons, lats, self._ORDER_PRECISION), kind="stable")
+        lons, lats = lons[order], lats[order]
+        batches = ((start, lons[start:start + self.batch_size], lats[start:start + self.batch_size])
+                   for start in range(0, len(lons), self.batch_size))
+        point_chunks, pid_chunks = [], []
+        for points, pids in self.__pool.imap(_lookup_batch, batches):
+            point_chunks.append(order[points])
+            pid_chunks.append(pids)
+        return collect_pairs(point_chunks, pid_chunks)
+
+    def query_region(self, geometry, predicate: str = "intersects") -> List:
+        return self.index.query_region(geometry, predicate)
+
+    def nearest(self, point: Point, k: int = 1, max_distance: float = None):
+        return self.index.nearest(point, k, max_distance)
+
+    def metadata(self, pids, columns: List[str] = None) -> DataFrame:
+        return self.index.metadata(pids, columns)
+
+    def feature_ids(self, pids) -> np.ndarray:
+        return self.index.feature_ids(pids)
+
+    def stats(self) -> dict:
+        return self.index.stats()
+
+    def worker_memory(self) -> dict:
+        """Summed rss and pss of the workers, in bytes (see process_memory); None where /proc is missing"""
+        memory = [process_memory(pid) for pid in self.__worker_pids]
+        rss = [m[0] for m in memory]
+        pss = [m[1] for m in memory]
+        return {"workers": len(memory), "rss_bytes": None if None in rss else sum(rss),
+                "pss_bytes": None if None in pss else sum(pss)}
@@ -0,0 +1,64 @@
+from typing import Iterable, List, Tuple
+
+import numpy as np
+import shapely
+from geopandas import GeoDataFrame
+from pandas import DataFrame
+from shapely.geometry import Point
+from shapely.strtree import STRtree
+
+from featurereader import dataframe_features
+from geodatapoint import GeoDataPoint
+from metastore import MetaStore
+from spatialindex import SpatialIndex, collect_pairs, feature_polygons, polygon_feature_ids, polygon_metadata, \
+    REGION_PREDICATES
+
+
+class ShapelySTRtreeIndex(SpatialIndex):
+    """
+    shapely's STRtree over the polygons of a dataset, a read-only baseline for the benchmarks.
+    Polygon ids are positions in the tree, as in the other indexes
+    """
+
+    def __init__(self, node_capacity: int = 10):
+        self.node_capacity = node_capacity
+        self.tree = None
+        self.polygons: List[GeoDataPoint] = []
+        self.features = dict()
+        self.metas = MetaStore()
+
+    def build(self, geo_df: GeoDataFrame):
+        self.build_from_stream(dataframe_features(geo_df))
+
+    def build_from_stream(self, features: Iterable):
+        self.polygons = []
+        self.features = dict()
+        self.metas = MetaStore()
+        polygons = list(feature_polygons(features, self.polygons, self.features, self.metas))
+        self.metas.finalize()
+        self.tree = STRtree([gdp.poly for gdp in polygons], node_capacity=self.node_capacity)
+
+    def lookup(self, point: Point) -> List[GeoDataPoint]:
+        if self.tree is None:
+            raise ValueError("index is not built")
+        return [self.polygons[pid] for pid in sorted(self.tree.query(point, predicate="within").tolist())]
+
+    def lookup_many(self, lons: np.ndarray, lats: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        if self.tree is None:
+            raise ValueError("index is not built")
+        points, pids = self.tree.query(shapely.points(lons, lats), predicate="within")
+        return collect_pairs([points], [pids])
+
+    def query_region(self, geometry, predicate: str = "intersects") -> List[GeoDataPoint]:
+        if self.tree is None:
+            raise ValueError("index is not built")
+        if predicate not in REGION_PREDICATES:
+            raise Exception("Invalid predicate")
+        pids = self.tree.query(geometry, predicate="intersects" if predicate == "intersects" else "contains")
+        return [self.polygons[pid] for pid in sorted(pids.tolist())]
+
+    def metadata(self, pids, columns: List[str] = None) -> DataFrame:
+        return polygon_metadata(self.polygons, self.metas, pids, columns)
+
+    def feature_ids(self, pids) -> np.ndarray:
+        return polygon_feature_ids(self.polygons, pids)
@@ -0,0 +1,217 @@
+import os
+import tempfile
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import get_context
+from time import perf_counter, perf_counter_ns, time
+from typing import Iterator, List, Tuple, Type, Union
+
+import numpy as np
+from geopandas import GeoDataFrame
+from pandas import DataFrame
+from shapely.geometry import Point
+
+from featurereader import read_features
+from queryexecutor import load_index
+from spatialindex import SpatialIndex
+
+
+def _nice(niceness: int):
+    if niceness > 0 and hasattr(os, "nice"):
+        os.nice(niceness)
+
+
+def _build_snapshot(index_cls: Type[SpatialIndex], params: dict, source: Union[str, GeoDataFrame], path: str) -> float:
+    """Process pool task of SnapshotManager.refresh: builds an index from source and saves it, returns build seconds"""
+    start = perf_counter()
+    idx = index_cls(**params)
+    if isinstance(source, str):
+        idx.build_from_stream(read_features(source))
+    else:
+        idx.build(source)
+    seconds = perf_counter() - start
+    idx.save(path)
+    return seconds
+
+
+class Snapshot(object):
+    """One version of the index served by a SnapshotManager, with the queries running on it"""
+
+    def __init__(self, index: SpatialIndex, version: int, path: str, build_seconds: float, load_seconds: float):
+        self.index = index
+        self.version = version
+        self.path = path
+        self.build_seconds = build_seconds
+        self.load_seconds = load_seconds
+        # nanoseconds the current snapshot was held back by the swap, and wall clock time of the swap
+        self.swap_ns = None
+        self.swapped_at = None
+        self.in_flight = 0
+
+    def info(self) -> dict:
+        return {"version": self.version, "build_seconds": self.build_seconds, "load_seconds": self.load_seconds,
+                "swap_ns": self.swap_ns, "swapped_at": self.swapped_at, "in_flight": self.in_flight}
+
+
+class SnapshotManager(SpatialIndex):
+    '''
+    Serves lookups from the current snapshot of an index while new versions are built in the background.
+
+    refresh builds a new version in a separate process, niced so that it leaves cores to the queries, and saves it
+    to an index file of directory. A background thread maps that file, warms it (see warm) and swaps it in under a
+    lock held only for the pointer swap: queries started before the swap finish on the old snapshot, which is
+    reclaimed, i.e. dropped and its file removed, once the last of them is done. Queries go through the SpatialIndex
+    methods of the manager, or through acquire to run several queries on one snapshot. pids are only valid on the
+    snapshot that returned them: lookup_features resolves them to feature ids on it. Indexes must implement save
+    and load; refreshes run one at a time, in order.
+    '''
+
+    def __init__(self, index_cls: Type[SpatialIndex], params: dict = None, directory: str = None, warm: bool = True,
+                 build_niceness: int = 10, keep_files: bool = False):
+        self.index_cls = index_cls
+        self.params = dict(params or {})
+        self.directory = directory or tempfile.mkdtemp(prefix="snapshots-")
+        self.warm = warm
+        self.build_niceness = build_niceness
+        self.keep_files = keep_files
+        self.__lock = threading.Lock()
+        self.__current: Snapshot = None
+        self.__retired: List[Snapshot] = []
+        self.__versions = 0
+        self.__refresher = ThreadPoolExecutor(1)
+        self.__builder = None
+
+    @property
+    def version(self) -> int:
+        """Version of the current snapshot, 0 before the first refresh"""
+        current = self.__current
+        return 0 if current is None else current.version
+
+    def refresh(self, source: Union[str, GeoDataFrame], wait: bool = False) -> Union[Future, Snapshot]:
+        """
+        Builds a new version from source, a GeoDataFrame or a file read with featurereader.read_features, and swaps
+        it in. Returns a Future of the new Snapshot, or the Snapshot itself with wait
+        """
+        with self.__lock:
+            self.__versions += 1
+            version = self.__versions
+        future = self.__refresher.submit(self.__refresh, source, version)
+        return future.result() if wait else future
+
+    def __refresh(self, source: Union[str, GeoDataFrame], version: int) -> Snapshot:
+        path = os.path.join(self.directory, "snapshot-{}.idx".format(version))
+        if self.__builder is None:
+            self.__builder = ProcessPoolExecutor(1, get_context("spawn"), _nice, (self.build_niceness,))
+        build_seconds = self.__builder.submit(_build_snapshot, self.index_cls, self.params, source, path).result()
+        start = perf_counter()
+        idx = load_index(path)
+        if self.warm:
+            self.__warm(idx)
+        snapshot = Snapshot(idx, version, path, build_seconds, perf_counter() - start)
+        self.__swap(snapshot)
+        return snapshot
+
+    @staticmethod
+    def __warm(idx: SpatialIndex):
+        """Decodes and prepares every polygon and cell clip of a loaded index, so that its first queries do not pay"""
+        for gdp in idx.polygons:
+            if gdp is not None:
+                gdp.prepare()
+        clips = getattr(getattr(idx, "gt", None), "clips", None)
+        if clips is not None:
+            for _ in clips:
+                pass
+
+    def __swap(self, snapshot: Snapshot):
+        begin = perf_counter_ns()
+        with self.__lock:
+            old, self.__current = self.__current, snapshot
+            if old is not None:
+                self.__retired.append(old)
+        snapshot.swap_ns = perf_counter_ns() - begin
+        snapshot.swapped_at = time()
+        self.__reclaim()
+
+    def __reclaim(self):
+        with self.__lock:
+            drained = [s for s in self.__retired if s.in_flight == 0]
+            self.__retired = [s for s in self.__retired if s.in_flight > 0]
+        for snapshot in drained:
+            snapshot.index = None
+            if not self.keep_files and os.path.exists(snapshot.path):
+                # pages still mapped by the dropped index stay valid until it is collected
+                os.remove(snapshot.path)
+
+    @contextmanager
+    def acquire(self) -> Iterator[SpatialIndex]:
+        """Index of the current snapshot, kept alive until the block exits"""
+        with self.__lock:
+            snapshot = self.__current
+            if snapshot is None:
+                raise ValueError("index is not built")
+            snapshot.in_flight += 1
+        try:
+            yield snapshot.index
+        finally:
+            with self.__lock:
+                snapshot.in_flight -= 1
+                drained = snapshot.in_flight == 0 and snapshot is not self.__current
+            if drained:
+                self.__reclaim()
+
+    def snapshots(self) -> dict:
+        """Info of the current snapshot (see Snapshot.info) and of retired snapshots still serving queries"""
+        with self.__lock:
+            current, retired = self.__current, list(self.__retired)
+        return {"current": None if current is None else current.info(), "retired": [s.info() for s in retired]}
+
+    def close(self):
+        """Waits for running refreshes and stops the build process; snapshots keep serving"""
+        self.__refresher.shutdown()
+        if self.__builder is not None:
+            self.__builder.shutdown()
+            self.__builder = None
+
+    def lookup(self, p: Point):
+        with self.acquire() as idx:
+            return idx.lookup(p)
+
+    def lookup_many(self, lons: np.ndarray, lats: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        with self.acquire() as idx:
+            return idx.lookup_many(lons, lats)
+
+    def lookup_features(self, lons: np.ndarray, lats: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """SpatialIndex.lookup_features, the ids resolved on the snapshot that ran the lookup"""
+        with self.acquire() as idx:
+            return idx.lookup_features(lons, lats)
+
+    def query_region(self, geometry, predicate: str = "intersects") -> List:
+        with self.acquire() as idx:
+            return idx.query_region(geometry, predicate)
+
+    def nearest(self, point: Point, k: int = 1, max_distance: float = None):
+        with self.acquire() as idx:
+            return idx.nearest(point, k, max_distance)
+
+    def metadata(self, pids, columns: List[str] = None) -> DataFrame:
+        """
+        Attributes of pids on the current snapshot, which may not be the one that returned them: resolve pids
+        within one acquire block, or use lookup_features
+        """
+        with self.acquire() as idx:
+            return idx.metadata(pids, columns)
+
+    def feature_ids(self, pids) -> np.ndarray:
+        """Feature ids of pids on the current snapshot, see metadata"""
+        with self.acquire() as idx:
+            return idx.feature_ids(pids)
+
+    def sjoin_points(self, points_df, lon_col: str, lat_col: str, **kwargs) -> Iterator[DataFrame]:
+        """SpatialIndex.sjoin_points, every chunk joined against the snapshot current when the join started"""
+        with self.acquire() as idx:
+            yield from idx.sjoin_points(points_df, lon_col, lat_col, **kwargs)
+
+    def stats(self) -> dict:
+        with self.acquire() as idx:
+            return dict(idx.stats(), snapshots=self.snapshots())
@@ -1,5 +1,21 @@
+from time import perf_counter_ns
+from typing import Any, Dict, Iterable, Iterator, List, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import shapely
 from geopandas import GeoDataFrame
-from shapely.geometry import Point
+from pandas import DataFrame
+from shapely.geometry import Point, shape
+from shapely.geometry.base import BaseGeometry
+
+from geodatapoint import GeoDataPoint, polygon_parts
+from indexstats import LookupHook, LookupTrace
+from metastore import MetaStore
+
+REGION_PREDICATES = ("intersects", "within")
+JOIN_TYPES = ("inner", "left")
+JOIN_MATCHES = ("all", "one")
 
 
 class SpatialIndex(object):
@@ -8,8 +24,273 @@ class SpatialIndex(object):
     def build(self, gdf: GeoDataFrame):
         raise NotImplementedError("build index is not implemented")
 
+    def build_from_stream(self, features: Iterable):
+        """Builds the index from GeoJSON like features (see parse_feature and featurereader), read one at a time"""
+        raise NotImplementedError("streaming build is not implemented")
+
     def lookup(self, p: Point):
         raise NotImplementedError("lookup index is not implemented")
 
+    def lookup_many(self, lons: np.ndarray, lats: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns parallel arrays of (point index, polygon id) for every polygon containing a point"""
+        raise NotImplementedError("batched lookup index is not implemented")
+
+    def lookup_features(self, lons: np.ndarray, lats: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """lookup_many with its polygon ids resolved to feature ids: parallel arrays of (point index, feature id)"""
+        points, pids = self.lookup_many(lons, lats)
+        return points, self.feature_ids(pids)
+
+    def query_region(self, geometry: BaseGeometry, predicate: str = "intersects") -> List:
+        """Polygons intersecting (predicate="intersects") or lying within (predicate="within") geometry"""
+        raise NotImplementedError("region query is not implemented")
+
+    def nearest(self, point: Point, k: int = 1, max_distance: float = None) -> List[Tuple[Any, float]]:
+        """
+        (polygon, distance) pairs of the k features nearest to point, closest first, one polygon per feature.
+        Distances are planar, in degrees, and 0 for polygons containing the point
+        """
+        raise NotImplementedError("nearest is not implemented")
+
+    def metadata(self, pids, columns: List[str] = None) -> DataFrame:
+        """Attributes of the features of polygons pids (e.g. from lookup_many), one row per pid"""
+        raise NotImplementedError("metadata is not implemented")
+
+    def feature_ids(self, pids) -> np.ndarray:
+        """Ids of the features of polygons pids, as an object array"""
+        raise NotImplementedError("feature ids are not implemented")
+
+    def sjoin_points(self, points_df: Union[DataFrame, Iterable[DataFrame]], lon_col: str, lat_col: str,
+                     chunk_size: int = 1 << 16, how: str = "inner", matches: str = "all", columns: List[str] = None,
+                     fid_col: str = "feature_id", rsuffix: str = "_right") -> Iterator[DataFrame]:
+        """
+        Spatial join of points against the indexed features, one DataFrame per chunk of chunk_size points.
+
+        points_df is a DataFrame, or an iterable of them (e.g. pandas.read_csv(..., chunksize=n)) so that the input
+        never has to be held in memory at once. Every output row holds the columns of a point, under its index label,
+        the id of a feature containing it in fid_col and the feature attributes in columns (all of them if None);
+        attributes named as a point column get rsuffix. how="inner" drops points outside every feature, how="left"
+        keeps them with missing feature values. matches="all" yields a row per (point, feature), matches="one" only
+        the feature of its smallest polygon id. Use pandas.concat over the chunks for a single DataFrame
+        """
+        if how not in JOIN_TYPES:
+            raise Exception("Invalid join type")
+        if matches not in JOIN_MATCHES:
+            raise Exception("Invalid match mode")
+        if chunk_size <= 0:
+            raise ValueError("chunk_size must be positive")
+        frames = [points_df] if isinstance(points_df, DataFrame) else points_df
+        for frame in frames:
+            for start in range(0, len(frame), chunk_size):
+                yield self.__join_chunk(frame.iloc[start:start + chunk_size], lon_col, lat_col, how, matches, columns,
+                                        fid_col, rsuffix)
+
+    def __join_chunk(self, chunk: DataFrame, lon_col: str, lat_col: str, how: str, matches: str,
+                     columns: List[str], fid_col: str, rsuffix: str) -> DataFrame:
+        lons = chunk[lon_col].to_numpy(dtype=np.float64)
+        lats = chunk[lat_col].to_numpy(dtype=np.float64)
+        points, pids = self.lookup_many(lons, lats)
+
+        # attributes are read once per distinct polygon of the chunk, pairs index into them
+        unique_pids, inverse = np.unique(pids, return_inverse=True)
+        fids = self.feature_ids(unique_pids)
+        codes, distinct_fids = pd.factorize(fids)
+        pair_codes = codes[inverse]
+        # pairs are ordered by point, then polygon id: keep the first pair of every (point, feature)
+        keep = np.ones(len(points), dtype=bool)
+        if matches == "one":
+            keep[1:] = points[1:] != points[:-1]
+        elif len(points) > 1:
+            _, first = np.unique(points * max(len(distinct_fids), 1) + pair_codes, return_index=True)
+            keep[:] = False
+            keep[first] = True
+        points, slots = points[keep], inverse[keep]
+
+        if how == "left":
+            missing = np.ones(len(chunk), dtype=bool)
+            missing[points] = False
+            outside = np.flatnonzero(missing)
+            order = np.argsort(np.concatenate([points, outside]), kind="stable")
+            points = np.concatenate([points, outside])[order]
+            slots = np.concatenate([slots, np.full(len(outside), -1, dtype=slots.dtype)])[order]
+
+        out = chunk.iloc[points].copy()
+        matched = slots >= 0
+        feature_ids = np.empty(len(slots), dtype=object)
+        feature_ids[matched] = fids[slots[matched]]
+        out[fid_col] = feature_ids
+        meta = self.metadata(unique_pids, columns).reset_index(drop=True)
+        meta = meta.reindex(np.where(matched, slots, -1)) if not matched.all() else meta.iloc[slots]
+        for name in meta.columns:
+            out[name + rsuffix if name in chunk.columns or name == fid_col else name] = meta[name].to_numpy()
+        return out
+
+    def insert(self, feature) -> Any:
+        raise NotImplementedError("insert is not implemented")
+
+    def delete(self, feature_id):
+        raise NotImplementedError("delete is not implemented")
+
+    def update(self, feature_id, geometry: BaseGeometry = None, meta: dict = None):
+        raise NotImplementedError("update is not implemented")
+
+    def save(self, path: str):
+        raise NotImplementedError("save index is not implemented")
+
+    @classmethod
+    def load(cls, path: str):
+        raise NotImplementedError("load index is not implemented")
+
     def show(self):
         raise NotImplementedError("show index is not implemented")
+
+    def stats(self) -> dict:
+        """Size and shape of the index structures"""
+        raise NotImplementedError("stats is not implemented")
+
+    def _traced_lookup(self, p: Point, trace: LookupTrace):
+        """lookup, filling the counters of trace"""
+        raise NotImplementedError("traced lookup is not implemented")
+
+    def set_lookup_hook(self, hook: LookupHook = None):
+        """
+        Calls hook with a LookupTrace after every lookup; None removes it. The hook replaces lookup on the instance
+        by a traced variant, so that lookups run without any instrumentation while no hook is installed
+        """
+        if hook is None:
+            self.__dict__.pop("lookup", None)
+            return
+
+        def lookup(p: Point):
+            trace = LookupTrace()
+            start = perf_counter_ns()
+            containers = self._traced_lookup(p, trace)
+            trace.total_ns = perf_counter_ns() - start
+            trace.results = len(containers)
+            hook(trace)
+            return containers
+
+        self.lookup = lookup
+
+
+def collect_pairs(point_chunks: List[np.ndarray], pid_chunks: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """Concatenates (point index, polygon id) chunks into arrays ordered by point index, then polygon id"""
+    if len(point_chunks) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32)
+    points = np.concatenate(point_chunks).astype(np.int64, copy=False)
+    pids = np.concatenate(pid_chunks).astype(np.int32, copy=False)
+    order = np.lexsort((pids, points))
+    return points[order], pids[order]
+
+
+def refine_region(geometry: BaseGeometry, polygons: List, predicate: str) -> np.ndarray:
+    """Mask of the GeoDataPoints satisfying predicate against a prepared geometry"""
+    if len(polygons) == 0:
+        return np.zeros(0, dtype=bool)
+    if predicate == "intersects":
+        return shapely.intersects(geometry, [gdp.poly for gdp in polygons])
+    if predicate == "within":
+        # polygons sticking out of the query's bounding box cannot lie within it
+        min_lon, min_lat, max_lon, max_lat = geometry.bounds
+        bounds = np.array([gdp.bbox for gdp in polygons]).reshape(-1, 4)
+        mask = (bounds[:, 0] >= min_lon) & (bounds[:, 1] >= min_lat) & (bounds[:, 2] <= max_lon) & \
+            (bounds[:, 3] <= max_lat)
+        if mask.any():
+            mask[mask] = shapely.contains(geometry, [gdp.poly for gdp, m in zip(polygons, mask) if m])
+        return mask
+    raise Exception("Invalid predicate")
+
+
+def nearest_features(polygons: List, distances: np.ndarray, k: int,
+                     max_distance: float = None) -> List[Tuple[Any, float]]:
+    """The k closest GeoDataPoints with distinct feature ids, as (polygon, distance) pairs"""
+    out, seen = [], set()
+    for i in np.lexsort(([gdp.pid for gdp in polygons], distances)).tolist():
+        if len(out) == k or (max_distance is not None and distances[i] > max_distance):
+            break
+        if polygons[i].fid not in seen:
+            seen.add(polygons[i].fid)
+            out.append((polygons[i], float(distances[i])))
+    return out
+
+
+def parse_feature(feature) -> Tuple[Any, BaseGeometry, dict]:
+    """
+    (id, geometry, properties) of a GeoJSON like feature mapping. The geometry may be a shapely geometry or a
+    GeoJSON geometry mapping; id is None when the feature has none
+    """
+    geometry = feature["geometry"]
+    if not isinstance(geometry, BaseGeometry):
+        geometry = shape(geometry)
+    return feature.get("id"), geometry, dict(feature.get("properties") or {})
+
+
+def feature_map(polygons: List) -> Dict[Any, List[int]]:
+    """Feature id -> pids of its polygons, skipping deleted (None) polygons"""
+    features = dict()
+    for gdp in polygons:
+        if gdp is not None:
+            features.setdefault(gdp.fid, []).append(gdp.pid)
+    return features
+
+
+def needs_compaction(polygons: List, metas: MetaStore) -> bool:
+    """Whether polygons holds deleted (None) polygons, or metas rows that no polygon references"""
+    live = [gdp for gdp in polygons if gdp is not None]
+    return len(live) < len(polygons) or len(set(gdp.row for gdp in live)) < len(metas)
+
+
+def compaction(polygons: List, metas: MetaStore) -> Tuple[np.ndarray, np.ndarray, MetaStore]:
+    """
+    Renumbering that drops deleted (None) polygons and unreferenced attribute rows: the new pid of every pid (-1 for
+    deleted polygons), the new row of every live polygon in pid order, and the store holding those rows. Neither
+    polygons nor metas are changed
+    """
+    live = [gdp for gdp in polygons if gdp is not None]
+    store, rows = metas.compact([gdp.row for gdp in live])
+    pids = np.full(len(polygons), -1, dtype=np.int32)
+    pids[np.array([gdp.pid for gdp in live], dtype=np.int64)] = np.arange(len(live), dtype=np.int32)
+    return pids, rows, store
+
+
+def next_feature_id(features: Dict[Any, List[int]]) -> int:
+    """Smallest integer id above every integer feature id in use"""
+    return max((fid + 1 for fid in features if isinstance(fid, (int, np.integer))), default=0)
+
+
+def feature_polygons(features: Iterable, polygons: List, feature_pids: Dict[Any, List[int]],
+                     metas: MetaStore) -> Iterator[GeoDataPoint]:
+    """
+    GeoDataPoints of a stream of GeoJSON like features, parsed one at a time. Feature attributes are appended to
+    metas, and every GeoDataPoint is appended to polygons and registered in feature_pids before it is yielded.
+    Features without an id are numbered by their position in the stream, features without a geometry are skipped
+    """
+    for i, feature in enumerate(features):
+        if feature.get("geometry") is None:
+            continue
+        fid, geometry, meta = parse_feature(feature)
+        if fid is None:
+            fid = i
+        if fid in feature_pids:
+            raise KeyError("feature {} is already indexed".format(fid))
+        pids = feature_pids[fid] = []
+        row = metas.append(meta)
+        for part, poly in enumerate(polygon_parts(geometry)):
+            gdp = GeoDataPoint(None, poly, len(polygons), fid, part, row, metas)
+            polygons.append(gdp)
+            pids.append(gdp.pid)
+            yield gdp
+
+
+def polygon_feature_ids(polygons: List, pids) -> np.ndarray:
+    """Feature ids of polygons pids, as an object array"""
+    out = np.empty(len(pids), dtype=object)
+    for i, pid in enumerate(np.asarray(pids, dtype=np.int64).tolist()):
+        out[i] = polygons[pid].fid
+    return out
+
+
+def polygon_metadata(polygons: List, metas: MetaStore, pids, columns: List[str] = None) -> DataFrame:
+    """Attributes of the features of polygons pids, one row per pid"""
+    pids = np.asarray(pids, dtype=np.int64)
+    rows = [polygons[pid].row for pid in pids.tolist()]
+    return metas.frame(rows, columns, index=pids)
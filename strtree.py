@@ -1,20 +1,37 @@
 from abc import ABC
-from typing import List, Union
+from typing import Dict, List, Tuple, Union
 
+import numpy as np
+import shapely
 from shapely.geometry import Point, Polygon
 
+import geohashes
 from geodatapoint import GeoDataPoint
 from basegeometrypoint import BaseGeometryPoint
+from indexstats import LookupTrace, value_summary
+from spatialindex import refine_region, nearest_features
 
-from math import ceil, sqrt
+from heapq import heappush, heappop
+from time import perf_counter_ns
+from itertools import count
+from math import ceil, sqrt, hypot
 
 
 class RTreeNode(BaseGeometryPoint):
     def __init__(self, entries: List[BaseGeometryPoint], mbr: (float, float, float, float)):
         self.entries = entries
         self.mbr = mbr
-        poly_coords = [(mbr[0], mbr[1]), (mbr[0], mbr[3]), (mbr[2], mbr[3]), (mbr[2], mbr[1])]
-        self._mbr_poly = Polygon(poly_coords)
+        self.__mbr_poly = None
+
+    @property
+    def _mbr_poly(self) -> Polygon:
+        # built on first use, so that loading a saved tree does not pay for a GEOS polygon per node
+        if self.__mbr_poly is None:
+            mbr = self.mbr
+            poly_coords = [(mbr[0], mbr[1]), (mbr[0], mbr[3]), (mbr[2], mbr[3]), (mbr[2], mbr[1])]
+            self.__mbr_poly = Polygon(poly_coords)
+            shapely.prepare(self.__mbr_poly)
+        return self.__mbr_poly
 
     def search(self, point: Point) -> List[GeoDataPoint]:
         if self.is_empty:
@@ -33,9 +50,82 @@ class RTreeNode(BaseGeometryPoint):
 
         return containers
 
+    def traced_search(self, point: Point, trace: LookupTrace) -> List[GeoDataPoint]:
+        """search, counting nodes entered, candidates and exact tests into trace"""
+        if self.is_empty or not self._mbr_poly.contains(point):
+            return []
+        trace.probes += 1
+        containers = []
+        for e in self.entries:
+            if isinstance(e, RTreeNode):
+                containers.extend(e.traced_search(point, trace))
+                continue
+            trace.candidates += 1
+            trace.pip_tests += 1
+            start = perf_counter_ns()
+            inside = e.contains(point)
+            trace.geos_ns += perf_counter_ns() - start
+            if inside:
+                containers.append(e)
+        return containers
+
+    def search_many(self, xs: np.ndarray, ys: np.ndarray, idx: np.ndarray, out: list):
+        """Appends (point indices, polygon) pairs for every polygon under this node containing some points"""
+        if self.is_empty:
+            return
+
+        mask = self.contains_many(xs, ys)
+        if not mask.any():
+            return
+        xs, ys, idx = xs[mask], ys[mask], idx[mask]
+
+        for e in self.entries:
+            if isinstance(e, RTreeNode):
+                e.search_many(xs, ys, idx, out)
+            else:
+                inside = e.contains_many(xs, ys)
+                if inside.any():
+                    out.append((idx[inside], e))
+
+    def search_region(self, geometry, bbox, within: bool, accepted: list, candidates: list):
+        """
+        Collects polygons under this node whose bounding box could satisfy the predicate into candidates. Whole
+        subtrees whose MBR lies inside the (prepared) query geometry go to accepted without any exact test
+        """
+        if self.is_empty or not _intersects(self.mbr, bbox):
+            return
+        if _covers(bbox, self.mbr) and geometry.contains(self._mbr_poly):
+            self.leaves(accepted)
+            return
+        for e in self.entries:
+            if isinstance(e, RTreeNode):
+                e.search_region(geometry, bbox, within, accepted, candidates)
+            elif _covers(bbox, e.bbox) if within else _intersects(bbox, e.bbox):
+                candidates.append(e)
+
+    def leaves(self, out: list):
+        """Appends all polygons under this node to out"""
+        for e in self.entries:
+            if isinstance(e, RTreeNode):
+                e.leaves(out)
+            else:
+                out.append(e)
+
     def contains(self, point: Point):
         return self._mbr_poly.contains(point)
 
+    def contains_many(self, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        min_lon, min_lat, max_lon, max_lat = self.mbr
+        return (xs >= min_lon) & (xs <= max_lon) & (ys >= min_lat) & (ys <= max_lat)
+
+    def set_mbr(self, mbr: (float, float, float, float)):
+        self.mbr = mbr
+        self.__mbr_poly = None
+
+    @property
+    def is_leaf(self):
+        return self.is_empty or not isinstance(self.entries[0], RTreeNode)
+
     @classmethod
     def empty_node(cls):
         return RTreeNode([], (0.0, 0.0, 0.0, 0.0))
@@ -53,11 +143,71 @@ class RTreeNode(BaseGeometryPoint):
         raise NotImplementedError("centroid of RTreeNode is not implemented")
 
 
+def _union(a, b):
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+
+def _area(mbr):
+    return (mbr[2] - mbr[0]) * (mbr[3] - mbr[1])
+
+
+def _margin(mbr):
+    return (mbr[2] - mbr[0]) + (mbr[3] - mbr[1])
+
+
+def _overlap(a, b):
+    w = min(a[2], b[2]) - max(a[0], b[0])
+    h = min(a[3], b[3]) - max(a[1], b[1])
+    return w * h if w > 0 and h > 0 else 0.0
+
+
+def _mbr_distance(mbr, x: float, y: float) -> float:
+    return hypot(max(mbr[0] - x, 0.0, x - mbr[2]), max(mbr[1] - y, 0.0, y - mbr[3]))
+
+
+def _intersects(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def _covers(a, b):
+    return a[0] <= b[0] and a[1] <= b[1] and a[2] >= b[2] and a[3] >= b[3]
+
+
+def hilbert_order(mbrs: np.ndarray) -> np.ndarray:
+    """Order of (n, 4) bounding boxes along the hilbert curve through their centers"""
+    codes = geohashes.encode_many((mbrs[:, 0] + mbrs[:, 2]) / 2, (mbrs[:, 1] + mbrs[:, 3]) / 2, geohashes.MAX_PRECISION)
+    return np.argsort(codes, kind="stable")
+
+
+def _entries_mbr(entries: List[BaseGeometryPoint]):
+    mbr = entries[0].bbox
+    for e in entries[1:]:
+        mbr = _union(mbr, e.bbox)
+    return mbr
+
+
 class STRTree(object):
-    def __init__(self, node_capacity: int = 10):
+    '''
+    Sort-Tile-Recursive packed R-tree.
+
+    The tree can also be updated in place: insertions follow R* (least enlargement subtree choice, margin/overlap
+    driven node splits), deletions tighten MBRs on the way up. Since dynamic updates degrade the packing, the tree
+    is repacked once the number of updates since the last pack exceeds repack_ratio of its size.
+
+    Two bulk loaders are provided:
+    STR_PACKING: sorts entries by x into vertical slices, then by y within every slice
+    HILBERT_PACKING: sorts entries by the hilbert code of their centers and packs them in that order
+    '''
+    STR_PACKING = 1
+    HILBERT_PACKING = 2
+
+    def __init__(self, node_capacity: int = 10, repack_ratio: float = 0.25, packing=STR_PACKING):
         self._node_capacity = node_capacity
+        self._packing = packing
         self._root: RTreeNode = None
         self._total_polygons = 0
+        self._repack_ratio = repack_ratio
+        self._updates = 0
 
     @staticmethod
     def __pack_node(cls, level: List[BaseGeometryPoint]):
@@ -79,9 +229,18 @@ class STRTree(object):
         if level_len == 0:
             return RTreeNode.empty_node()
 
-        if len(level) < self._node_capacity:
+        if len(level) <= self._node_capacity:
             return self.__pack_node(self, level)
 
+        if self._packing == self.HILBERT_PACKING:
+            order = hilbert_order(np.array([e.bbox for e in level], dtype=np.float64))
+            level = [level[i] for i in order.tolist()]
+            next_level = [self.__pack_node(self, level[i:i + self._node_capacity])
+                          for i in range(0, level_len, self._node_capacity)]
+            return self.__pack_level(next_level)
+        elif self._packing != self.STR_PACKING:
+            raise Exception("Invalid packing")
+
         level.sort(key=lambda pt: pt.bbox[0] + pt.bbox[2])
 
         node_count = ceil(level_len / self._node_capacity)
@@ -93,7 +252,7 @@ class STRTree(object):
             if i >= level_len:
                 break
             slice_end = min(level_len, i + slice_capacity)
-            level[i:slice_end].sort(key=lambda pt: pt.bbox[1] + pt.bbox[3])
+            level[i:slice_end] = sorted(level[i:slice_end], key=lambda pt: pt.bbox[1] + pt.bbox[3])
             while i < slice_end:
                 pack_end = min(level_len, i + self._node_capacity)
                 next_level.append(self.__pack_node(self, level[i:pack_end]))
@@ -103,11 +262,327 @@ class STRTree(object):
 
     def build(self, polygons: List[GeoDataPoint]):
         self._total_polygons = len(polygons)
+        self._updates = 0
         self._root = self.__pack_level(polygons)
 
+    @staticmethod
+    def __choose_subtree(node: RTreeNode, bbox) -> RTreeNode:
+        best, best_cost = None, None
+        for child in node.entries:
+            area = _area(child.mbr)
+            cost = (_area(_union(child.mbr, bbox)) - area, area)
+            if best_cost is None or cost < best_cost:
+                best, best_cost = child, cost
+        return best
+
+    def __split(self, node: RTreeNode) -> RTreeNode:
+        """R* split: pick the axis with least total margin, then the distribution with least overlap"""
+        min_fill = max(1, ceil(0.4 * self._node_capacity))
+        entries = node.entries
+        best_axis, best_margin = None, None
+        for axis in (0, 1):
+            ordered = sorted(entries, key=lambda e: e.bbox[axis] + e.bbox[axis + 2])
+            margin = 0.0
+            for k in range(min_fill, len(ordered) - min_fill + 1):
+                margin += _margin(_entries_mbr(ordered[:k])) + _margin(_entries_mbr(ordered[k:]))
+            if best_margin is None or margin < best_margin:
+                best_axis, best_margin = ordered, margin
+
+        best_k, best_cost = None, None
+        for k in range(min_fill, len(best_axis) - min_fill + 1):
+            left, right = _entries_mbr(best_axis[:k]), _entries_mbr(best_axis[k:])
+            cost = (_overlap(left, right), _area(left) + _area(right))
+            if best_cost is None or cost < best_cost:
+                best_k, best_cost = k, cost
+
+        node.entries = best_axis[:best_k]
+        node.set_mbr(_entries_mbr(node.entries))
+        return RTreeNode(best_axis[best_k:], _entries_mbr(best_axis[best_k:]))
+
+    def __insert(self, node: RTreeNode, gdp: GeoDataPoint, bbox) -> Union[RTreeNode, None]:
+        """Inserts under node; returns the new sibling if node had to be split"""
+        node.set_mbr(_union(node.mbr, bbox))
+        if node.is_leaf:
+            node.entries.append(gdp)
+        else:
+            split = self.__insert(self.__choose_subtree(node, bbox), gdp, bbox)
+            if split is not None:
+                node.entries.append(split)
+        if len(node.entries) > self._node_capacity:
+            return self.__split(node)
+        return None
+
+    def insert(self, gdp: GeoDataPoint):
+        if self._root is None or self._root.is_empty:
+            self._root = RTreeNode([gdp], gdp.bbox)
+        else:
+            split = self.__insert(self._root, gdp, gdp.bbox)
+            if split is not None:
+                self._root = self.__pack_node(self, [self._root, split])
+        self._total_polygons += 1
+        self._updates += 1
+
+    def __find_leaf(self, node: RTreeNode, gdp: GeoDataPoint, bbox, path: List[RTreeNode]) -> bool:
+        """Appends the path to the leaf holding gdp to path; returns whether it was found"""
+        path.append(node)
+        if node.is_leaf:
+            if any(e is gdp for e in node.entries):
+                return True
+        else:
+            for child in node.entries:
+                if _covers(child.mbr, bbox) and self.__find_leaf(child, gdp, bbox, path):
+                    return True
+        path.pop()
+        return False
+
+    def delete(self, gdp: GeoDataPoint) -> bool:
+        """Removes gdp, dropping nodes left empty and tightening MBRs on the path. Returns whether it was found"""
+        if self._root is None:
+            raise ValueError("index is not built")
+        path = []
+        if not self.__find_leaf(self._root, gdp, gdp.bbox, path):
+            return False
+        leaf = path[-1]
+        leaf.entries = [e for e in leaf.entries if e is not gdp]
+        for i in range(len(path) - 1, -1, -1):
+            node = path[i]
+            if node.is_empty and i > 0:
+                path[i - 1].entries.remove(node)
+            elif not node.is_empty:
+                node.set_mbr(_entries_mbr(node.entries))
+        if self._root.is_empty:
+            self._root = RTreeNode.empty_node()
+        self._total_polygons -= 1
+        self._updates += 1
+        return True
+
+    @property
+    def needs_repack(self) -> bool:
+        return self._updates > self._repack_ratio * max(1, self._total_polygons)
+
+    def polygons(self) -> List[GeoDataPoint]:
+        """All polygons in the tree"""
+        out = []
+        if self._root is not None:
+            self._root.leaves(out)
+        return out
+
+    def repack(self):
+        """Rebuilds the tree with STR packing from its current polygons"""
+        self.build(self.polygons())
+
     def search(self, point: Point) -> List[GeoDataPoint]:
         if self._root is None:
             raise ValueError("index is not built")
         return self._root.search(point)
 
+    def traced_search(self, point: Point, trace: LookupTrace) -> List[GeoDataPoint]:
+        if self._root is None:
+            raise ValueError("index is not built")
+        return self._root.traced_search(point, trace)
+
+    def search_many(self, xs: np.ndarray, ys: np.ndarray) -> List[Tuple[np.ndarray, GeoDataPoint]]:
+        if self._root is None:
+            raise ValueError("index is not built")
+        out = []
+        self._root.search_many(xs, ys, np.arange(len(xs)), out)
+        return out
+
+    def search_region(self, geometry, predicate: str) -> List[GeoDataPoint]:
+        """Polygons intersecting or lying within geometry, by an MBR pruned traversal and a batched exact test"""
+        if self._root is None:
+            raise ValueError("index is not built")
+        shapely.prepare(geometry)
+        accepted, candidates = [], []
+        self._root.search_region(geometry, geometry.bounds, predicate == "within", accepted, candidates)
+        mask = refine_region(geometry, candidates, predicate)
+        return accepted + [gdp for gdp, m in zip(candidates, mask) if m]
+
+    def nearest(self, point: Point, k: int = 1, max_distance: float = None) -> List[Tuple[GeoDataPoint, float]]:
+        """
+        Best-first search. Nodes and polygons are popped from a heap ordered by MBR distance, a polygon popped on
+        its MBR distance is pushed back with its exact distance, and polygons popped on their exact distance are
+        final, as nothing left in the heap can be closer
+        """
+        if self._root is None:
+            raise ValueError("index is not built")
+        x, y = point.coords[0]
+        tie = count()
+        heap = [(_mbr_distance(self._root.mbr, x, y), next(tie), self._root, False)]
+        polygons, distances, seen = [], [], set()
+        while len(heap) > 0 and len(polygons) < k:
+            distance, _, item, exact = heappop(heap)
+            if max_distance is not None and distance > max_distance:
+                break
+            if isinstance(item, RTreeNode):
+                for e in item.entries:
+                    heappush(heap, (_mbr_distance(e.bbox, x, y), next(tie), e, False))
+            elif not exact:
+                heappush(heap, (item.poly.distance(point), next(tie), item, True))
+            elif item.fid not in seen:
+                seen.add(item.fid)
+                polygons.append(item)
+                distances.append(distance)
+        return nearest_features(polygons, np.array(distances, dtype=np.float64), k, max_distance)
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        """
+        Flattens the tree in breadth first order. Children of a node are contiguous, starting at node_child_start:
+        node positions for inner nodes, positions in leaf_pids and leaf_mbr for leaves.
+        """
+        if self._root is None:
+            raise ValueError("index is not built")
+        nodes = [self._root]
+        mbrs, child_start, child_count, leaf, leaf_pids, leaf_mbr = [], [], [], [], [], []
+        i = 0
+        while i < len(nodes):
+            node = nodes[i]
+            i += 1
+            mbrs.append(node.mbr)
+            child_count.append(len(node.entries))
+            is_leaf = node.is_empty or not isinstance(node.entries[0], RTreeNode)
+            leaf.append(is_leaf)
+            if is_leaf:
+                child_start.append(len(leaf_pids))
+                leaf_pids.extend(e.pid for e in node.entries)
+                leaf_mbr.extend(e.bbox for e in node.entries)
+            else:
+                child_start.append(len(nodes))
+                nodes.extend(node.entries)
+        return {
+            "node_mbr": np.array(mbrs, dtype=np.float64).reshape(-1, 4),
+            "node_child_start": np.array(child_start, dtype=np.int64),
+            "node_child_count": np.array(child_count, dtype=np.int32),
+            "node_leaf": np.array(leaf, dtype=bool),
+            "leaf_pids": np.array(leaf_pids, dtype=np.int32),
+            "leaf_mbr": np.array(leaf_mbr, dtype=np.float64).reshape(-1, 4),
+        }
+
+    def stats(self) -> dict:
+        """
+        Shape of the tree, see tree_stats. Bytes are those of the tree flattened by to_arrays. Updates apply to the
+        nodes in place, updates counts those made since the tree was last packed
+        """
+        return dict(tree_stats(self.to_arrays()), updates=self._updates)
+
+    @classmethod
+    def from_arrays(cls, node_capacity: int, arrays: Dict[str, np.ndarray], polygons: List[GeoDataPoint],
+                    repack_ratio: float = 0.25, packing=STR_PACKING) -> 'STRTree':
+        """Rebuilds the tree flattened by to_arrays; polygons are indexed by pid"""
+        tree = cls(node_capacity, repack_ratio, packing)
+        node_mbr = arrays["node_mbr"].tolist()
+        child_start = arrays["node_child_start"].tolist()
+        child_count = arrays["node_child_count"].tolist()
+        node_leaf = arrays["node_leaf"].tolist()
+        leaf_pids = arrays["leaf_pids"].tolist()
+        nodes: List[RTreeNode] = [None] * len(node_mbr)
+        # children always come after their parent, so build from the back
+        for i in range(len(nodes) - 1, -1, -1):
+            start, end = child_start[i], child_start[i] + child_count[i]
+            if node_leaf[i]:
+                entries = [polygons[pid] for pid in leaf_pids[start:end]]
+            else:
+                entries = nodes[start:end]
+            nodes[i] = RTreeNode(entries, tuple(node_mbr[i]))
+        tree._root = nodes[0]
+        tree._total_polygons = len(leaf_pids)
+        return tree
+
+
+def tree_quality(arrays: Dict[str, np.ndarray], xs: np.ndarray, ys: np.ndarray) -> dict:
+    """
+    Quality report of a tree flattened by to_arrays.
+    overlap_area: total area shared by sibling nodes, dead_space: total area of nodes not covered by any child's MBR,
+    both also per depth and as a ratio of total node area. nodes_visited and entries_tested: average number of nodes
+    entered and of leaf entries reaching an exact test, for point queries at xs, ys
+    """
+    node_mbr, leaf_mbr = arrays["node_mbr"], arrays["leaf_mbr"]
+    child_start, child_count = arrays["node_child_start"], arrays["node_child_count"]
+    node_leaf = arrays["node_leaf"]
+    depth = np.zeros(len(node_mbr), dtype=np.int64)
+    overlap = np.zeros(len(node_mbr), dtype=np.float64)
+    dead_space = np.zeros(len(node_mbr), dtype=np.float64)
+    area = (node_mbr[:, 2] - node_mbr[:, 0]) * (node_mbr[:, 3] - node_mbr[:, 1])
+
+    # nodes are in breadth first order, so parents are seen before their children
+    for i in range(len(node_mbr)):
+        start, end = child_start[i], child_start[i] + child_count[i]
+        children = leaf_mbr[start:end] if node_leaf[i] else node_mbr[start:end]
+        if len(children) == 0:
+            continue
+        boxes = shapely.box(children[:, 0], children[:, 1], children[:, 2], children[:, 3])
+        dead_space[i] = area[i] - shapely.union_all(boxes).area
+        if not node_leaf[i]:
+            depth[start:end] = depth[i] + 1
+            for j in range(len(children) - 1):
+                w = np.minimum(children[j, 2], children[j + 1:, 2]) - np.maximum(children[j, 0], children[j + 1:, 0])
+                h = np.minimum(children[j, 3], children[j + 1:, 3]) - np.maximum(children[j, 1], children[j + 1:, 1])
+                # overlap among children is booked on the depth of the children
+                overlap[start + j] = np.sum(np.clip(w, 0, None) * np.clip(h, 0, None))
+
+    # queries are pushed down the tree together (see FlatSTRTree.search_many), so the cost follows the visits
+    nodes_visited, entries_tested = 0, 0
+    root = node_mbr[:1]
+    stack = [(0, np.flatnonzero((root[:, 0] <= xs) & (root[:, 2] >= xs) & (root[:, 1] <= ys) & (root[:, 3] >= ys)))]
+    while len(stack) > 0:
+        node, pts = stack.pop()
+        if len(pts) == 0:
+            continue
+        nodes_visited += len(pts)
+        start, end = child_start[node], child_start[node] + child_count[node]
+        mbrs = leaf_mbr[start:end] if node_leaf[node] else node_mbr[start:end]
+        px, py = xs[pts], ys[pts]
+        # (children, points) matrix of bounding box hits
+        hits = (mbrs[:, 0, None] <= px) & (mbrs[:, 2, None] >= px) & (mbrs[:, 1, None] <= py) & (mbrs[:, 3, None] >= py)
+        if node_leaf[node]:
+            entries_tested += np.count_nonzero(hits)
+        else:
+            stack.extend((start + j, pts[hits[j]]) for j in np.flatnonzero(hits.any(axis=1)).tolist())
+
+    levels = []
+    for d in range(int(depth.max()) + 1 if len(depth) > 0 else 0):
+        at = depth == d
+        levels.append({"depth": d, "nodes": int(np.count_nonzero(at)), "area": float(area[at].sum()),
+                       "overlap_area": float(overlap[at].sum()), "dead_space": float(dead_space[at].sum())})
+    total_area = max(float(area.sum()), np.finfo(np.float64).tiny)
+    queries = max(len(xs), 1)
+    return {
+        "nodes": len(node_mbr),
+        "leaves": int(np.count_nonzero(node_leaf)),
+        "height": len(levels),
+        "overlap_area": float(overlap.sum()),
+        "overlap_ratio": float(overlap.sum()) / total_area,
+        "dead_space": float(dead_space.sum()),
+        "dead_space_ratio": float(dead_space.sum()) / total_area,
+        "nodes_visited": float(nodes_visited) / queries,
+        "entries_tested": float(entries_tested) / queries,
+        "levels": levels,
+    }
+
 
+def tree_stats(arrays: Dict[str, np.ndarray]) -> dict:
+    """
+    Shape of a tree flattened by to_arrays: node, leaf and entry counts, height, nodes per depth, fanout of inner
+    nodes and fill of leaves, and bytes of the arrays
+    """
+    child_start, child_count = arrays["node_child_start"], arrays["node_child_count"]
+    node_leaf = arrays["node_leaf"]
+    nodes_per_depth = []
+    # nodes are in breadth first order, so every level is a contiguous range of nodes following the level above
+    first, last = 0, min(1, len(node_leaf))
+    while first < last:
+        nodes_per_depth.append(last - first)
+        inner = np.flatnonzero(~node_leaf[first:last]) + first
+        if len(inner) == 0:
+            break
+        first, last = int(child_start[inner].min()), int((child_start[inner] + child_count[inner]).max())
+    return {
+        "nodes": len(node_leaf),
+        "leaves": int(np.count_nonzero(node_leaf)),
+        "entries": len(arrays["leaf_pids"]),
+        "height": len(nodes_per_depth),
+        "nodes_per_depth": nodes_per_depth,
+        "fanout": value_summary(child_count[~node_leaf]),
+        "leaf_fill": value_summary(child_count[node_leaf]),
+        "bytes": sum(arr.nbytes for arr in arrays.values()),
+    }
@@ -1,30 +1,239 @@
+import numpy as np
+import shapely
 from geopandas import GeoDataFrame
-from shapely.geometry import Point, Polygon
-from typing import List
+from pandas import DataFrame
+from shapely.geometry import Point
+from typing import Iterable, List, Tuple, Union
 
-from geodatapoint import GeoDataPoint
-from spatialindex import SpatialIndex
-from strtree import STRTree
+import indexfile
+from geodatapoint import GeoDataPoint, polygon_parts
+from spatialindex import SpatialIndex, collect_pairs, parse_feature, feature_map, needs_compaction, compaction, \
+    next_feature_id, feature_polygons, polygon_feature_ids, polygon_metadata, REGION_PREDICATES
+from featurereader import dataframe_features
+from indexstats import LookupTrace, polygon_stats
+from metastore import MetaStore
+from flatstrtree import FlatSTRTree
+from strtree import STRTree, tree_quality
 
 
 class STRTreeIndex(SpatialIndex):
-    def __init__(self, node_capacity: int = 10):
+    '''
+    Two tree layouts are provided:
+    OBJECT_TREE: STRTree, a tree of RTreeNode objects
+    FLAT_TREE: FlatSTRTree, node MBRs and children ranges in flat numpy arrays
+    '''
+    OBJECT_TREE = 1
+    FLAT_TREE = 2
+
+    # bulk loaders, see STRTree
+    STR_PACKING = STRTree.STR_PACKING
+    HILBERT_PACKING = STRTree.HILBERT_PACKING
+
+    def __init__(self, node_capacity: int = 10, repack_ratio: float = 0.25, tree_type=OBJECT_TREE,
+                 packing=STR_PACKING):
         self.node_capacity = node_capacity
-        self.strtree = STRTree(node_capacity)
+        self.repack_ratio = repack_ratio
+        self.tree_type = tree_type
+        self.packing = packing
+        self.strtree = self.__tree_class()(node_capacity, repack_ratio, packing)
+        self.polygons: List[GeoDataPoint] = []
+        # feature id -> pids of its polygons. None until needed on a loaded index
+        self.features: Union[dict, None] = dict()
+        # attributes of every feature, referenced by row from self.polygons
+        self.metas = MetaStore()
+        self._next_fid = None
+
+    def __tree_class(self):
+        if self.tree_type == self.OBJECT_TREE:
+            return STRTree
+        elif self.tree_type == self.FLAT_TREE:
+            return FlatSTRTree
+        else:
+            raise Exception("Invalid tree type")
 
     def build(self, geo_df: GeoDataFrame):
-        gdp_list = []
-        df_columns = list(geo_df.columns)
-        for i, row in geo_df.iterrows():
-            polygons: List[Polygon] = row["geometry"].geoms
-            # TODO: Check for non-polygon entries
-            for poly in polygons:
-                meta = {column: row[column] for column in list(filter(lambda x: x != "geometry", df_columns))}
-                gdp_list.append(GeoDataPoint(meta, poly))
+        self.build_from_stream(dataframe_features(geo_df))
+
+    def build_from_stream(self, features: Iterable):
+        """Builds the index from GeoJSON like features (see feature_polygons), parsed one at a time"""
+        self.polygons = []
+        self.features = dict()
+        self.metas = MetaStore()
+        self._next_fid = None
+        gdp_list = list(feature_polygons(features, self.polygons, self.features, self.metas))
+        self.metas.finalize()
         self.strtree.build(gdp_list)
 
+    def metadata(self, pids, columns: List[str] = None) -> DataFrame:
+        """Attributes of the features of polygons pids (e.g. from lookup_many), one row per pid"""
+        return polygon_metadata(self.polygons, self.metas, pids, columns)
+
+    def feature_ids(self, pids) -> np.ndarray:
+        return polygon_feature_ids(self.polygons, pids)
+
+    def __feature_map(self) -> dict:
+        if self.features is None:
+            self.features = feature_map(self.polygons)
+        return self.features
+
+    def __add_feature(self, fid, geometry, meta: dict):
+        pids = []
+        row = self.metas.append(meta)
+        for part, poly in enumerate(polygon_parts(geometry)):
+            gdp = GeoDataPoint(None, poly, len(self.polygons), fid, part, row, self.metas)
+            self.polygons.append(gdp)
+            pids.append(gdp.pid)
+            self.strtree.insert(gdp)
+        self.features[fid] = pids
+
+    def __remove_feature(self, fid):
+        for pid in self.features.pop(fid):
+            self.strtree.delete(self.polygons[pid])
+            self.polygons[pid] = None
+
+    def __maybe_repack(self):
+        if self.strtree.needs_repack:
+            self.compact()
+
+    def compact(self):
+        """
+        Drops deleted polygons, and the attribute rows of deleted and updated features: live polygons are numbered
+        again densely, in order, and the tree is packed again over them. pids returned before are invalid afterwards
+        """
+        if not needs_compaction(self.polygons, self.metas):
+            self.strtree.repack()
+            return
+        _, rows, metas = compaction(self.polygons, self.metas)
+        live = [gdp for gdp in self.polygons if gdp is not None]
+        for pid, (gdp, row) in enumerate(zip(live, rows.tolist())):
+            gdp.relocate(pid, row, metas)
+        self.polygons, self.metas, self.features = live, metas, None
+        # STR packing sorts the list it is given
+        self.strtree.build(list(live))
+
+    def insert(self, feature):
+        """Indexes a GeoJSON like feature (see parse_feature). Returns its id, a new integer one if it has none"""
+        fid, geometry, meta = parse_feature(feature)
+        features = self.__feature_map()
+        if self._next_fid is None:
+            self._next_fid = next_feature_id(features)
+        if fid is None:
+            fid = self._next_fid
+        if fid in features:
+            raise KeyError("feature {} is already indexed".format(fid))
+        if isinstance(fid, (int, np.integer)):
+            self._next_fid = max(self._next_fid, fid + 1)
+        self.__add_feature(fid, geometry, meta)
+        self.__maybe_repack()
+        return fid
+
+    def delete(self, feature_id):
+        if feature_id not in self.__feature_map():
+            raise KeyError("feature {} is not indexed".format(feature_id))
+        self.__remove_feature(feature_id)
+        self.__maybe_repack()
+
+    def update(self, feature_id, geometry=None, meta: dict = None):
+        """Replaces geometry and/or meta of a feature; whichever is None is kept"""
+        features = self.__feature_map()
+        if feature_id not in features:
+            raise KeyError("feature {} is not indexed".format(feature_id))
+        parts = [self.polygons[pid] for pid in features[feature_id]]
+        if geometry is None:
+            geometry = parts[0].poly if len(parts) == 1 else shapely.multipolygons([gdp.poly for gdp in parts])
+        if meta is None:
+            meta = parts[0].meta
+        self.__remove_feature(feature_id)
+        self.__add_feature(feature_id, geometry, meta)
+        self.__maybe_repack()
+
     def lookup(self, p: Point):
         return self.strtree.search(p)
 
+    def _traced_lookup(self, p: Point, trace: LookupTrace):
+        return self.strtree.traced_search(p, trace)
+
+    def lookup_many(self, lons: np.ndarray, lats: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Batched lookup pushing whole point arrays down the tree; polygon ids index into self.polygons"""
+        lons = np.asarray(lons, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+        found = self.strtree.search_many(lons, lats)
+        return collect_pairs([pts for pts, _ in found], [np.full(len(pts), gdp.pid) for pts, gdp in found])
+
+    def query_region(self, geometry, predicate: str = "intersects") -> List[GeoDataPoint]:
+        """Polygons intersecting (predicate="intersects") or lying within (predicate="within") geometry, by pid"""
+        if predicate not in REGION_PREDICATES:
+            raise Exception("Invalid predicate")
+        return sorted(self.strtree.search_region(geometry, predicate), key=lambda gdp: gdp.pid)
+
+    def nearest(self, p: Point, k: int = 1, max_distance: float = None) -> List[Tuple[GeoDataPoint, float]]:
+        return self.strtree.nearest(p, k, max_distance)
+
+    def save(self, path: str):
+        """
+        Writes the index to path. Deleted polygons and stale attribute rows are left out of the file, which holds the
+        index as compact would leave it; this index and the pids it returned are unchanged
+        """
+        sections = self.strtree.to_arrays()
+        polygons, metas, rows = self.polygons, self.metas, None
+        if needs_compaction(self.polygons, self.metas):
+            pids, rows, metas = compaction(self.polygons, self.metas)
+            polygons = [gdp for gdp in self.polygons if gdp is not None]
+            sections["leaf_pids"] = pids[sections["leaf_pids"]]
+        sections.update(indexfile.pack_polygons(polygons, rows))
+        sections.update(metas.to_sections())
+        indexfile.write_index(path, {"kind": "strtree", "node_capacity": self.node_capacity,
+                                     "repack_ratio": self.repack_ratio, "tree_type": self.tree_type,
+                                     "packing": self.packing}, sections)
+
+    @classmethod
+    def load(cls, path: str, tree_type=None) -> 'STRTreeIndex':
+        """
+        Maps an index written by save. Polygons are decoded on first use. A FLAT_TREE searches the mapped arrays
+        directly; files from either tree type load as either, tree_type defaults to the one saved
+        """
+        header, sections = indexfile.read_index(path)
+        if header.get("kind") != "strtree":
+            raise ValueError("not a strtree index file: {}".format(path))
+        if tree_type is None:
+            tree_type = header.get("tree_type", cls.OBJECT_TREE)
+        idx = cls(header["node_capacity"], header.get("repack_ratio", 0.25), tree_type,
+                  header.get("packing", cls.STR_PACKING))
+        idx.metas = MetaStore.from_sections(sections)
+        idx.polygons = indexfile.load_polygons(sections, idx.metas)
+        idx.features = None
+        idx.strtree = idx.__tree_class().from_arrays(idx.node_capacity, sections, idx.polygons, idx.repack_ratio,
+                                                     idx.packing)
+        return idx
+
+    def quality(self, lons: np.ndarray = None, lats: np.ndarray = None, query_count: int = 1000) -> dict:
+        """
+        Tree quality report (see tree_quality) for point queries at lons, lats, by default query_count points
+        spread uniformly over the tree's bounding box
+        """
+        arrays = self.strtree.to_arrays()
+        if lons is None or lats is None:
+            min_lon, min_lat, max_lon, max_lat = arrays["node_mbr"][0]
+            rng = np.random.default_rng(0)
+            lons = rng.uniform(min_lon, max_lon, query_count)
+            lats = rng.uniform(min_lat, max_lat, query_count)
+        return tree_quality(arrays, np.asarray(lons, dtype=np.float64), np.asarray(lats, dtype=np.float64))
+
+    def stats(self) -> dict:
+        """Shape of the tree (see tree_stats) and bytes per structure; polygon bytes only count polygons in memory"""
+        tree = self.strtree.stats()
+        polygons = polygon_stats(self.polygons)
+        return {
+            "tree": tree,
+            "polygons": polygons["polygons"],
+            "deleted_polygons": polygons["deleted"],
+            "stale_meta_rows": len(self.metas) - polygons["rows"],
+            "bytes": {
+                "tree": tree["bytes"],
+                "polygons": polygons["coordinate_bytes"],
+                "meta": self.metas.nbytes,
+            },
+        }
+
     def show(self):
         raise NotImplementedError("show is not implemented for STRTreeIndex")
@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+# modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from workload import Workload  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def workload() -> Workload:
+    return Workload.synthetic(500, seed=0)
+
+
+def features_by_point(points, fids, n: int) -> list:
+    """Set of feature ids per point, from parallel (point index, feature id) arrays"""
+    out = [set() for _ in range(n)]
+    for point, fid in zip(points.tolist(), fids.tolist()):
+        out[point].add(fid)
+    return out
@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+import indexfile
+
+
+def test_round_trip_maps_sections(tmp_path):
+    path = str(tmp_path / "index.idx")
+    sections = {"ids": np.arange(10, dtype=np.int32), "mbr": np.ones((3, 4)), "empty": np.empty(0, dtype=np.int64)}
+    indexfile.write_index(path, {"kind": "test"}, sections)
+    header, loaded = indexfile.read_index(path)
+    assert header["kind"] == "test"
+    for name, arr in sections.items():
+        np.testing.assert_array_equal(loaded[name], arr)
+        assert loaded[name].dtype == arr.dtype
+
+
+@pytest.mark.parametrize("version", [indexfile.VERSION - 1, indexfile.VERSION + 1])
+def test_other_versions_are_rejected(tmp_path, version):
+    path = str(tmp_path / "index.idx")
+    indexfile.write_index(path, {"kind": "test"}, {"ids": np.arange(10, dtype=np.int32)})
+    with open(path, "r+b") as f:
+        magic, _, header_len = indexfile._PREAMBLE.unpack(f.read(indexfile._PREAMBLE.size))
+        f.seek(0)
+        f.write(indexfile._PREAMBLE.pack(magic, version, header_len))
+    with pytest.raises(ValueError, match="unsupported index file version"):
+        indexfile.read_index(path)
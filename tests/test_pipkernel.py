@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+import shapely
+from shapely.geometry import Point, Polygon
+
+from pipkernel import EdgeGrid
+from workload import Workload
+
+
+def _star(n: int, x: float, y: float, r: float) -> Polygon:
+    angles = np.linspace(0, 2 * np.pi, 2 * n, endpoint=False)
+    radii = np.where(np.arange(2 * n) % 2 == 0, r, r / 3)
+    return Polygon(np.column_stack([x + radii * np.cos(angles), y + radii * np.sin(angles)]))
+
+
+# small polygons, large ones, and ones far from the origin, where the orientation tolerance matters most
+SHAPES = {
+    "voronoi": [poly for geometry in Workload.synthetic(50, seed=0).dataset.geometry[:10] for poly in geometry.geoms],
+    "circle": [Point(0, 0).buffer(1, quad_segs=256)],
+    "city_circle": [Point(-73.98, 40.75).buffer(1e-3, quad_segs=256)],
+    "star": [_star(400, 0, 0, 1), _star(300, -73.98, 40.75, 1e-2)],
+    "square": [shapely.box(0, 0, 1, 1), shapely.box(-74, 40.7, -73.9, 40.8)],
+}
+
+
+def _holed(poly: Polygon) -> Polygon:
+    """poly with a square hole around its representative point, whose edges are axis parallel"""
+    min_x, min_y, max_x, max_y = poly.bounds
+    cx, cy = poly.representative_point().coords[0]
+    half = min(max_x - min_x, max_y - min_y) / 8
+    # shrunk until the hole lies inside poly
+    while not poly.contains(shapely.box(cx - half, cy - half, cx + half, cy + half)):
+        half /= 2
+    holed = poly.difference(shapely.box(cx - half, cy - half, cx + half, cy + half))
+    assert len(holed.interiors) == 1 and holed.is_valid
+    return holed
+
+
+def _collinear(poly: Polygon) -> Polygon:
+    """poly segmentized into at least EdgeGrid.MIN_VERTICES vertices, i.e. with runs of collinear edges"""
+    return shapely.segmentize(poly, poly.exterior.length / EdgeGrid.MIN_VERTICES)
+
+
+VARIANTS = {"original": lambda poly: poly, "hole": _holed, "collinear": _collinear}
+
+
+@pytest.mark.parametrize("variant", list(VARIANTS))
+@pytest.mark.parametrize("shape", list(SHAPES))
+def test_contains_xy_matches_shapely(shape, variant):
+    rng = np.random.default_rng(0)
+    for poly in SHAPES[shape]:
+        poly = VARIANTS[variant](poly)
+        grid = EdgeGrid(poly)
+        min_x, min_y, max_x, max_y = poly.bounds
+        pad_x, pad_y = (max_x - min_x) * 0.05, (max_y - min_y) * 0.05
+        coords = shapely.get_coordinates(poly)
+        middles = (coords[:-1] + coords[1:]) / 2
+        # random points, and points on vertices, edges and cell centers where the crossing count is least reliable
+        xs = np.concatenate([rng.uniform(min_x - pad_x, max_x + pad_x, 2000), coords[:, 0], middles[:, 0],
+                             grid.centers[:, 0]])
+        ys = np.concatenate([rng.uniform(min_y - pad_y, max_y + pad_y, 2000), coords[:, 1], middles[:, 1],
+                             grid.centers[:, 1]])
+        np.testing.assert_array_equal(grid.contains_xy(xs, ys), shapely.contains_xy(poly, xs, ys))
+
+
+def test_build_skips_small_and_invalid_geometries():
+    assert EdgeGrid.build(shapely.box(0, 0, 1, 1)) is None
+    assert EdgeGrid.build(SHAPES["circle"][0].union(shapely.box(2, 2, 3, 3))) is None
+    assert EdgeGrid.build(SHAPES["circle"][0]) is not None
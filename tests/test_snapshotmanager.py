@@ -0,0 +1,66 @@
+import asyncio
+
+import pytest
+
+from conftest import features_by_point
+from geotrieindex import GeoTrieIndex
+from lookupserver import LookupBatcher
+from snapshotmanager import SnapshotManager
+from strtreeindex import STRTreeIndex
+
+INDEXES = [
+    (GeoTrieIndex, {"gh_len": 4}),
+    (STRTreeIndex, {"node_capacity": 10, "tree_type": STRTreeIndex.OBJECT_TREE}),
+    (STRTreeIndex, {"node_capacity": 10, "tree_type": STRTreeIndex.FLAT_TREE}),
+]
+
+
+@pytest.fixture(params=INDEXES, ids=["geotrie", "object_tree", "flat_tree"])
+def swapping(request, workload, tmp_path):
+    '''
+    (manager, lons, lats, expected): a manager over the workload whose current snapshot swaps in a rebuild with
+    every other feature dropped, which renumbers the pids of the rest, once its lookup_many has run and before it
+    returns. expected are the features of the points on the workload itself
+    '''
+    index_cls, params = request.param
+    gdf = workload.dataset
+    lons, lats = workload.points(2000)
+    reference = index_cls(**params)
+    reference.build(gdf)
+    expected = features_by_point(*reference.lookup_features(lons, lats), len(lons))
+
+    manager = SnapshotManager(index_cls, params, str(tmp_path), warm=False)
+    manager.refresh(gdf, wait=True)
+    with manager.acquire() as idx:
+        lookup_many = idx.lookup_many
+
+        def lookup_and_swap(xs, ys):
+            found = lookup_many(xs, ys)
+            manager.refresh(gdf.iloc[::2], wait=True)
+            return found
+
+        idx.lookup_many = lookup_and_swap
+    yield manager, lons, lats, expected
+    manager.close()
+
+
+def test_lookup_features_resolves_on_the_snapshot_looked_up(swapping):
+    manager, lons, lats, expected = swapping
+    version = manager.version
+    got = features_by_point(*manager.lookup_features(lons, lats), len(lons))
+    assert manager.version == version + 1
+    assert got == expected
+
+
+def test_batcher_resolves_on_the_snapshot_looked_up(swapping):
+    manager, lons, lats, expected = swapping
+    version = manager.version
+
+    async def lookup_all():
+        batcher = LookupBatcher(manager, max_batch=len(lons))
+        return await asyncio.gather(*[batcher.lookup(lon, lat) for lon, lat in zip(lons.tolist(), lats.tolist())])
+
+    got = [set(features) for features in asyncio.run(lookup_all())]
+    assert manager.version == version + 1
+    assert got == expected
+
@@ -0,0 +1,116 @@
+import numpy as np
+import pytest
+import shapely
+from geopandas import GeoDataFrame
+from shapely import affinity
+from shapely.geometry import MultiPolygon
+
+from conftest import features_by_point
+from geotrieindex import GeoTrieIndex
+from queryexecutor import load_index
+from strtreeindex import STRTreeIndex
+
+# tree variants repack rarely, so that deleted and pending polygons are still around at save
+INDEXES = {
+    "trie_store": (GeoTrieIndex, {"gh_len": 5, "scan_algorithm": GeoTrieIndex.VECTOR_GRID}),
+    "array_store": (GeoTrieIndex, {"gh_len": 5, "scan_algorithm": GeoTrieIndex.VECTOR_GRID,
+                                   "store_type": GeoTrieIndex.ARRAY_STORE}),
+    "object_tree": (STRTreeIndex, {"node_capacity": 10, "repack_ratio": 10.0, "tree_type": STRTreeIndex.OBJECT_TREE}),
+    "flat_tree": (STRTreeIndex, {"node_capacity": 10, "repack_ratio": 10.0, "tree_type": STRTreeIndex.FLAT_TREE}),
+    "flat_tree_repacking": (STRTreeIndex, {"node_capacity": 10, "tree_type": STRTreeIndex.FLAT_TREE}),
+}
+
+
+def _mutate(idx, gdf: GeoDataFrame) -> GeoDataFrame:
+    """Deletes, updates and inserts features of idx, built on gdf. Returns gdf with the same changes"""
+    gdf = gdf.copy()
+    fids = gdf.index.tolist()
+    for fid in fids[::7]:
+        idx.delete(fid)
+    gdf = gdf.drop(fids[::7])
+    for fid in fids[1::7]:
+        # moved, and split into two parts
+        geometry = gdf.geometry[fid].geoms[0]
+        moved = MultiPolygon([affinity.translate(geometry, 0.01, 0.0), affinity.scale(geometry, 0.5, 0.5)])
+        idx.update(fid, geometry=moved)
+        gdf.loc[fid, "geometry"] = moved
+    for fid in fids[2::7]:
+        idx.update(fid, meta={"name": "updated{}".format(fid), "val": -fid})
+        gdf.loc[fid, ["name", "val"]] = ["updated{}".format(fid), -fid]
+    min_lon, min_lat, max_lon, max_lat = gdf.total_bounds
+    for k in range(5):
+        fid = "new{}".format(k)
+        x, y = min_lon + k * 0.05, min_lat + k * 0.05
+        geometry = shapely.box(x, y, x + 0.1, y + 0.1)
+        assert idx.insert({"id": fid, "geometry": geometry, "properties": {"name": fid, "val": 1000 + k}}) == fid
+        gdf.loc[fid] = [fid, 1000 + k, MultiPolygon([geometry])]
+    return gdf
+
+
+def _answers(idx, lons: np.ndarray, lats: np.ndarray):
+    """Features of every point, and the attributes of every feature found, through lookup_many and its pids"""
+    points, pids = idx.lookup_many(lons, lats)
+    fids = idx.feature_ids(pids)
+    meta = idx.metadata(pids)
+    attributes = {fid: (name, int(val)) for fid, name, val in zip(fids.tolist(), meta["name"], meta["val"])}
+    return features_by_point(points, fids, len(lons)), attributes
+
+
+@pytest.fixture(params=list(INDEXES))
+def mutated(request, workload):
+    """(index, expected answers, lons, lats): an index built and mutated, and the answers of one rebuilt after"""
+    index_cls, params = INDEXES[request.param]
+    idx = index_cls(**params)
+    idx.build(workload.dataset)
+    gdf = _mutate(idx, workload.dataset)
+    rebuilt = index_cls(**params)
+    rebuilt.build(gdf)
+    lons, lats = workload.points(5000)
+    return idx, _answers(rebuilt, lons, lats), lons, lats
+
+
+def test_updates_match_a_rebuild(mutated):
+    idx, expected, lons, lats = mutated
+    assert _answers(idx, lons, lats) == expected
+
+
+def test_compact_matches_a_rebuild(mutated):
+    idx, expected, lons, lats = mutated
+    idx.compact()
+    assert all(gdp is not None for gdp in idx.polygons)
+    assert idx.stats()["stale_meta_rows"] == 0
+    assert _answers(idx, lons, lats) == expected
+
+
+def test_save_round_trip_leaves_the_index_alone(mutated, tmp_path):
+    idx, expected, lons, lats = mutated
+    points, pids = idx.lookup_many(lons, lats)
+    fids, meta = idx.feature_ids(pids), idx.metadata(pids)
+    polygon_count = len(idx.polygons)
+    idx.save(str(tmp_path / "index.idx"))
+
+    # pids returned before the save still resolve to the same features and attributes
+    assert len(idx.polygons) == polygon_count
+    assert idx.feature_ids(pids).tolist() == fids.tolist()
+    assert idx.metadata(pids).equals(meta)
+    assert _answers(idx, lons, lats) == expected
+
+    loaded = load_index(str(tmp_path / "index.idx"))
+    assert all(gdp is not None for gdp in loaded.polygons)
+    assert loaded.stats()["stale_meta_rows"] == 0
+    assert _answers(loaded, lons, lats) == expected
+
+
+def test_updates_of_a_loaded_index_match_a_rebuild(workload, tmp_path):
+    for name, (index_cls, params) in INDEXES.items():
+        idx = index_cls(**params)
+        idx.build(workload.dataset)
+        idx.save(str(tmp_path / "{}.idx".format(name)))
+        loaded = load_index(str(tmp_path / "{}.idx".format(name)))
+        gdf = _mutate(loaded, workload.dataset)
+        rebuilt = index_cls(**params)
+        rebuilt.build(gdf)
+        lons, lats = workload.points(5000)
+        assert _answers(loaded, lons, lats) == _answers(rebuilt, lons, lats), name
+        loaded.compact()
+        assert _answers(loaded, lons, lats) == _answers(rebuilt, lons, lats), name
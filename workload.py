@@ -0,0 +1,100 @@
+from typing import List, Tuple
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from geopandas import GeoDataFrame
+from shapely import affinity
+from shapely.geometry import MultiPolygon, box
+
+
+class Workload(object):
+    '''
+    Seeded benchmark inputs: a polygon dataset, and points, regions and updates drawn over its extent.
+    Every stream is drawn from its own generator seeded by (seed, stream, size), so the same workload always
+    yields the same inputs, whatever else was drawn before.
+
+    Two point distributions are provided:
+    UNIFORM: points spread uniformly over the bounding box of the dataset
+    HOTSPOT: hot_share of the points close to one of hot_count hot spots, the rest uniform
+    '''
+    UNIFORM = 1
+    HOTSPOT = 2
+
+    _POINTS = 1
+    _REGIONS = 2
+    _UPDATES = 3
+    _SYNTHETIC = 4
+
+    def __init__(self, name: str, dataset: GeoDataFrame, seed: int = 0, spec: dict = None):
+        self.name = name
+        self.dataset = dataset
+        self.seed = seed
+        # arguments of from_spec that rebuild this workload, e.g. in another process
+        self.spec = spec
+
+    @classmethod
+    def from_file(cls, path: str, sample_size: int = None, seed: int = 0) -> 'Workload':
+        dataset = gpd.read_file(path)
+        if sample_size is not None and sample_size > 0:
+            dataset = dataset[:sample_size]
+        return cls(path, dataset, seed, {"path": path, "sample_size": sample_size, "seed": seed})
+
+    @classmethod
+    def synthetic(cls, polygon_count: int = 10000, seed: int = 0,
+                  bounds: Tuple[float, float, float, float] = (-74.3, 40.5, -73.7, 40.9)) -> 'Workload':
+        """Voronoi tessellation of polygon_count random sites over bounds, one MultiPolygon feature per cell"""
+        rng = np.random.default_rng((seed, cls._SYNTHETIC, polygon_count))
+        min_lon, min_lat, max_lon, max_lat = bounds
+        sites = shapely.multipoints(np.column_stack([rng.uniform(min_lon, max_lon, polygon_count),
+                                                     rng.uniform(min_lat, max_lat, polygon_count)]))
+        extent = box(*bounds)
+        cells = [cell.intersection(extent) for cell in shapely.voronoi_polygons(sites, extend_to=extent).geoms]
+        dataset = GeoDataFrame({"name": ["cell{}".format(i) for i in range(len(cells))],
+                                "val": np.arange(len(cells))},
+                               geometry=[MultiPolygon([cell]) for cell in cells], crs="EPSG:4326")
+        name = "synthetic-{}".format(polygon_count)
+        return cls(name, dataset, seed, {"polygon_count": polygon_count, "seed": seed, "bounds": list(bounds)})
+
+    @classmethod
+    def from_spec(cls, spec: dict) -> 'Workload':
+        if "path" in spec:
+            return cls.from_file(spec["path"], spec["sample_size"], spec["seed"])
+        return cls.synthetic(spec["polygon_count"], spec["seed"], tuple(spec["bounds"]))
+
+    def __rng(self, stream: int, size: int, *extra) -> np.random.Generator:
+        return np.random.default_rng((self.seed, stream, size) + extra)
+
+    def points(self, n: int, distribution=UNIFORM, hot_count: int = 100, hot_share: float = 0.9,
+               spread: float = 1e-3) -> Tuple[np.ndarray, np.ndarray]:
+        """Longitudes and latitudes of n points. spread is the deviation around hot spots, relative to the extent"""
+        if distribution not in (self.UNIFORM, self.HOTSPOT):
+            raise Exception("Invalid distribution")
+        rng = self.__rng(self._POINTS, n, distribution)
+        min_lon, min_lat, max_lon, max_lat = self.dataset.total_bounds
+        xs = rng.uniform(min_lon, max_lon, n)
+        ys = rng.uniform(min_lat, max_lat, n)
+        if distribution == self.HOTSPOT:
+            hot_xs = rng.uniform(min_lon, max_lon, hot_count)
+            hot_ys = rng.uniform(min_lat, max_lat, hot_count)
+            hot = np.flatnonzero(rng.random(n) < hot_share)
+            spots = rng.integers(0, hot_count, len(hot))
+            xs[hot] = np.clip(hot_xs[spots] + rng.normal(0, (max_lon - min_lon) * spread, len(hot)), min_lon, max_lon)
+            ys[hot] = np.clip(hot_ys[spots] + rng.normal(0, (max_lat - min_lat) * spread, len(hot)), min_lat, max_lat)
+        return xs, ys
+
+    def regions(self, n: int, size: float = 0.1) -> List:
+        """n boxes whose sides are size times the extent of the dataset"""
+        rng = self.__rng(self._REGIONS, n)
+        min_lon, min_lat, max_lon, max_lat = self.dataset.total_bounds
+        width = (max_lon - min_lon) * size
+        height = (max_lat - min_lat) * size
+        xs = rng.uniform(min_lon, max_lon - width, n)
+        ys = rng.uniform(min_lat, max_lat - height, n)
+        return [box(x, y, x + width, y + height) for x, y in zip(xs, ys)]
+
+    def updates(self, n: int, offset: float = 1e-4) -> List[Tuple]:
+        """(feature id, geometry) pairs moving n random features by offset degrees"""
+        rng = self.__rng(self._UPDATES, n)
+        fids = rng.choice(np.asarray(self.dataset.index), size=n)
+        return [(fid, affinity.translate(self.dataset.geometry[fid], offset, offset)) for fid in fids.tolist()]